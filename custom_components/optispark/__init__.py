@@ -29,6 +29,7 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
         hass=hass,
         client=OptisparkApiClient(
             session=async_get_clientsession(hass)),
+        entry_id=entry.entry_id,
         climate_entity_id=entry.data['climate_entity_id'],
         heat_pump_power_entity_id=entry.data['heat_pump_power_entity_id'],
         external_temp_entity_id=entry.data['external_temp_entity_id'],
@@ -40,6 +41,7 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     await coordinator.async_config_entry_first_refresh()
 
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+    entry.async_on_unload(coordinator.async_shutdown)
     entry.async_on_unload(entry.add_update_listener(async_reload_entry))
 
     return True
@@ -52,10 +54,19 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     return unloaded
 
 
+async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Delete the history cache, upload journal and heating profile of a removed entry."""
+    from .history_cache import async_remove_history_cache  # Prevent circular import
+    from .profile_store import ProfileStore
+    from .upload_journal import UploadJournal
+    await async_remove_history_cache(hass, entry.entry_id)
+    await UploadJournal(hass, entry.entry_id).async_remove()
+    await ProfileStore(hass, entry.entry_id).async_remove()
+
+
 async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
     """Reload config entry."""
-    await async_unload_entry(hass, entry)
-    await async_setup_entry(hass, entry)
+    await hass.config_entries.async_reload(entry.entry_id)
 
 
 class OptisparkGetEntityError(Exception):
@@ -2,7 +2,9 @@
 from __future__ import annotations
 
 import asyncio
-import socket
+import json
+import random
+import time
 
 import aiohttp
 import async_timeout
@@ -11,9 +13,19 @@ from datetime import datetime, timezone
 import pickle
 import gzip
 import base64
+import numpy as np
 from .const import LOGGER
+from . import const
+from .compression import JSON_CODECS, CompressionPolicy, binary_codecs
+from .resilience import CircuitBreaker, RetryPolicy
+from .transport import AiohttpTransport, TransportResponse
 import traceback
 
+# Body of the binary transport: the pickled payload sent as is, compressed with Content-Encoding
+# (identity, gzip or xz)
+BINARY_CONTENT_TYPE = 'application/vnd.optispark.pickle'
+JSON_CONTENT_TYPE = 'application/json'
+
 
 class OptisparkApiClientError(Exception):
     """Exception to indicate a general API error."""
@@ -31,6 +43,18 @@ class OptisparkApiClientCommunicationError(
     """Exception to indicate a communication error."""
 
 
+class OptisparkApiClientCircuitOpenError(
+    OptisparkApiClientCommunicationError
+):
+    """The backend has been failing, the call wasn't attempted."""
+
+
+class OptisparkApiClientRequestError(
+    OptisparkApiClientError
+):
+    """Exception to indicate the lambda rejected the request (4xx status, or 502 for a bad payload)."""
+
+
 class OptisparkApiClientAuthenticationError(
     OptisparkApiClientError
 ):
@@ -74,7 +98,7 @@ def floats_to_decimal(obj):
     elif isinstance(obj, list):
         return [floats_to_decimal(element) for element in obj]
     elif isinstance(obj, tuple):
-        return (floats_to_decimal(element) for element in obj)
+        return tuple(floats_to_decimal(element) for element in obj)
     elif isinstance(obj, datetime):
         return floats_to_decimal(obj.timestamp())
     else:
@@ -82,15 +106,109 @@ def floats_to_decimal(obj):
         raise TypeError(f'Object of type {type(obj)} not supported by DynamoDB')
 
 
+def decimal_column(values) -> list[Decimal]:
+    """Convert a column of floats to Decimals in bulk.
+
+    The same as Decimal(str(x)) for each element, numpy formats float64 with the same shortest
+    repr as python does.
+    """
+    return list(map(Decimal, np.asarray(values, dtype=np.float64).astype(str).tolist()))
+
+
+def encode_history(frame):
+    """Encode a HistoryFrame in the {timestamp: {'state': ..., 'attributes': {...}}} format.
+
+    The output is identical to floats_to_decimal(frame.to_dict()) but the timestamps and numeric
+    states are converted a whole column at a time, and each distinct attributes payload is only
+    converted once (every reading still gets its own copy of the dict).
+    """
+    timestamps = decimal_column(frame.timestamps / 1e6)
+    if frame.label_ids is not None:
+        labels = [floats_to_decimal(label) for label in frame.labels]
+        states = [labels[label_id] for label_id in frame.label_ids.tolist()]
+    else:
+        states = decimal_column(frame.values)
+    attributes = [floats_to_decimal(dict(payload)) for payload in frame.attributes]
+    return {
+        timestamp: {
+            'state': state,
+            'attributes': attributes[attribute_id].copy() if attribute_id >= 0 else {}}
+        for timestamp, state, attribute_id in zip(timestamps, states, frame.attribute_ids.tolist())}
+
+
+def encode_dynamo_data(dynamo_data):
+    """Convert dynamo_data to the types supported by DynamoDB.
+
+    histories hold a HistoryFrame per column and are encoded with encode_history, everything else
+    is small and goes through floats_to_decimal.
+    """
+    encoded = {}
+    for key, value in dynamo_data.items():
+        if key == 'histories':
+            encoded[key] = {column: encode_history(frame) for column, frame in value.items()}
+        else:
+            encoded[key] = floats_to_decimal(value)
+    return encoded
+
+
+class ProfileFlight:
+    """A profile request in flight, shared by every caller with equivalent lambda_args."""
+
+    def __init__(self, key, task: asyncio.Task):
+        """Init."""
+        self.key = key
+        self.task = task
+        self.superseded = False
+
+
+def profile_request_key(lambda_args):
+    """Key that is equal for equivalent lambda_args.
+
+    Only the parameters set by the user (const.LAMBDA_PROFILE_REQUEST_KEY_ARGS) are compared.
+    initial_internal_temp and outside_range follow the heat pump's temperature, which can change
+    while a request is in flight, and a request with the previous reading is still the answer.
+    """
+    return json.dumps(
+        {key: lambda_args.get(key) for key in const.LAMBDA_PROFILE_REQUEST_KEY_ARGS},
+        sort_keys=True,
+        default=str)
+
+
 class OptisparkApiClient:
     """Optispark API Client."""
 
     def __init__(
         self,
-        session: aiohttp.ClientSession,
+        session: aiohttp.ClientSession | None = None,
+        transport=None,
+        lambda_url: str = const.LAMBDA_URL,
     ) -> None:
-        """Sample API Client."""
-        self._session = session
+        """Sample API Client.
+
+        Requests are sent to lambda_url with transport, or over session if no transport is given
+        (see transport.py).
+        Requests are sent with the json wrapped scheme until the backend answers with a binary
+        body, which means it accepts binary requests too.  Binary requests may be sent uncompressed
+        or with xz until the backend rejects that Content-Encoding with a 415, gzip is always
+        accepted.
+        """
+        self._transport = transport if transport is not None else AiohttpTransport(session)
+        self.lambda_url = lambda_url
+        self._binary_transport = False
+        self._rejected_encodings = set()  # Content-Encoding of binary requests, None for identity
+        # Time spent encoding and decoding payloads, by where it was run
+        self.codec_seconds = {'event loop': 0.0, 'executor': 0.0}
+        self.compression_policy = CompressionPolicy()
+        self._profile_flight: ProfileFlight | None = None
+        self.profile_requests_coalesced = 0
+        self.random = random.Random()
+        self.retry_policies = {
+            payload_type: RetryPolicy(*policy) for payload_type, policy in const.RETRY_POLICIES.items()}
+        self.default_retry_policy = RetryPolicy(*const.RETRY_POLICY_DEFAULT)
+        self.circuit_breaker = CircuitBreaker(
+            const.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            const.CIRCUIT_BREAKER_RESET_TIMEOUT,
+            self.random)
 
     def datetime_set_utc(self, d: dict[str, datetime]):
         """Set the timezone of the datetime values to UTC."""
@@ -102,13 +220,13 @@ class OptisparkApiClient:
 
     async def upload_history(self, dynamo_data):
         """Upload historical data to dynamoDB without calculating heat pump profile."""
-        lambda_url = 'https://lhyj2mknjfmatuwzkxn4uuczrq0fbsbd.lambda-url.eu-west-2.on.aws/'
         payload = {'dynamo_data': dynamo_data}
         payload['upload_only'] = True
         extra = await self._api_wrapper(
             method="post",
-            url=lambda_url,
+            url=self.lambda_url,
             data=payload,
+            payload_type='upload_history',
         )
         oldest_dates = self.datetime_set_utc(extra['oldest_dates'])
         newest_dates = self.datetime_set_utc(extra['newest_dates'])
@@ -119,13 +237,13 @@ class OptisparkApiClient:
 
         dynamo_data will only contain the user_hash.
         """
-        lambda_url = 'https://lhyj2mknjfmatuwzkxn4uuczrq0fbsbd.lambda-url.eu-west-2.on.aws/'
         payload = {'dynamo_data': dynamo_data}
         payload['get_newest_oldest_data_date_only'] = True
         extra = await self._api_wrapper(
             method="post",
-            url=lambda_url,
+            url=self.lambda_url,
             data=payload,
+            payload_type='get_data_dates',
         )
         oldest_dates = self.datetime_set_utc(extra['oldest_dates'])
         newest_dates = self.datetime_set_utc(extra['newest_dates'])
@@ -133,16 +251,48 @@ class OptisparkApiClient:
         return oldest_dates, newest_dates
 
     async def async_get_profile(self, lambda_args: dict):
-        """Get heat pump profile only."""
-        lambda_url = 'https://lhyj2mknjfmatuwzkxn4uuczrq0fbsbd.lambda-url.eu-west-2.on.aws/'
+        """Get heat pump profile only.
 
+        Single flight: callers with lambda_args equivalent to the request in flight await that
+        request instead of sending their own.  Callers with different lambda_args supersede it,
+        the stale request is cancelled and its callers are handed the new request's result.
+        """
+        key = profile_request_key(lambda_args)
+        flight = self._profile_flight
+        if flight is not None and not flight.task.done():
+            if flight.key == key:
+                self.profile_requests_coalesced += 1
+                LOGGER.debug(f'Profile request coalesced ({self.profile_requests_coalesced} so far)')
+            else:
+                LOGGER.debug('Profile request superseded by one with new lambda_args')
+                flight.superseded = True
+                flight.task.cancel()
+                flight = None
+        else:
+            flight = None
+        if flight is None:
+            flight = self._profile_flight = ProfileFlight(
+                key,
+                asyncio.create_task(self._async_get_profile(dict(lambda_args))))
+        while True:
+            try:
+                return await asyncio.shield(flight.task)
+            except asyncio.CancelledError:
+                if not (flight.superseded and flight.task.cancelled()):
+                    # This caller was cancelled, not the request
+                    raise
+                flight = self._profile_flight
+
+    async def _async_get_profile(self, lambda_args: dict):
+        """Request the heat pump profile from the lambda."""
         payload = lambda_args
         payload['get_profile_only'] = True
         LOGGER.debug('----------Lambda get profile----------')
         results, errors = await self._api_wrapper(
             method="post",
-            url=lambda_url,
+            url=self.lambda_url,
             data=payload,
+            payload_type='get_profile',
         )
         if errors['success'] is False:
             LOGGER.debug(f'OptisparkApiClientLambdaError: {errors["error_message"]}')
@@ -154,15 +304,6 @@ class OptisparkApiClient:
             results['projected_percent_savings'] = results['base_cost']/results['optimised_cost']*100 - 100
         return results
 
-    def json_serialisable(self, data):
-        """Convert to compressed bytes so that data can be converted to json."""
-        uncompressed_data = pickle.dumps(data)
-        compressed_data = gzip.compress(uncompressed_data)
-        LOGGER.debug(f'len(uncompressed_data): {len(uncompressed_data)}')
-        LOGGER.debug(f'len(compressed_data): {len(compressed_data)}')
-        base64_string = base64.b64encode(compressed_data).decode('utf-8')
-        return base64_string
-
     def json_deserialise(self, payload):
         """Convert from the compressed bytes to original objects."""
         payload = payload['serialised_payload']
@@ -171,48 +312,215 @@ class OptisparkApiClient:
         payload = pickle.loads(payload)
         return payload
 
+    def request_arguments(self, data, binary_codecs, payload_type, on_event_loop=False):
+        """Encode data and return the body and headers of a request.
+
+        binary_codecs are the codecs the binary transport may use, None for the json scheme.
+        The compression is chosen by self.compression_policy for the payload_type.  The binary
+        transport declares it with the Content-Encoding header, the json scheme is always gzip.
+        data isn't modified.  Both transports advertise that a binary response is accepted.
+        """
+        if 'dynamo_data' in data:
+            data = data | {'dynamo_data': encode_dynamo_data(data['dynamo_data'])}
+        accept = f'{BINARY_CONTENT_TYPE}, {JSON_CONTENT_TYPE}'
+        uncompressed_data = pickle.dumps(data)
+        if binary_codecs is not None:
+            codec, compressed_data = self.compression_policy.compress(
+                payload_type,
+                binary_codecs,
+                uncompressed_data,
+                on_event_loop)
+            headers = {'Content-Type': BINARY_CONTENT_TYPE, 'Accept': accept}
+            if codec.content_encoding is not None:
+                headers['Content-Encoding'] = codec.content_encoding
+            return {'data': compressed_data, 'headers': headers}
+        _codec, compressed_data = self.compression_policy.compress(
+            payload_type,
+            JSON_CODECS,
+            uncompressed_data,
+            on_event_loop)
+        return {
+            'json': base64.b64encode(compressed_data).decode('utf-8'),
+            'headers': {'Accept': accept}}
+
+    def decode_response(self, content_type, body: bytes):
+        """Decode the body of a response of either transport.
+
+        aiohttp has already undone the Content-Encoding of binary responses.
+        """
+        if content_type == BINARY_CONTENT_TYPE:
+            return pickle.loads(body)
+        return self.json_deserialise(json.loads(body))
+
+    async def run_codec(self, name, size, threshold, func, *args):
+        """Run an encode/decode step, in the executor if size is at least threshold.
+
+        Small payloads aren't worth the thread hop.  The time taken is added to self.codec_seconds
+        so the event loop time saved by the executor shows in the debug logs.
+        """
+        def timed():
+            start = time.perf_counter()
+            result = func(*args)
+            return result, time.perf_counter() - start
+
+        if size >= threshold:
+            where = 'executor'
+            result, seconds = await asyncio.get_running_loop().run_in_executor(None, timed)
+        else:
+            where = 'event loop'
+            result, seconds = timed()
+        self.codec_seconds[where] += seconds
+        LOGGER.debug(f'{name} (size {size}) took {seconds*1000:.1f} ms in the {where}, '
+                     f'{self.codec_seconds["executor"]:.2f} s of event loop time saved so far')
+        return result
+
+    async def encode_request(self, data, payload_type):
+        """Body and headers of a request using the negotiated transport.
+
+        Payloads with at least const.EXECUTOR_ENCODE_MIN_READINGS history readings are encoded in
+        the executor.
+        """
+        histories = data.get('dynamo_data', {}).get('histories', {})
+        readings = sum(len(frame) for frame in histories.values())
+        return await self.run_codec(
+            'encode',
+            readings,
+            const.EXECUTOR_ENCODE_MIN_READINGS,
+            self.request_arguments,
+            data,
+            binary_codecs(self._rejected_encodings) if self._binary_transport else None,
+            payload_type,
+            readings < const.EXECUTOR_ENCODE_MIN_READINGS)
+
+    async def response_payload(self, response: TransportResponse):
+        """Decode the response of either transport.
+
+        A binary response switches the following requests to the binary transport.  Responses of
+        at least const.EXECUTOR_DECODE_MIN_BYTES are decoded in the executor.
+        """
+        if response.content_type == BINARY_CONTENT_TYPE and self._binary_transport is False:
+            LOGGER.debug('Backend supports the binary transport, switching to it')
+            self._binary_transport = True
+        return await self.run_codec(
+            'decode',
+            len(response.body),
+            const.EXECUTOR_DECODE_MIN_BYTES,
+            self.decode_response,
+            response.content_type,
+            response.body)
+
     async def _api_wrapper(
         self,
         method: str,
         url: str,
         data: dict,
+        payload_type: str = 'default',
+    ):
+        """Call the Lambda function, retrying the failures that may be temporary.
+
+        payload_type (e.g. 'upload_history') selects the compression statistics used for data and
+        the retry policy (const.RETRY_POLICIES).  Timeouts, connection errors and 429/5xx responses
+        (other than 502, which the lambda returns for payloads it can't handle) are retried with
+        exponential backoff and jitter, within the policy's max_total seconds.  Calls are refused
+        with OptisparkApiClientCircuitOpenError while self.circuit_breaker is open.
+        """
+        policy = self.retry_policies.get(payload_type, self.default_retry_policy)
+        deadline = time.monotonic() + policy.max_total
+        attempt = 1
+        while True:
+            if not self.circuit_breaker.allow_request():
+                raise OptisparkApiClientCircuitOpenError(
+                    f'Backend failing, not calling it for another '
+                    f'{self.circuit_breaker.retry_after():.0f} s')
+            generation = self.circuit_breaker.generation
+            timeout = min(const.LAMBDA_REQUEST_TIMEOUT, deadline - time.monotonic())
+            try:
+                result = await self._api_request(method, url, data, payload_type, timeout)
+            except (OptisparkApiClientTimeoutError, OptisparkApiClientCommunicationError) as exception:
+                self.circuit_breaker.record_failure(generation)
+                delay = policy.delay(attempt, self.random)
+                if (attempt >= policy.attempts
+                        or self.circuit_breaker.state != CircuitBreaker.CLOSED
+                        or time.monotonic() + delay >= deadline):
+                    LOGGER.error(f'{type(exception).__name__}:\n  {exception} ({payload_type}, '
+                                 f'attempt {attempt}/{policy.attempts})')
+                    raise
+                LOGGER.debug(f'{payload_type} failed ({exception}), attempt {attempt}/{policy.attempts}, '
+                             f'retrying in {delay:.1f} s')
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except (OptisparkApiClientAuthenticationError, OptisparkApiClientRequestError):
+                # The backend answered, it just didn't like the request
+                self.circuit_breaker.record_success()
+                raise
+            except BaseException:
+                self.circuit_breaker.release()
+                raise
+            self.circuit_breaker.record_success()
+            return result
+
+    async def _api_request(
+        self,
+        method: str,
+        url: str,
+        data: dict,
+        payload_type: str,
+        timeout: float = const.LAMBDA_REQUEST_TIMEOUT,
     ):
-        """Call the Lambda function."""
+        """Make a single call to the Lambda function, giving up after timeout seconds."""
         try:
-            if 'dynamo_data' in data:
-                data['dynamo_data'] = floats_to_decimal(data['dynamo_data'])
-            data_serialised = self.json_serialisable(data)
+            request_arguments = await self.encode_request(data, payload_type)
 
-            async with async_timeout.timeout(120):
-                response = await self._session.request(
+            async with async_timeout.timeout(timeout):
+                response = await self._transport.request(
                     method=method,
                     url=url,
-                    json=data_serialised,
+                    **request_arguments,
                 )
+                while response.status == 415 and self._binary_transport:
+                    encoding = request_arguments['headers'].get('Content-Encoding')
+                    if encoding != 'gzip':
+                        # Fall back to the other codecs, down to gzip
+                        LOGGER.debug(f'Content-Encoding ({encoding or "identity"}) rejected, not using it again')
+                        self._rejected_encodings.add(encoding)
+                    else:
+                        # The backend no longer accepts binary requests, fall back to json
+                        LOGGER.debug('Binary transport rejected, falling back to json')
+                        self._binary_transport = False
+                    request_arguments = await self.encode_request(data, payload_type)
+                    response = await self._transport.request(
+                        method=method,
+                        url=url,
+                        **request_arguments,
+                    )
                 if response.status in (401, 403):
                     raise OptisparkApiClientAuthenticationError(
                         "Invalid credentials",
                     )
                 if response.status == 502:
+                    # The lambda failed on the payload, sending it again won't help.
                     # HomeAssistant will not print errors if there was never a successful update
-                    LOGGER.debug('OptisparkApiClientCommunicationError:\n  502 Bad Gateway - check payload')
-                    raise OptisparkApiClientCommunicationError(
+                    LOGGER.debug('OptisparkApiClientRequestError:\n  502 Bad Gateway - check payload')
+                    raise OptisparkApiClientRequestError(
                         '502 Bad Gateway - check payload')
-                response.raise_for_status()
-                payload = await response.json()
-                return self.json_deserialise(payload)
-
+                if response.status == 429 or response.status >= 500:
+                    raise OptisparkApiClientCommunicationError(
+                        f'{response.status} error fetching information')
+                if response.status >= 400:
+                    raise OptisparkApiClientRequestError(
+                        f'{response.status} error, request rejected')
+                return await self.response_payload(response)
+
+        except OptisparkApiClientError:
+            raise
         except asyncio.TimeoutError as exception:
-            LOGGER.error(traceback.format_exc())
-            LOGGER.error('OptisparkApiClientTimeoutError:\n  Timeout error fetching information')
             raise OptisparkApiClientTimeoutError(
                 "Timeout error fetching information",
             ) from exception
-        except (aiohttp.ClientError, socket.gaierror) as exception:
-            LOGGER.error(traceback.format_exc())
-            LOGGER.error('OptisparkApiClientCommunicationError:\n  Error fetching information')
+        except (aiohttp.ClientError, OSError) as exception:
             raise OptisparkApiClientCommunicationError(
-                "Error fetching information",
+                f"Error fetching information: {exception!r}",
             ) from exception
         except Exception as exception:  # pylint: disable=broad-except
             LOGGER.error(traceback.format_exc())
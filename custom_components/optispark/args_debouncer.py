@@ -0,0 +1,74 @@
+"""Debouncing of the lambda_args changes made from the UI."""
+from __future__ import annotations
+
+import time
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.event import async_call_later
+
+from .const import LOGGER
+from . import const
+
+
+class LambdaArgsDebouncer:
+    """Merge a burst of lambda_args changes into a single recalculation of the heating profile.
+
+    Dragging a slider changes lambda_args at every step, but only the final value needs a new
+    heating profile.  apply(lambda_args) is called with the latest lambda_args once there have
+    been no changes for quiet_period seconds, or max_wait seconds after the first change of the
+    burst if the changes keep coming.
+    """
+
+    def __init__(self, hass: HomeAssistant, apply, quiet_period=const.LAMBDA_ARGS_QUIET_PERIOD,
+                 max_wait=const.LAMBDA_ARGS_MAX_WAIT):
+        """Init."""
+        self.hass = hass
+        self.apply = apply
+        self.quiet_period = quiet_period
+        self.max_wait = max_wait
+        self.lambda_args = None
+        self.pending_changes = 0
+        self.first_change = None
+        self.changes = 0
+        self.recalculations = 0
+        self._unsub_timer = None
+
+    @property
+    def calls_saved(self):
+        """Recalculations avoided by merging changes."""
+        return self.changes - self.pending_changes - self.recalculations
+
+    @callback
+    def update(self, lambda_args):
+        """Record a change of lambda_args and (re)start the quiet period."""
+        now = time.monotonic()
+        if self.pending_changes == 0:
+            self.first_change = now
+        self.lambda_args = lambda_args
+        self.pending_changes += 1
+        self.changes += 1
+        self._cancel_timer()
+        delay = min(self.quiet_period, self.first_change + self.max_wait - now)
+        self._unsub_timer = async_call_later(self.hass, max(delay, 0), self._fire)
+
+    @callback
+    def _fire(self, _now):
+        self._unsub_timer = None
+        merged = self.pending_changes
+        self.pending_changes = 0
+        self.recalculations += 1
+        LOGGER.debug(f'({merged}) lambda_args changes merged into one recalculation, '
+                     f'({self.calls_saved}) lambda calls saved so far')
+        self.apply(self.lambda_args)
+
+    @callback
+    def _cancel_timer(self):
+        if self._unsub_timer is not None:
+            self._unsub_timer()
+            self._unsub_timer = None
+
+    @callback
+    def async_cancel(self):
+        """Drop the pending changes."""
+        self._cancel_timer()
+        self.pending_changes = 0
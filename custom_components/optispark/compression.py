@@ -0,0 +1,140 @@
+"""Compression of the payloads sent to the Lambda.
+
+Picks the codec for each payload type (history upload, date probe, profile request) from rolling
+measurements of how well, and how fast, each codec compresses that type of payload.
+"""
+
+import gzip
+import lzma
+import threading
+import time
+from functools import partial
+
+from .const import LOGGER
+from . import const
+
+
+class Codec:
+    """A compression codec and the Content-Encoding that declares it (None for no compression)."""
+
+    def __init__(self, name, content_encoding, compress):
+        """Init."""
+        self.name = name
+        self.content_encoding = content_encoding
+        self.compress = compress
+
+
+CODECS = {codec.name: codec for codec in [
+    Codec('identity', None, lambda data: data),
+    Codec('gzip-1', 'gzip', partial(gzip.compress, compresslevel=1)),
+    Codec('gzip-6', 'gzip', partial(gzip.compress, compresslevel=6)),
+    Codec('gzip-9', 'gzip', partial(gzip.compress, compresslevel=9)),
+    Codec('xz', 'xz', lzma.compress)]}
+# The json scheme is always gunzipped by the backend, only the level can change
+JSON_CODECS = ['gzip-1', 'gzip-6', 'gzip-9']
+BINARY_CODECS = ['identity', 'gzip-1', 'gzip-6', 'gzip-9', 'xz']
+# Measuring these on a sample takes long enough to be noticed, they are only measured off the
+# event loop
+SLOW_CODECS = {'xz'}
+
+
+def binary_codecs(rejected_encodings):
+    """Names of the binary transport codecs whose Content-Encoding hasn't been rejected."""
+    return [name for name in BINARY_CODECS if CODECS[name].content_encoding not in rejected_encodings]
+
+
+class CodecStats:
+    """Exponentially weighted averages of a codec's compression ratio and time per byte."""
+
+    def __init__(self):
+        """Init."""
+        self.ratio = None
+        self.seconds_per_byte = None
+
+    def record(self, size, compressed_size, seconds, weight=const.COMPRESSION_EWMA_WEIGHT):
+        """Add a measurement."""
+        ratio = compressed_size / size
+        seconds_per_byte = seconds / size
+        if self.ratio is None:
+            self.ratio, self.seconds_per_byte = ratio, seconds_per_byte
+        else:
+            self.ratio += weight * (ratio - self.ratio)
+            self.seconds_per_byte += weight * (seconds_per_byte - self.seconds_per_byte)
+
+    def cost(self, size, bytes_per_second):
+        """Estimated seconds to compress and send size bytes."""
+        return size * (self.seconds_per_byte + self.ratio / bytes_per_second)
+
+
+class CompressionPolicy:
+    """Choose and apply the codec of each payload.
+
+    Payloads smaller than const.COMPRESSION_MIN_BYTES use the first (cheapest) candidate, no
+    compression when the backend accepts it.  Larger
+    payloads use the codec with the lowest estimated compress + send time for their payload type,
+    so small requests stay cheap and big backfills get the best ratio the uplink makes worth it.
+    The decision is cached per payload type and re-evaluated every
+    const.COMPRESSION_REEVALUATE_EVERY payloads by compressing a sample of the payload with every
+    candidate.  Thread safe, payloads may be compressed in the executor.
+    """
+
+    def __init__(self, bytes_per_second=const.COMPRESSION_UPLINK_BYTES_PER_SECOND):
+        """Init."""
+        self.bytes_per_second = bytes_per_second
+        self.stats = {}  # (payload_type, codec name) -> CodecStats
+        self.decisions = {}  # (payload_type, candidates) -> [codec name, payloads left]
+        self._lock = threading.Lock()
+
+    def record(self, payload_type, codec_name, size, compressed_size, seconds):
+        """Add a measurement of codec_name compressing a payload_type payload."""
+        with self._lock:
+            stats = self.stats.setdefault((payload_type, codec_name), CodecStats())
+            stats.record(size, compressed_size, seconds)
+
+    def timed_compress(self, payload_type, codec_name, data):
+        """Compress data with codec_name and record how it did."""
+        start = time.perf_counter()
+        compressed = CODECS[codec_name].compress(data)
+        self.record(payload_type, codec_name, len(data), len(compressed), time.perf_counter() - start)
+        return compressed
+
+    def evaluate(self, payload_type, candidates, data):
+        """Measure every candidate on a sample of data and return the cheapest for its size."""
+        sample = data[:const.COMPRESSION_SAMPLE_BYTES]
+        for codec_name in candidates:
+            self.timed_compress(payload_type, codec_name, sample)
+        with self._lock:
+            costs = {
+                codec_name: self.stats[(payload_type, codec_name)].cost(len(data), self.bytes_per_second)
+                for codec_name in candidates}
+        best = min(costs, key=costs.get)
+        LOGGER.debug(f'Compression of {payload_type} payloads: {best} '
+                     f'(estimated seconds { {name: round(cost, 3) for name, cost in costs.items()} })')
+        return best
+
+    def choose(self, payload_type, candidates, data):
+        """Name of the codec to compress data with."""
+        if len(data) < const.COMPRESSION_MIN_BYTES:
+            return candidates[0]
+        key = (payload_type, tuple(candidates))
+        with self._lock:
+            decision = self.decisions.get(key)
+            if decision is not None and decision[1] > 0:
+                decision[1] -= 1
+                return decision[0]
+        codec_name = self.evaluate(payload_type, candidates, data)
+        with self._lock:
+            self.decisions[key] = [codec_name, const.COMPRESSION_REEVALUATE_EVERY - 1]
+        return codec_name
+
+    def compress(self, payload_type, candidates, data: bytes, on_event_loop=False):
+        """Compress data with the chosen codec.  Returns the Codec used and the compressed bytes.
+
+        SLOW_CODECS aren't candidates on_event_loop, they would have to be measured there.
+        """
+        if on_event_loop:
+            candidates = [codec_name for codec_name in candidates if codec_name not in SLOW_CODECS]
+        codec_name = self.choose(payload_type, candidates, data)
+        compressed = self.timed_compress(payload_type, codec_name, data)
+        LOGGER.debug(f'{payload_type}: {len(data)} bytes compressed to {len(compressed)} with {codec_name}')
+        return CODECS[codec_name], compressed
@@ -1,4 +1,5 @@
 """Constants for Optispark."""
+from datetime import timedelta
 from logging import Logger, getLogger
 
 LOGGER: Logger = getLogger(__package__)
@@ -7,6 +8,7 @@ NAME = "Optispark"
 DOMAIN = "optispark"
 VERSION = "0.2.6"
 ATTRIBUTION = "Data provided by http://jsonplaceholder.typicode.com/"
+LAMBDA_URL = 'https://lhyj2mknjfmatuwzkxn4uuczrq0fbsbd.lambda-url.eu-west-2.on.aws/'
 
 LAMBDA_TEMP_CONTROLS = 'temp_controls'
 LAMBDA_PRICE = 'electricity_price'
@@ -17,6 +19,16 @@ LAMBDA_BASE_COST = 'base_cost'
 LAMBDA_OPTIMISED_COST = 'optimised_cost'
 LAMBDA_PROJECTED_PERCENT_SAVINGS = 'projected_percent_savings'
 LAMBDA_HOME_ASSISTANT_VERSION = 'home_assistant_version'
+# Heating profile values with one element per LAMBDA_TIMESTAMP, and those with a single value
+LAMBDA_TIME_BASED_KEYS = [
+    LAMBDA_BASE_DEMAND,
+    LAMBDA_PRICE,
+    LAMBDA_TEMP_CONTROLS,
+    LAMBDA_OPTIMISED_DEMAND]
+LAMBDA_NON_TIME_BASED_KEYS = [
+    LAMBDA_BASE_COST,
+    LAMBDA_OPTIMISED_COST,
+    LAMBDA_PROJECTED_PERCENT_SAVINGS]
 # Lambda parameters
 LAMBDA_SET_POINT = 'temp_set_point'
 LAMBDA_TEMP_RANGE = 'temp_range'
@@ -25,10 +37,52 @@ LAMBDA_USER_HASH = 'user_hash'
 LAMBDA_INITIAL_INTERNAL_TEMP = 'initial_internal_temp'
 LAMBDA_OUTSIDE_RANGE = 'outside_range'
 LAMBDA_HEAT_PUMP_MODE_RAW = 'heat_pump_mode_raw'
+# The parameters set by the user.  Profile requests that only differ in the others (read from the
+# heat pump at the time of the request) are coalesced
+LAMBDA_PROFILE_REQUEST_KEY_ARGS = [
+    LAMBDA_SET_POINT,
+    LAMBDA_TEMP_RANGE,
+    LAMBDA_POSTCODE,
+    LAMBDA_USER_HASH,
+    LAMBDA_HEAT_PUMP_MODE_RAW]
 
+# The coordinator updates when its input entities change and when the heating profile moves on to
+# its next slot.  The interval is only a fallback
+UPDATE_FALLBACK_INTERVAL = timedelta(minutes=15)
+UPDATE_RETRY_INTERVAL = timedelta(minutes=1)  # A failed lambda call is retried after this
+# Changes of lambda_args from the UI are merged until there have been none for the quiet period,
+# or for at most the max wait after the first change (seconds)
+LAMBDA_ARGS_QUIET_PERIOD = 2
+LAMBDA_ARGS_MAX_WAIT = 10
 HISTORY_DAYS = 28  # the number of days initially required by our algorithm
 DYNAMO_HISTORY_DAYS = 365*2
 MAX_UPLOAD_HISTORY_READINGS = 5000
+MAX_CONCURRENT_UPLOADS = 4
+BACKFILL_ROUND_PAYLOADS = 16  # The backfill releases the upload lock after this many payloads
+HISTORY_CACHE_SEGMENT_READINGS = 50000  # Contiguous cached pages are merged up to this size
+HISTORY_CACHE_MAX_READINGS = 1_000_000  # per column, about 24 MB on disk
+UPLOAD_JOURNAL_SAVE_DELAY = 5  # seconds
+UPLOAD_JOURNAL_RECONCILE_HOURS = 24
+# Payloads at least this big are encoded/decoded in the executor instead of the event loop
+EXECUTOR_ENCODE_MIN_READINGS = 500
+EXECUTOR_DECODE_MIN_BYTES = 64 * 1024
+# Compression policy of the payloads sent to the lambda (see compression.py)
+COMPRESSION_MIN_BYTES = 1024  # Smaller payloads aren't worth compressing
+COMPRESSION_SAMPLE_BYTES = 64 * 1024
+COMPRESSION_REEVALUATE_EVERY = 20  # payloads
+COMPRESSION_EWMA_WEIGHT = 0.2
+COMPRESSION_UPLINK_BYTES_PER_SECOND = 500_000
+# Retries of the calls to the lambda (see resilience.py)
+# payload_type: (attempts, base delay, max delay, max total) - in seconds
+# max total bounds how long a call, e.g. an upload holding the upload lock, keeps retrying
+RETRY_POLICIES = {
+    'upload_history': (4, 5, 60, 300),
+    'get_data_dates': (3, 2, 30, 150),
+    'get_profile': (3, 2, 30, 150)}
+RETRY_POLICY_DEFAULT = (2, 2, 30, 150)
+LAMBDA_REQUEST_TIMEOUT = 120  # seconds, the lambda can take a while to start up
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5  # consecutive failed calls
+CIRCUIT_BREAKER_RESET_TIMEOUT = 60  # seconds
 DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER = 'heat_pump_power'
 DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE = 'external_temperature'
 DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY = 'climate_entity'
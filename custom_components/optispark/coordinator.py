@@ -1,11 +1,14 @@
 """DataUpdateCoordinator for optispark."""
 from __future__ import annotations
 
+import asyncio
+import math
 from datetime import timedelta, datetime, timezone
 import traceback
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import Event, HomeAssistant, callback
 import homeassistant.const
+from homeassistant.helpers.event import async_track_point_in_utc_time, async_track_state_change_event
 from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
     UpdateFailed,
@@ -16,16 +19,25 @@ from homeassistant.exceptions import ConfigEntryAuthFailed
 from .api import (
     OptisparkApiClient,
     OptisparkApiClientAuthenticationError,
+    OptisparkApiClientCommunicationError,
     OptisparkApiClientError,
+    OptisparkApiClientLambdaError,
+    OptisparkApiClientTimeoutError,
 )
 from . import const
 from . import get_entity
 from . import history
+from .args_debouncer import LambdaArgsDebouncer
+from .history_cache import HistoryCache
+from .snapshot import InputSnapshot, take_snapshot
+from .profile_frame import ProfileFrame
+from .profile_store import ProfileStore
+from .upload_journal import UploadJournal
+from .upload_scheduler import UploadScheduler
 from .const import LOGGER
 from homeassistant.helpers.entity_registry import EntityRegistry, RegistryEntry
 from homeassistant.helpers import entity_registry
 from homeassistant.helpers import template
-import numpy as np
 
 
 class OptisparkSetTemperatureError(Exception):
@@ -39,6 +51,7 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
         self,
         hass: HomeAssistant,
         client: OptisparkApiClient,
+        entry_id: str,
         climate_entity_id: str,
         heat_pump_power_entity_id: str,
         external_temp_entity_id: str,
@@ -52,7 +65,7 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
             hass=hass,
             logger=const.LOGGER,
             name=const.DOMAIN,
-            update_interval=timedelta(seconds=10),
+            update_interval=const.UPDATE_FALLBACK_INTERVAL,
         )
         self._postcode = postcode if postcode is not None else 'AB11 6LU'
         self._tariff = tariff
@@ -62,6 +75,7 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
         self._heat_pump_power_entity_id = heat_pump_power_entity_id
         self._external_temp_entity_id = external_temp_entity_id
         self._switch_enabled = False  # The switch will set this at startup
+        self._snapshot: InputSnapshot | None = None
         self._available = False
         self._lambda_args = {
             const.LAMBDA_SET_POINT: 20.0,
@@ -76,42 +90,24 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
         self._lambda_update_handler = LambdaUpdateHandler(
             hass=self.hass,
             client=self.client,
+            entry_id=entry_id,
             climate_entity_id=self._climate_entity_id,
             heat_pump_power_entity_id=self._heat_pump_power_entity_id,
             external_temp_entity_id=self._external_temp_entity_id,
             user_hash=self._user_hash,
             postcode=self._postcode,
             tariff=self._tariff)
-
-    def convert_sensor_from_farenheit(self, entity, temp):
-        """Ensure that the sensor returns values in Celcius.
-
-        Only works with sensor entities
-        If the sensor uses Farenheit then we'll need to convert Farenheit to Celcius
-        """
-        sensor_unit = entity.native_unit_of_measurement
-        if sensor_unit == homeassistant.const.TEMP_CELSIUS:
-            return temp
-        elif sensor_unit == homeassistant.const.TEMP_FAHRENHEIT:
-            # Convert temperature from Celcius to Farenheit
-            return (temp-32) * 5/9
-        else:
-            raise ValueError(f'Heat pump uses unkown units ({sensor_unit})')
-
-    def convert_climate_from_farenheit(self, entity, temp):
-        """Ensure that the heat pump returns values in Celcius.
-
-        Only works with climate entity
-        If the heat_pump uses Farenheit then we'll need to convert Farenheit to Celcius
-        """
-        heat_pump_unit = entity.temperature_unit
-        if heat_pump_unit == homeassistant.const.TEMP_CELSIUS:
-            return temp
-        elif heat_pump_unit == homeassistant.const.TEMP_FAHRENHEIT:
-            # Convert temperature from Celcius to Farenheit
-            return (temp-32) * 5/9
-        else:
-            raise ValueError(f'Heat pump uses unkown units ({heat_pump_unit})')
+        self._lambda_update_handler.on_update_needed = self.async_schedule_update
+        # Updates are driven by the input entities changing and by wakeups when the profile moves
+        # on, the update_interval is only a fallback
+        self._unsub_state_changes = async_track_state_change_event(
+            hass,
+            [entity_id for entity_id in (climate_entity_id, heat_pump_power_entity_id, external_temp_entity_id)
+             if entity_id is not None],
+            self._async_input_changed)
+        self._unsub_wakeup = None
+        self._shutting_down = False
+        self._lambda_args_debouncer = LambdaArgsDebouncer(hass, self._apply_lambda_args)
 
     def convert_climate_from_celcius(self, entity, temp):
         """Ensure that the heat pump is given a temperature in the correct units.
@@ -131,13 +127,13 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
     async def update_heat_pump_temperature(self, data):
         """Set the temperature of the heat pump using the value from lambda."""
         temp: float = data[const.LAMBDA_TEMP_CONTROLS]
-        climate_entity = get_entity(self.hass, self._climate_entity_id)
-
         try:
-            if self.heat_pump_target_temperature == temp:
+            target_temperature = self.heat_pump_target_temperature
+            if target_temperature is not None and math.isclose(target_temperature, temp, abs_tol=0.01):
                 return
+            climate_entity = get_entity(self.hass, self._climate_entity_id)
             LOGGER.debug('Change in target temperature!')
-            supports_target_temperature_range = climate_entity.supported_features & ClimateEntityFeature.TARGET_TEMPERATURE_RANGE == ClimateEntityFeature.TARGET_TEMPERATURE_RANGE
+            supports_target_temperature_range = self.snapshot.supported_features & ClimateEntityFeature.TARGET_TEMPERATURE_RANGE == ClimateEntityFeature.TARGET_TEMPERATURE_RANGE
             if supports_target_temperature_range:
                 await climate_entity.async_set_temperature(
                     target_temp_low=self.convert_climate_from_celcius(climate_entity, temp),
@@ -184,47 +180,81 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
         """Enable/Disable all entities other than the switch."""
         entities = self.get_optispark_entities(include_switch=False)
         self.enable_disable_entities(entities, enable)
+        if enable and self._switch_enabled is False:
+            # Updates are event driven, nothing else would fetch the data at startup
+            self.async_schedule_update()
         self._switch_enabled = enable
         if enable is False:
             # The coordinator is available once data is fetched
             self._available = False
         #self.always_update = enable
 
+    async def async_shutdown(self) -> None:
+        """Cancel any scheduled call and the background upload of old history.
+
+        Safe to call more than once, HA calls it when it stops as well as when the entry is unloaded.
+        """
+        self._shutting_down = True
+        await super().async_shutdown()
+        if self._unsub_state_changes is not None:
+            self._unsub_state_changes()
+            self._unsub_state_changes = None
+        self._cancel_wakeup()
+        self._lambda_args_debouncer.async_cancel()
+        await self._lambda_update_handler.async_cancel_backfill()
+
     async def async_set_lambda_args(self, lambda_args):
         """Update the lambda arguments.
 
-        To be called from entities.
+        To be called from entities, with a modified copy of requested_lambda_args.  The lambda
+        arguments only change, and the new heating profile is only requested, once the changes have
+        settled, see LambdaArgsDebouncer.
         """
+        self._lambda_args_debouncer.update(lambda_args)
+
+    @callback
+    def _apply_lambda_args(self, lambda_args):
+        """Recalculate the heating profile with the settled lambda_args."""
         self._lambda_args = lambda_args
         self._lambda_update_handler.manual_update = True
-        await self.async_request_update()
+        self.async_schedule_update()
 
     @property
     def postcode(self):
         """Postcode."""
         return self._postcode
 
+    @property
+    def snapshot(self) -> InputSnapshot:
+        """Inputs of the current tick, see refresh_snapshot."""
+        if self._snapshot is None:
+            self.refresh_snapshot()
+        return self._snapshot
+
+    def refresh_snapshot(self):
+        """Read the inputs from the state machine, once per tick and whenever an input changes.
+
+        Every reader of the inputs in between (sensors, climate entity, lambda_args) sees the same
+        values, converted to °C and kW once.
+        """
+        self._snapshot = take_snapshot(
+            self.hass,
+            self._climate_entity_id,
+            self._heat_pump_power_entity_id,
+            self._external_temp_entity_id)
+
     @property
     def heat_pump_target_temperature(self):
-        """The current target temperature that the heat pump is set to.
+        """The current target temperature that the heat pump is set to, in °C.
 
         Assumes that the heat pump is being used for heating.
         """
-        climate_entity = get_entity(self.hass, self._climate_entity_id)
-        supports_target_temperature_range = climate_entity.supported_features & ClimateEntityFeature.TARGET_TEMPERATURE_RANGE == ClimateEntityFeature.TARGET_TEMPERATURE_RANGE
-        if supports_target_temperature_range:
-            temperature = climate_entity.target_temperature_low
-        else:
-            temperature = climate_entity.target_temperature
-
-        return temperature
+        return self.snapshot.target_temp
 
     @property
     def internal_temp(self):
         """Internal temperature of the heat pump."""
-        entity = get_entity(self.hass, self._climate_entity_id)
-        out = self.convert_climate_from_farenheit(entity, entity.current_temperature)
-        return out
+        return self.snapshot.internal_temp
 
     @property
     def heat_pump_power_usage(self):
@@ -232,44 +262,86 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
 
         Return value in kW
         """
-        entity = get_entity(self.hass, self._heat_pump_power_entity_id)
-        native_value = entity.native_value
-        match entity.unit_of_measurement:
-            case 'W':
-                return native_value/1000
-            case 'kW':
-                return native_value
-            case _:
-                LOGGER.error(f'Heat pump does not use supported unit({entity.unit_of_measurement})')
-                raise TypeError(f'Heat pump does not use supported unit({entity.unit_of_measurement})')
+        return self.snapshot.heat_pump_power_usage
 
     @property
     def external_temp(self):
         """External house temperature."""
-        if self._external_temp_entity_id is None:
-            return None
-        else:
-            entity = get_entity(self.hass, self._external_temp_entity_id)
-            return self.convert_sensor_from_farenheit(entity, entity.native_value)
+        return self.snapshot.external_temp
 
     @property
     def lambda_args(self):
-        """Returns the lambda arguments.
+        """Returns a copy of the lambda arguments.
 
         Updates the initial_internal_temp and checks outside_range.
         """
-        self._lambda_args[const.LAMBDA_INITIAL_INTERNAL_TEMP] = self.internal_temp
-        if abs(self.internal_temp - self._lambda_args[const.LAMBDA_SET_POINT]) > self._lambda_args[const.LAMBDA_TEMP_RANGE]:
-            self._lambda_args[const.LAMBDA_OUTSIDE_RANGE] = True
+        lambda_args = dict(self._lambda_args)
+        internal_temp = self.internal_temp
+        lambda_args[const.LAMBDA_INITIAL_INTERNAL_TEMP] = internal_temp
+        if internal_temp is not None and abs(internal_temp - lambda_args[const.LAMBDA_SET_POINT]) > lambda_args[const.LAMBDA_TEMP_RANGE]:
+            lambda_args[const.LAMBDA_OUTSIDE_RANGE] = True
         else:
-            self._lambda_args[const.LAMBDA_OUTSIDE_RANGE] = False
-        return self._lambda_args
+            lambda_args[const.LAMBDA_OUTSIDE_RANGE] = False
+        return lambda_args
+
+    @property
+    def requested_lambda_args(self):
+        """Copy of the lambda arguments including the changes that haven't settled yet.
+
+        Entities modify this copy, so that a change made while another one is still waiting in
+        the debouncer doesn't undo it.
+        """
+        if self._lambda_args_debouncer.pending_changes:
+            return dict(self._lambda_args_debouncer.lambda_args)
+        return dict(self._lambda_args)
 
     @property
     def available(self):
         """Is there data available for the entities."""
         return self._available
 
+    @callback
+    def async_schedule_update(self, *_args):
+        """Request an update from a callback, e.g. an event listener."""
+        self.hass.async_create_task(self.async_request_refresh())
+
+    @callback
+    def _async_input_changed(self, event: Event):
+        """Update when an input that the update reads changes.
+
+        The entities that show the inputs are refreshed straight away, they don't wait for the
+        update.  Changes that the update doesn't read (the sensors, climate attributes other than
+        the temperatures and features) don't cause one, and nothing happens while the integration
+        is disabled.
+        """
+        if self._switch_enabled is False or event.data.get('new_state') is None:
+            return
+        previous = self.snapshot
+        self.refresh_snapshot()
+        self.async_update_listeners()
+        if self._snapshot.update_inputs() != previous.update_inputs():
+            self.async_schedule_update()
+
+    @callback
+    def _cancel_wakeup(self):
+        if self._unsub_wakeup is not None:
+            self._unsub_wakeup()
+            self._unsub_wakeup = None
+
+    @callback
+    def _async_wakeup(self, _now):
+        self._unsub_wakeup = None
+        self.async_schedule_update()
+
+    @callback
+    def schedule_wakeup(self):
+        """Schedule an update for when the data changes without any input changing."""
+        self._cancel_wakeup()
+        if self._switch_enabled is False or self._shutting_down:
+            return
+        wakeup = self._lambda_update_handler.next_wakeup(datetime.now(tz=timezone.utc))
+        self._unsub_wakeup = async_track_point_in_utc_time(self.hass, self._async_wakeup, wakeup)
+
     async def async_request_update(self):
         """Request home assistant to update all its values.
 
@@ -285,10 +357,13 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
         Returns the current setting for the heat pump for the current moment.
         Entire days heat pump profile will be stored if it's out of date.
         """
+        self.refresh_snapshot()
         if self._switch_enabled is False:
             # Integration is disabled, don't call lambda
             return self.data
         try:
+            if self.internal_temp is None:
+                raise UpdateFailed(f'Heat pump ({self._climate_entity_id}) has no current temperature')
             data = await self._lambda_update_handler(self.lambda_args)
             await self.update_heat_pump_temperature(data)
             self._available = True
@@ -297,6 +372,8 @@ class OptisparkDataUpdateCoordinator(DataUpdateCoordinator):
             raise ConfigEntryAuthFailed(exception) from exception
         except OptisparkApiClientError as exception:
             raise UpdateFailed(exception) from exception
+        finally:
+            self.schedule_wakeup()
 
 
 class LambdaUpdateHandler:
@@ -305,8 +382,10 @@ class LambdaUpdateHandler:
     Gets the heating profile and ensure dynamo is up to date.
     """
 
-    def __init__(self, hass, client: OptisparkApiClient, climate_entity_id,
-                 heat_pump_power_entity_id, external_temp_entity_id, user_hash, postcode, tariff):
+    def __init__(self, hass, client: OptisparkApiClient, entry_id, climate_entity_id,
+                 heat_pump_power_entity_id, external_temp_entity_id, user_hash, postcode, tariff,
+                 page_size=const.MAX_UPLOAD_HISTORY_READINGS,
+                 max_concurrent_uploads=const.MAX_CONCURRENT_UPLOADS):
         """Init."""
         self.hass = hass
         self.client: OptisparkApiClient = client
@@ -320,6 +399,17 @@ class LambdaUpdateHandler:
         self.manual_update = False
         self.history_upload_complete = False
         self.outside_range_flag = False
+        self.newest_watermarks = {}
+        self.oldest_watermarks = {}
+        self.ha_oldest_dates = None  # Set by update_ha_dates
+        self.ha_newest_dates = None
+        self.page_size = page_size  # Max readings per entity read from the recorder and uploaded
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.backfill_task = None
+        self.refresh_task = None
+        self.on_update_needed = None  # Called when a background task needs an update to follow it
+        self.lambda_results = None
+        self.profile_frame: ProfileFrame | None = None
         self.id_to_column_name_lookup = {
             climate_entity_id: const.DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY,
             heat_pump_power_entity_id: const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER,
@@ -330,164 +420,424 @@ class LambdaUpdateHandler:
         for entity_id in [climate_entity_id, heat_pump_power_entity_id, external_temp_entity_id]:
             if entity_id is not None:
                 self.active_entity_ids.append(entity_id)
+        # Sensor histories only need the unit from their attributes
+        self.no_attributes_entity_ids = [heat_pump_power_entity_id, external_temp_entity_id]
+        self.history_cache = HistoryCache(
+            hass,
+            entry_id,
+            {self.id_to_column_name_lookup[entity_id]: entity_id for entity_id in self.active_entity_ids})
+        self.upload_journal = UploadJournal(hass, entry_id)
+        self.profile_store = ProfileStore(hass, entry_id)
+        # Held by call_lambda and by each round of the backfill, so the two pipelines never
+        # upload, commit or reset the watermarks at the same time
+        self.upload_lock = asyncio.Lock()
+
+    def update_watermarks(self, dynamo_oldest_dates, dynamo_newest_dates):
+        """Reset the upload watermarks from the dates in dynamo.
+
+        newest_watermarks: every reading up to and including this date has been uploaded
+        oldest_watermarks: every reading from this date onwards has been uploaded
+        """
+        for column in self.id_to_column_name_lookup.values():
+            newest_date = dynamo_newest_dates.get(column)
+            if newest_date is None:
+                # No data in dynamo - upload first x days
+                newest_date = datetime.now(tz=timezone.utc) - timedelta(days=const.HISTORY_DAYS)
+            self.newest_watermarks[column] = newest_date
+            self.oldest_watermarks[column] = dynamo_oldest_dates.get(column)
+
+    def new_history_windows(self):
+        """Recorder windows of the new history that is still missing from dynamo.
+
+        The windows end just after the newest reading in HA (rather than now) so that readings the
+        recorder hasn't committed yet aren't marked as uploaded or cached.
+        """
+        windows = {}
+        for active_entity_id in self.entities_with_data_missing_from_dynamo():
+            column = self.id_to_column_name_lookup[active_entity_id]
+            windows[active_entity_id] = (
+                self.newest_watermarks[column],
+                self.ha_newest_dates[column] + timedelta(microseconds=1))
+        return windows
+
+    def old_history_upload_complete(self, column, history_floor):
+        """Check if every reading of column in HA is already in dynamo."""
+        watermark = self.oldest_watermarks[column]
+        if watermark is None or watermark <= history_floor:
+            return True
+        ha_oldest_date = self.ha_oldest_dates.get(column)
+        return ha_oldest_date is None or watermark <= ha_oldest_date
+
+    def old_history_windows(self):
+        """Recorder windows of the old history that is still missing from dynamo."""
+        history_floor = datetime.now(tz=timezone.utc) - timedelta(days=const.DYNAMO_HISTORY_DAYS)
+        windows = {}
+        for active_entity_id in self.active_entity_ids:
+            column = self.id_to_column_name_lookup[active_entity_id]
+            if self.old_history_upload_complete(column, history_floor):
+                LOGGER.debug(f'  ({column}) - Upload complete')
+                continue
+            windows[active_entity_id] = (history_floor, self.oldest_watermarks[column])
+        return windows
 
-    def get_missing_histories_boundary(self, history_states, dynamo_date):
-        """Get index where history_state matches dynamo_date."""
-        for idx, datum in enumerate(history_states):
-            if datum.last_updated >= dynamo_date:
-                idx_bound = idx
-                return idx_bound
-        return idx_bound  # type: ignore
-
-    def get_missing_old_histories_states(self, history_states, column):
-        """Get states that are older than anything in dynamo."""
-        dynamo_date = self.dynamo_oldest_dates[column]
-        idx_bound = self.get_missing_histories_boundary(
-            history_states,
-            dynamo_date)
-        return history_states[:idx_bound]
-
-    def get_missing_new_histories_states(self, history_states, column):
-        """Get states that are newer than anything in dynamo."""
-        dynamo_date = self.dynamo_newest_dates[column]
-        if dynamo_date is None:
-            # No data in dynamo - upload first x days
-            dynamo_date = datetime.now(tz=timezone.utc) - timedelta(days=const.HISTORY_DAYS)
-        idx_bound = self.get_missing_histories_boundary(
-            history_states,
-            dynamo_date)
-        if idx_bound == len(history_states) - 1:
-            error = True
-        else:
-            error = False
-        return history_states[idx_bound+1:], error
+    def advance_watermarks(self, pages, descending):
+        """Move the watermarks past pages, to be called once pages are in dynamo.
 
+        The recorder pages exclude their start and end times.
+        """
+        for entity_id, page in pages.items():
+            column = self.id_to_column_name_lookup[entity_id]
+            if descending:
+                if page.exhausted:
+                    self.oldest_watermarks[column] = page.start_time
+                else:
+                    self.oldest_watermarks[column] = page.start_time + timedelta(microseconds=1)
+            else:
+                self.newest_watermarks[column] = page.end_time - timedelta(microseconds=1)
 
-    async def upload_new_history(self, missing_entities):
-        """Upload section of new history states that are newer than anything in dynamo.
+    def next_windows(self, windows, pages, descending):
+        """What is left of each window after its page, windows that have been exhausted are dropped.
 
-        self.dynamo_dates is updated so that if this function is called again a new section will be
-        uploaded.
-        const.MAX_UPLOAD_HISTORY_READINGS number of readings are uploaded to avoid long delay.
+        Matches advance_watermarks, so the read cursor and the watermarks agree once the pages are
+        committed.
         """
-        histories = {}
-        constant_attributes = {}
-        async def debug_check_history_length(days):
-            history_states = await history.get_state_changes(
-                self.hass,
-                active_entity_id,
-                days)
-            LOGGER.debug(f'---------- days: {days} ----------')
-            LOGGER.debug(f'  history_states[0]: {history_states[0].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
-            LOGGER.debug(f'  history_states[-1]: {history_states[-1].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
+        next_windows = {}
+        for entity_id, (start_time, end_time) in windows.items():
+            page = pages[entity_id]
+            if page.exhausted:
+                continue
+            if descending:
+                next_windows[entity_id] = (start_time, page.start_time + timedelta(microseconds=1))
+            else:
+                next_windows[entity_id] = (page.end_time - timedelta(microseconds=1), end_time)
+        return next_windows
 
-            history_states = await history.get_state_changes_period(
-                self.hass,
-                active_entity_id,
-                days)
-            LOGGER.debug(f'  history_states[0]: {history_states[0].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
-            LOGGER.debug(f'  history_states[-1]: {history_states[-1].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
+    async def history_pages(self, windows, descending):
+        """Pipeline stage: fetch the next page of every missing window.
 
-        for active_entity_id in missing_entities:
-            column = self.id_to_column_name_lookup[active_entity_id]
-            history_states = await history.get_state_changes(
+        Pages are read from the history cache where possible, the rest of each window (up to the
+        nearest cached segment) is read from the recorder.
+        Each round continues from the pages of the previous one rather than from the watermarks,
+        which only move once uploads are committed.  Stops once every window is exhausted.
+        """
+        while windows:
+            pages = {}
+            recorder_windows = {}
+            clipped = set()
+            for entity_id, (start_time, end_time) in windows.items():
+                column = self.id_to_column_name_lookup[entity_id]
+                if (acknowledged := self.upload_journal.find_acknowledged(
+                        column,
+                        start_time,
+                        end_time,
+                        descending)) is not None:
+                    # Already in dynamo, skip it with an empty page
+                    pages[entity_id] = history.HistoryPage(
+                        entity_id,
+                        *acknowledged,
+                        states=None,
+                        window_attributes=None,
+                        frame=history.HistoryFrame([], []))
+                    continue
+                page = await self.history_cache.async_read_page(
+                    entity_id,
+                    column,
+                    start_time,
+                    end_time,
+                    descending,
+                    self.page_size)
+                if page is not None:
+                    pages[entity_id] = page
+                    continue
+                start_time, end_time, is_clipped = self.history_cache.clip_window(
+                    column,
+                    start_time,
+                    end_time,
+                    descending)
+                recorder_windows[entity_id] = (start_time, end_time)
+                if is_clipped:
+                    clipped.add(entity_id)
+            if recorder_windows:
+                recorder_pages = await history.get_history_pages(
+                    self.hass,
+                    recorder_windows,
+                    descending,
+                    self.page_size,
+                    self.no_attributes_entity_ids)
+                for entity_id in clipped:
+                    # The rest of the window is cached, it hasn't been exhausted
+                    recorder_pages[entity_id].exhausted = False
+                pages |= recorder_pages
+            yield pages
+            windows = self.next_windows(windows, pages, descending)
+
+    async def normalise_page(self, column, page):
+        """Normalise the states of a recorder page into page.frame and add it to the cache."""
+        if len(page.states) == 0:
+            page.frame = history.HistoryFrame([], [])
+        else:
+            frame, page.constant_attributes = history.states_to_histories(
                 self.hass,
-                active_entity_id,
-                const.DYNAMO_HISTORY_DAYS)
-            missing_new_histories_states, error = self.get_missing_new_histories_states(history_states, column)
-            if error:
-                raise RuntimeError('No missing history data to upload, should not have gotten here')
-
-            LOGGER.debug(f'  column: {column}')
-            if len(missing_new_histories_states) == 0:
-                LOGGER.debug(f'    ({column}) - Upload complete')
-                continue
-            LOGGER.debug(f'    len(missing_new_histories_states): {len(missing_new_histories_states)}')
-            missing_new_histories_states = missing_new_histories_states[:const.MAX_UPLOAD_HISTORY_READINGS]
-            LOGGER.debug(f'    len(missing_new_histories_states): {len(missing_new_histories_states)}')
-            LOGGER.debug(f'      {missing_new_histories_states[0].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
-            LOGGER.debug(f'      {missing_new_histories_states[-1].last_updated.strftime("%Y-%m-%d %H:%M:%S")}')
+                column,
+                page.states,
+                page.window_attributes)
+            page.frame = frame.after(page.start_time).before(page.end_time)
+        page.states = None
+        await self.history_cache.async_append(column, page)
+
+    async def history_payloads(self, rounds, descending):
+        """Pipeline stage: normalise each round of pages and package it for upload.
 
-            histories[column], constant_attributes[column] = history.states_to_histories(
+        Yields (dynamo_data, pages).  dynamo_data is None for rounds without any valid readings,
+        they have nothing to upload but their watermarks still need committing.
+        """
+        async for pages in rounds:
+            histories = {}
+            constant_attributes = {}
+            for entity_id, page in pages.items():
+                column = self.id_to_column_name_lookup[entity_id]
+                if page.frame is None:
+                    await self.normalise_page(column, page)
+                LOGGER.debug(f'  column: {column}')
+                LOGGER.debug(f'    page: {page.start_time.strftime("%Y-%m-%d %H:%M:%S")} - {page.end_time.strftime("%Y-%m-%d %H:%M:%S")}')
+                LOGGER.debug(f'    len(page.frame): {len(page.frame)}')
+                if len(page.frame) == 0:
+                    continue
+                histories[column] = page.frame
+                constant_attributes[column] = page.constant_attributes
+            if histories == {}:
+                LOGGER.debug('    No readings in pages, moving on...')
+                yield None, pages
+                continue
+            dynamo_data = history.histories_to_dynamo_data(
                 self.hass,
-                column,
-                missing_new_histories_states)
-        if histories == {}:
-            raise RuntimeError('Should not have gotten here! No missing history data to upload')
-        dynamo_data = history.histories_to_dynamo_data(
-            self.hass,
-            histories,
-            constant_attributes,
-            self.user_hash,
-            self.climate_entity_id,
-            self.postcode,
-            self.tariff)
-        self.dynamo_oldest_dates, self.dynamo_newest_dates = await self.client.upload_history(dynamo_data)
+                histories,
+                constant_attributes,
+                self.user_hash,
+                self.climate_entity_id,
+                self.postcode,
+                self.tariff)
+            yield dynamo_data, pages
+
+    async def upload_payload(self, payload):
+        """Pipeline stage: upload a payload, returns dynamo's (oldest_dates, newest_dates).
+
+        Runs concurrently with other uploads, nothing is changed until the payload is committed.
+        """
+        dynamo_data, pages = payload
+        if dynamo_data is None:
+            return None
+        dynamo_dates = await self.client.upload_history(dynamo_data)
+        for entity_id, page in pages.items():
+            self.upload_journal.acknowledge(
+                self.id_to_column_name_lookup[entity_id],
+                page.start_time,
+                page.end_time)
+        return dynamo_dates
+
+    async def commit_payload(self, payload, dynamo_dates, descending):
+        """Pipeline stage: move the watermarks past an uploaded payload's pages.
+
+        Called in the order the payloads were produced.  dynamo_dates are only used by this
+        payload's pipeline, they aren't shared with the other one.
+        """
+        _dynamo_data, pages = payload
+        self.advance_watermarks(pages, descending)
+        dynamo_oldest_dates = dynamo_dates[0] if dynamo_dates is not None else {}
+        for column, oldest_date in dynamo_oldest_dates.items():
+            if self.oldest_watermarks.get(column) is None:
+                # First upload of this column, the old history starts where it begins
+                self.oldest_watermarks[column] = oldest_date
+        self.upload_journal.commit(self.newest_watermarks, self.oldest_watermarks)
+
+    async def upload_history(self, windows, descending, limit=None):
+        """Stream the windows through the pipeline: pages -> payloads -> concurrent uploads.
+
+        Returns the number of payloads committed, at most limit.  The pages cached on the way are
+        indexed once the round is over, even if it failed.
+        """
+        scheduler = UploadScheduler(
+            upload=self.upload_payload,
+            commit=lambda payload, dynamo_dates: self.commit_payload(payload, dynamo_dates, descending),
+            max_in_flight=self.max_concurrent_uploads)
+        payloads = self.history_payloads(self.history_pages(windows, descending), descending)
+        try:
+            return await scheduler.run(payloads, limit)
+        finally:
+            await self.history_cache.async_flush(self.upload_journal.is_uploaded)
+
+    @property
+    def active_columns(self):
+        """Columns of the active entities."""
+        return [self.id_to_column_name_lookup[entity_id] for entity_id in self.active_entity_ids]
+
+    async def load_persisted_state(self):
+        """Load the history cache and the upload journal, resuming from the journal's watermarks.
+
+        The watermarks are only restored if the journal has every active column.
+        """
+        await self.history_cache.async_load()
+        await self.upload_journal.async_load()
+        if self.upload_journal.has_watermarks(self.active_columns):
+            self.newest_watermarks = dict(self.upload_journal.newest_watermarks)
+            self.oldest_watermarks = dict(self.upload_journal.oldest_watermarks)
+            LOGGER.debug('Upload watermarks restored from the upload journal')
+
+    async def upload_new_history(self):
+        """Upload the history states that are newer than anything in dynamo.
+
+        Streams through the recorder one page (of at most self.page_size readings) per entity at
+        a time, so memory stays bounded however much history is missing.
+        """
+        count = await self.upload_history(self.new_history_windows(), descending=False)
+        LOGGER.debug(f'Updated dynamo with NEW data: ({count}) rounds')
 
     async def upload_old_history(self):
-        """Upload section of old history states that are older than anything in dynamo.
+        """Upload the old history states that are older than anything in dynamo.
 
-        self.dynamo_dates is updated so that if this function is called again a new section will be
-        uploaded.
-        const.MAX_UPLOAD_HISTORY_READINGS number of readings are uploaded to avoid long delay.
+        Pages are read backwards from self.oldest_watermarks and uploaded concurrently.  If this is
+        interrupted, the next call carries on from the last committed page.
+        Each round of const.BACKFILL_ROUND_PAYLOADS payloads holds upload_lock, so the backfill
+        never runs alongside call_lambda's upload of new history (or its reset of the watermarks),
+        and call_lambda only waits for the round in progress.
         """
-        LOGGER.debug('Uploading portion of old history...')
-        histories = {}
-        constant_attributes = {}
-        for active_entity_id in self.active_entity_ids:
-            column = self.id_to_column_name_lookup[active_entity_id]
-            history_states = await history.get_state_changes(
-                self.hass,
-                active_entity_id,
-                const.DYNAMO_HISTORY_DAYS)
-            missing_old_histories_states = self.get_missing_old_histories_states(history_states, column)
+        LOGGER.debug('Uploading old history...')
+        while True:
+            async with self.upload_lock:
+                if not (windows := self.old_history_windows()):
+                    break
+                count = await self.upload_history(windows, descending=True, limit=const.BACKFILL_ROUND_PAYLOADS)
+            LOGGER.debug(f'Updated dynamo with OLD data: ({count}) rounds')
+        self.history_upload_complete = True
+        LOGGER.debug('History upload complete, recalculate heating profile...\n')
+        # Now that we have all the history, recalculate heating profile
+        self.manual_update = True
+
+    def backfill_ready(self):
+        """Check if the state the backfill starts from has been loaded by call_lambda.
+
+        The watermarks must have been restored from the journal (or reset from dynamo) and the
+        dates in HA read, call_lambda may have failed before getting that far.
+        """
+        return (self.upload_journal.loaded
+                and self.upload_journal.has_watermarks(self.active_columns)
+                and self.ha_oldest_dates is not None)
 
-            LOGGER.debug(f'  column: {column}')
-            if len(missing_old_histories_states) == 0:
-                LOGGER.debug(f'    ({column}) - Upload complete')
-                continue
-            LOGGER.debug(f'    len(missing_old_histories_states): {len(missing_old_histories_states)}')
-            missing_old_histories_states = missing_old_histories_states[-const.MAX_UPLOAD_HISTORY_READINGS:]
+    def start_backfill(self):
+        """Upload the old history in the background, unless it is already being uploaded.
 
-            histories[column], constant_attributes[column] = history.states_to_histories(
-                self.hass,
-                column,
-                missing_old_histories_states)
-        if histories == {}:
-            self.history_upload_complete = True
-            LOGGER.debug('History upload complete, recalculate heating profile...\n')
-            # Now that we have all the history, recalculate heating profile
-            self.manual_update = True
+        Nothing is started until backfill_ready, the next call_lambda gets it ready.
+        """
+        if self.backfill_task is not None and not self.backfill_task.done():
             return
-        dynamo_data = history.histories_to_dynamo_data(
-            self.hass,
-            histories,
-            constant_attributes,
-            self.user_hash,
-            self.climate_entity_id,
-            self.postcode,
-            self.tariff)
-        self.dynamo_oldest_dates, self.dynamo_newest_dates = await self.client.upload_history(dynamo_data)
+        if not self.backfill_ready():
+            LOGGER.debug('History backfill waiting for the upload state to be loaded')
+            return
+        self.backfill_task = self.hass.async_create_background_task(
+            self.upload_old_history(),
+            name=f'{const.DOMAIN} history backfill')
+        self.backfill_task.add_done_callback(self.backfill_done)
+
+    def backfill_done(self, task):
+        """Log why the backfill stopped, it is restarted on a later tick.
+
+        Once the history is complete, an update is needed to recalculate the heating profile.
+        """
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.debug(f'History backfill stopped: {task.exception()!r}')
+        elif not task.cancelled() and self.manual_update and self.on_update_needed is not None:
+            self.on_update_needed()
+
+    async def async_cancel_backfill(self):
+        """Stop the background upload of old history and the background profile refresh."""
+        tasks = [task for task in (self.backfill_task, self.refresh_task)
+                 if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def restore_profile(self):
+        """Restore the persisted heating profile if it can still be served."""
+        restored = await self.profile_store.async_load()
+        if restored is None:
+            return False
+        lambda_results, expire_time = restored
+        try:
+            self.profile_frame = ProfileFrame(lambda_results)
+        except ValueError as err:
+            LOGGER.warn(f'Persisted heating profile is invalid, ignoring it: {err}')
+            return False
+        self.lambda_results, self.expire_time = lambda_results, expire_time
+        return True
+
+    def start_profile_refresh(self, lambda_args):
+        """Fetch a new heating profile in the background, serving the current one meanwhile."""
+        self.refresh_task = self.hass.async_create_background_task(
+            self.call_lambda(lambda_args),
+            name=f'{const.DOMAIN} heating profile refresh')
+        self.refresh_task.add_done_callback(self.refresh_done)
+
+    def refresh_done(self, task):
+        """Log why the refresh failed, it is retried after const.UPDATE_RETRY_INTERVAL.
+
+        The retry also loads the upload state the backfill waits for.  Otherwise, an update is
+        needed to serve the new heating profile.
+        """
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.debug(f'Heating profile refresh failed: {task.exception()!r}')
+            self.manual_update = True
+        elif not task.cancelled() and self.on_update_needed is not None:
+            self.on_update_needed()
+
+    def next_wakeup(self, now):
+        """When the data next needs updating without any input changing.
+
+        That is at the next timestamp of the heating profile (the current slot ends) or when the
+        profile expires, whichever is first.  If the lambda still needs calling (it failed), it is
+        retried after const.UPDATE_RETRY_INTERVAL.
+        """
+        if self.manual_update or self.expire_time <= now:
+            return now + const.UPDATE_RETRY_INTERVAL
+        wakeup = self.expire_time
+        if self.profile_frame is not None and (upcoming := self.profile_frame.next_timestamp(now)):
+            # get_closest_time only uses timestamps strictly in the past
+            wakeup = min(wakeup, upcoming + timedelta(seconds=1))
+        return wakeup
 
     async def __call__(self, lambda_args):
         """Return lambda data for the current time.
 
         Calls lambda if new heating profile is needed
-        Otherwise, slowly uploads historical data
+        Otherwise, uploads historical data in the background
+        At startup the persisted heating profile is served straight away if it is still valid, and
+        refreshed in the background.
+        While the lambda is unavailable the last heating profile keeps being served, the api client
+        backs off (and eventually refuses calls) so the retries on each tick are cheap.
         """
+        if self.profile_store.loaded is False and await self.restore_profile():
+            self.start_profile_refresh(lambda_args)
+        if self.refresh_task is not None and not self.refresh_task.done():
+            return self.get_closest_time(lambda_args)
         now = datetime.now(tz=timezone.utc)
         # This probably won't result in a smooth transition
         if self.expire_time - now < timedelta(hours=0) or self.manual_update:
-            await self.call_lambda(lambda_args)
+            try:
+                await self.call_lambda(lambda_args)
+            except (OptisparkApiClientTimeoutError, OptisparkApiClientCommunicationError) as err:
+                if self.lambda_results is None:
+                    raise
+                LOGGER.debug(f'Lambda unavailable ({err}), serving the last heating profile')
         else:
             if self.history_upload_complete is False:
-                await self.upload_old_history()
+                self.start_backfill()
         return self.get_closest_time(lambda_args)
 
     async def update_dynamo_dates(self):
         """Call the lambda function and get the oldest and newest dates in dynamodb."""
-        self.dynamo_oldest_dates, self.dynamo_newest_dates = await self.client.get_data_dates(
+        dynamo_oldest_dates, dynamo_newest_dates = await self.client.get_data_dates(
             dynamo_data={'user_hash': self.user_hash})
+        self.update_watermarks(dynamo_oldest_dates, dynamo_newest_dates)
+        self.upload_journal.commit(self.newest_watermarks, self.oldest_watermarks, reconciled=True)
 
     async def update_ha_dates(self):
         """Get the oldest and newest dates in HA histories for active_entity_ids."""
@@ -507,16 +857,14 @@ class LambdaUpdateHandler:
         LOGGER.debug('---entities_with_data_missing_from_dynamo---')
         for active_entity_id in self.active_entity_ids:
             column = self.id_to_column_name_lookup[active_entity_id]
-            if self.dynamo_newest_dates[column] is None:
-                # First run, therefore data is missing
-                LOGGER.debug(f'First run, upload ({const.HISTORY_DAYS}) days of history...\n')
-                entities_missing.append(active_entity_id)
+            if self.ha_newest_dates.get(column) is None:
+                # Nothing recorded in HA
                 continue
-            if self.dynamo_newest_dates[column] < self.ha_newest_dates[column]:
-                LOGGER.debug(f'self.dynamo_newest_dates[{column}]: {self.dynamo_newest_dates[column]}')
+            if self.newest_watermarks[column] < self.ha_newest_dates[column]:
+                LOGGER.debug(f'self.newest_watermarks[{column}]: {self.newest_watermarks[column]}')
                 LOGGER.debug(f'self.ha_newest_dates[{column}]: {self.ha_newest_dates[column]}')
                 LOGGER.debug(f'  column: {column}')
-                LOGGER.debug(f'  dynamo {self.dynamo_newest_dates[column]} is older than local {self.ha_newest_dates[column]}')
+                LOGGER.debug(f'  dynamo {self.newest_watermarks[column]} is older than local {self.ha_newest_dates[column]}')
                 entities_missing.append(active_entity_id)
         return entities_missing
         #return False
@@ -527,61 +875,46 @@ class LambdaUpdateHandler:
         Upload all new and missing data to dynamo first.
         If there is no data in dynamo, upload const.HISTORY_DAYS worth of data.
         Records the when the heating profile expires and should be refreshed.
+        The watermarks come from the upload journal, dynamo is only asked for its dates when the
+        journal is missing a column or is due to be reconciled.
         """
         LOGGER.debug(f'********** self.expire_time: {self.expire_time}')
-        count = 0
-        await self.update_dynamo_dates()
-        await self.update_ha_dates()
-        while missing_entities := self.entities_with_data_missing_from_dynamo():
-            count += 1
-            LOGGER.debug(f'Updating dynamo with NEW data: round ({count})')
-            await self.upload_new_history(missing_entities)
+        async with self.upload_lock:
+            if self.upload_journal.loaded is False:
+                await self.load_persisted_state()
+            if self.upload_journal.needs_reconcile(self.active_columns):
+                await self.update_dynamo_dates()
+            await self.update_ha_dates()
+            await self.upload_new_history()
         LOGGER.debug('Upload of new history complete\n')
 
-        self.lambda_results = await self.client.async_get_profile(lambda_args)
+        lambda_results = await self.client.async_get_profile(lambda_args)
+        try:
+            self.profile_frame = ProfileFrame(lambda_results)
+        except ValueError as err:
+            # The last valid heating profile is kept
+            raise OptisparkApiClientLambdaError(f'Invalid heating profile: {err}') from err
+        self.lambda_results = lambda_results
 
         self.expire_time = self.lambda_results[const.LAMBDA_TIMESTAMP][-1]
         # The backend will currently only update upon a new day. FIX!
         self.expire_time = self.expire_time + timedelta(hours=1, minutes=30)
         LOGGER.debug(f'---------- self.expire_time: {self.expire_time}')
         self.manual_update = False
+        await self.profile_store.async_save(self.lambda_results, self.expire_time)
 
     def get_closest_time(self, lambda_args):
-        """Get the closest matching time to now from the lambda data set provided."""
-        time_based_keys = [
-            const.LAMBDA_BASE_DEMAND,
-            const.LAMBDA_PRICE,
-            const.LAMBDA_TEMP_CONTROLS,
-            const.LAMBDA_OPTIMISED_DEMAND]
-        non_time_based_keys = [
-            const.LAMBDA_BASE_COST,
-            const.LAMBDA_OPTIMISED_COST,
-            const.LAMBDA_PROJECTED_PERCENT_SAVINGS]
-
-        # Convert lists to {datetime: list_element}
-        my_data = {}
-        for key in time_based_keys:
-            my_data[key] = {
-                self.lambda_results[const.LAMBDA_TIMESTAMP][i]: self.lambda_results[key][i]
-                    for i in range(len(self.lambda_results[key]))}
-        for key in non_time_based_keys:
-            my_data[key] = self.lambda_results[key]
-
-        # Get closet datetime that is in the past
-        datetime_np = np.asarray(self.lambda_results[const.LAMBDA_TIMESTAMP])
-        filtered = datetime_np[datetime_np < datetime.now(tz=timezone.utc)]
-        closest_past_date = filtered.max()
-
-        out = {}
-        for key in time_based_keys:
-            out[key] = my_data[key][closest_past_date]
-
-        for key in non_time_based_keys:
-            out[key] = my_data[key]
+        """Get the closest matching time to now from the lambda data set provided.
+
+        The latest slot of self.profile_frame that is in the past, the lookup is cached until the
+        slot ends.
+        """
+        out = self.profile_frame.values_at()
 
         if lambda_args[const.LAMBDA_OUTSIDE_RANGE]:
             # We're outside of the temp range so simply set the set point to whatever the user has
-            # requested
+            # requested.  The profile frame's values are read only, so copy them first
+            out = dict(out)
             out[const.LAMBDA_TEMP_CONTROLS] = lambda_args[const.LAMBDA_SET_POINT]
             self.outside_range_flag = True
             LOGGER.debug(f'initial_internal_temp({lambda_args[const.LAMBDA_INITIAL_INTERNAL_TEMP]}) is outside of temp_range({lambda_args[const.LAMBDA_TEMP_RANGE]}) of the internal_temp({out[const.LAMBDA_TEMP_CONTROLS]}) - setting to set_point({lambda_args[const.LAMBDA_SET_POINT]})')
@@ -590,4 +923,7 @@ class LambdaUpdateHandler:
             LOGGER.debug('Temperature range reached')
             self.manual_update = True
             self.outside_range_flag = False
+            if self.on_update_needed is not None:
+                # Re-optimise now rather than after the const.UPDATE_RETRY_INTERVAL wakeup
+                self.on_update_needed()
         return out
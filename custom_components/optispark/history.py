@@ -7,18 +7,22 @@ All values in °F are converted to °C
 All values in W are converted to kW
 """
 
-from homeassistant.components.recorder.history import get_significant_states
-from homeassistant.components.recorder.history import state_changes_during_period
+from homeassistant.components.recorder.history import get_significant_states_with_session
 
-from homeassistant.components.recorder.util import get_instance
+from homeassistant.components.recorder.db_schema import StateAttributes, States
+from homeassistant.components.recorder.util import get_instance, session_scope
 from homeassistant.const import UnitOfTemperature
 from homeassistant.helpers.entity_registry import RegistryEntry
 from homeassistant.helpers.device_registry import DeviceRegistry
 from homeassistant.helpers import entity_registry
 from homeassistant.helpers import device_registry
 from homeassistant.helpers import template
+from homeassistant.util.json import json_loads_object
 from datetime import datetime, timedelta, timezone
 import json
+from types import MappingProxyType
+import numpy as np
+from sqlalchemy import select
 from .const import LOGGER
 from . import const
 
@@ -66,7 +70,178 @@ def get_user_info(hass, heat_pump_entity_id, postcode, tariff):
             'tariff': tariff}
 
 
-def climate_history(hass, state_changes):
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def datetime_to_epoch_us(date: datetime) -> int:
+    """Convert a timezone aware datetime to integer microseconds since the epoch."""
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+
+def epoch_us_to_datetime(epoch_us: int) -> datetime:
+    """Convert integer microseconds since the epoch to a UTC datetime."""
+    return EPOCH + timedelta(microseconds=epoch_us)
+
+
+class HistoryFrame:
+    """Columnar history of a single entity.
+
+    Replaces the {datetime: {'state': ..., 'attributes': {...}}} dict that used to be built for
+    every reading.  Each reading only costs an entry in a couple of numpy arrays:
+        timestamps: int64 microseconds since the epoch (UTC), in ascending order
+        values: float64 state of numeric entities, NaN for non numeric entities
+        labels/label_ids: states of non numeric entities (e.g. the climate hvac mode).  Each
+            distinct state string is stored once in labels and label_ids indexes into it
+        attributes/attribute_ids: each distinct attribute payload is stored once in attributes and
+            attribute_ids indexes into it, -1 means the reading has no attributes
+    """
+
+    def __init__(self, timestamps, values, labels=None, label_ids=None, attributes=None,
+                 attribute_ids=None):
+        """Init."""
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.labels = labels
+        self.label_ids = None if label_ids is None else np.asarray(label_ids, dtype=np.int32)
+        self.attributes = attributes if attributes is not None else []
+        if attribute_ids is None:
+            attribute_ids = np.full(len(self.timestamps), -1)
+        self.attribute_ids = np.asarray(attribute_ids, dtype=np.int32)
+
+    def __len__(self):
+        """Number of readings."""
+        return len(self.timestamps)
+
+    def slice(self, start: int, stop: int):
+        """HistoryFrame of the readings self[start:stop].
+
+        The side tables are shared with self.  An empty range gives an empty HistoryFrame.
+        """
+        return HistoryFrame(
+            timestamps=self.timestamps[start:stop],
+            values=self.values[start:stop],
+            labels=self.labels,
+            label_ids=None if self.label_ids is None else self.label_ids[start:stop],
+            attributes=self.attributes,
+            attribute_ids=self.attribute_ids[start:stop])
+
+    def after(self, date: datetime):
+        """Readings strictly after date.
+
+        self.timestamps is sorted so this is a binary search.
+        """
+        start = int(np.searchsorted(self.timestamps, datetime_to_epoch_us(date), side='right'))
+        return self.slice(start, len(self))
+
+    def before(self, date: datetime):
+        """Readings strictly before date."""
+        stop = int(np.searchsorted(self.timestamps, datetime_to_epoch_us(date), side='left'))
+        return self.slice(0, stop)
+
+    def first_datetime(self) -> datetime | None:
+        """Date of the first reading, None if empty."""
+        return epoch_us_to_datetime(int(self.timestamps[0])) if len(self) else None
+
+    def last_datetime(self) -> datetime | None:
+        """Date of the last reading, None if empty."""
+        return epoch_us_to_datetime(int(self.timestamps[-1])) if len(self) else None
+
+    def datetimes(self) -> list[datetime]:
+        """Timestamps as UTC datetimes."""
+        return [epoch_us_to_datetime(epoch_us) for epoch_us in self.timestamps.tolist()]
+
+    def states(self) -> list:
+        """State of each reading, the label for non numeric entities otherwise the value."""
+        if self.label_ids is not None:
+            return [self.labels[label_id] for label_id in self.label_ids.tolist()]
+        return self.values.tolist()
+
+    def to_dict(self):
+        """Convert to the {datetime: {'state': ..., 'attributes': {...}}} format used by dynamo."""
+        attribute_ids = self.attribute_ids.tolist()
+        return {
+            date: {
+                'state': state,
+                'attributes': self.attributes[attribute_id] if attribute_id >= 0 else {}}
+            for date, state, attribute_id in zip(self.datetimes(), self.states(), attribute_ids)}
+
+
+class _IdTable:
+    """Assign an index to each distinct object, used to build the HistoryFrame side tables."""
+
+    def __init__(self, key=id):
+        """Init."""
+        self.items = []
+        self._key = key
+        self._lookup = {}
+
+    def __call__(self, item) -> int:
+        """Index of item in self.items."""
+        key = self._key(item)
+        if (idx := self._lookup.get(key)) is None:
+            idx = self._lookup[key] = len(self.items)
+            self.items.append(item)
+        return idx
+
+
+CLIMATE_ATTRIBUTES_TO_CONVERT_TO_CELCIUS = ['current_temperature', 'target_temp_high', 'target_temp_low', 'temperature']
+
+
+def convert_climate_attributes(attributes, hh_temp_units):
+    """Copy of the climate attributes with the temperatures cast to float and converted to °C."""
+    converted = dict(attributes)
+    for key in CLIMATE_ATTRIBUTES_TO_CONVERT_TO_CELCIUS:
+        if key in converted:
+            try:
+                value = float(converted[key])
+            except Exception:
+                LOGGER.warn(f'Could not convert attributes[{key}] ({converted[key]}) of type({type(converted[key])}) to float')
+                continue
+            if hh_temp_units == UnitOfTemperature.FAHRENHEIT:
+                value = to_celcius(value)
+            converted[key] = value
+    return converted
+
+
+class ClimateAttributesCache:
+    """Convert each distinct climate attribute payload once.
+
+    Climate attributes repeat across thousands of consecutive states.  The recorder decodes each
+    distinct shared attributes row once and hands the same dict to every state that uses it, so
+    the cache is keyed by the identity of that dict and falls back to a hash of its content.
+    The converted attributes are returned as read only views, the recorder's dicts are never
+    modified.
+    """
+
+    def __init__(self, hh_temp_units):
+        """Init."""
+        if hh_temp_units not in (UnitOfTemperature.FAHRENHEIT, UnitOfTemperature.CELSIUS):
+            LOGGER.error(f'Heat pump uses unkown units ({hh_temp_units})')
+            raise ValueError(f'Heat pump uses unkown units ({hh_temp_units})')
+        self.hh_temp_units = hh_temp_units
+        self.hits = 0
+        self.misses = 0
+        # id(attributes) -> (attributes, view).  attributes is kept so that its id can't be reused
+        self._by_id = {}
+        self._by_content = {}
+
+    def __call__(self, attributes) -> MappingProxyType:
+        """Converted, read only, view of attributes."""
+        if (cached := self._by_id.get(id(attributes))) is not None:
+            self.hits += 1
+            return cached[1]
+        content_key = json.dumps(attributes, sort_keys=True, default=str)
+        if (view := self._by_content.get(content_key)) is None:
+            self.misses += 1
+            view = MappingProxyType(convert_climate_attributes(attributes, self.hh_temp_units))
+            self._by_content[content_key] = view
+        else:
+            self.hits += 1
+        self._by_id[id(attributes)] = (attributes, view)
+        return view
+
+
+def climate_history(hass, state_changes, _window_attributes=None):
     """Climate history.
 
     Home assistant logs the temperature states in whatever unit is set by the user (not the heat
@@ -75,192 +250,393 @@ def climate_history(hass, state_changes):
     If the user toggles the hh temperature units, the past logs will be messed up.  The units will be
     incorrect, they will have been stored as the old unit but now read as the new unit.  Lets just hope
     people don't regularly swap their temperature units.
+
+    Climate attributes change with every reading so they are always fetched per state.
     """
-    history = {}
+    timestamps = []
+    label_ids = []
+    attribute_ids = []
+    labels = _IdTable(key=str)
+    attributes = _IdTable()  # Each distinct converted view is stored once
     constant_attributes = {}  # Store attributes that would otherwise repeat in every time step
-    hh_temp_units = hass.config.units.temperature_unit
-    attributes_to_convert_to_celcius = ['current_temperature', 'target_temp_high', 'target_temp_low', 'temperature']
+    convert_attributes = ClimateAttributesCache(hass.config.units.temperature_unit)
     for time_step in state_changes:
-        if hh_temp_units == UnitOfTemperature.FAHRENHEIT:
-            for key in attributes_to_convert_to_celcius:
-                if key in time_step.attributes:
-                    try:
-                        time_step.attributes[key] = to_celcius(float(time_step.attributes[key]))
-                    except Exception:
-                        LOGGER.warn(f'Could not convert time_step.attributes[{key}] ({time_step.attributes[key]}) of type({type(time_step.attributes[key])}) to float')
-                        continue
-        elif hh_temp_units == UnitOfTemperature.CELSIUS:
-            # Already in °C but still cast to float
-            for key in attributes_to_convert_to_celcius:
-                if key in time_step.attributes:
-                    try:
-                        time_step.attributes[key] = float(time_step.attributes[key])
-                    except Exception:
-                        LOGGER.warn(f'Could not convert time_step.attributes[{key}] ({time_step.attributes[key]}) of type({type(time_step.attributes[key])}) to float')
-                        continue
-        else:
-            LOGGER.error(f'Heat pump uses unkown units ({hh_temp_units})')
-            raise ValueError(f'Heat pump uses unkown units ({hh_temp_units})')
-
-        history[time_step.last_updated] = {
-            'state': time_step.state,
-            'attributes': time_step.attributes}
+        timestamps.append(datetime_to_epoch_us(time_step.last_updated))
+        label_ids.append(labels(time_step.state))
+        attribute_ids.append(attributes(convert_attributes(time_step.attributes)))
+    LOGGER.debug(f'climate attributes converted: {convert_attributes.misses}, reused: {convert_attributes.hits}')
+
+    history = HistoryFrame(
+        timestamps=timestamps,
+        values=np.full(len(timestamps), np.nan),
+        labels=labels.items,
+        label_ids=label_ids,
+        attributes=[dict(view) for view in attributes.items],
+        attribute_ids=attribute_ids)
 
     # Get attributes from most recent time_step
     constant_attributes = {
         'entity_id': state_changes[-1].entity_id,
-        'attributes': state_changes[-1].attributes}
+        'attributes': dict(convert_attributes(state_changes[-1].attributes))}
 
     return history, constant_attributes
 
-def external_temp_history(_hass, state_changes):
+POWER_UNIT_CONVERSIONS = {
+    'W': lambda x: x / 1000,
+    'kW': lambda x: x}
+TEMPERATURE_UNIT_CONVERSIONS = {
+    '°F': to_celcius,
+    '°C': lambda x: x}
+
+
+def _parse_float(state) -> float:
+    """Parse a single state, NaN if it isn't a number."""
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_states(states) -> np.ndarray:
+    """Parse state strings to float64 in bulk.
+
+    States that aren't finite numbers (e.g. 'unavailable', 'unknown', '') are set to NaN.
+    """
+    try:
+        values = np.asarray(states, dtype=str).astype(np.float64)
+    except ValueError:
+        # At least one state isn't a number, fall back to parsing each state
+        values = np.fromiter((_parse_float(state) for state in states), dtype=np.float64, count=len(states))
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+
+def normalise_states(name, states, units, conversions):
+    """Convert raw sensor states to floats in the units used by dynamo.
+
+    states: raw state strings
+    units: unit_of_measurement of each state, or a single unit shared by every state
+    conversions: {unit: function} that converts an array in that unit to the dynamo unit
+
+    Returns the converted values (NaN where the state was rejected) and the set of units that have
+    no conversion.  Rejected states are reported in a single log line rather than one per state.
+    """
+    raw_values = parse_states(states)
+    if units is None or isinstance(units, str):
+        units = np.full(len(raw_values), units, dtype=object)
+    else:
+        units = np.asarray(units, dtype=object)
+    values = np.full(len(raw_values), np.nan)
+    known_unit = np.zeros(len(raw_values), dtype=bool)
+    for unit, convert in conversions.items():
+        mask = units == unit
+        values[mask] = convert(raw_values[mask])
+        known_unit |= mask
+
+    missing_unit = np.equal(units, None)
+    unknown_unit = ~known_unit & ~missing_unit
+    unknown_units = set(units[unknown_unit].tolist())
+    rejected = int(np.count_nonzero(np.isnan(values)))
+    if rejected:
+        LOGGER.warn(
+            f'({name}) rejected {rejected}/{len(values)} states: '
+            f'{int(np.count_nonzero(np.isnan(raw_values)))} not a number, '
+            f'{int(np.count_nonzero(missing_unit))} missing unit_of_measurement, '
+            f'{int(np.count_nonzero(unknown_unit))} with unsupported units {unknown_units or ""}')
+    return values, unknown_units
+
+
+def sensor_history(name, state_changes, window_attributes, conversions):
+    """Convert sensor states to a HistoryFrame, rejected states are dropped.
+
+    If the states were fetched without attributes, window_attributes holds the attributes shared
+    by every state and its unit is used for all of them.
+    Returns the HistoryFrame and the set of units that have no conversion.
+    """
+    if window_attributes is not None:
+        units = window_attributes.get('unit_of_measurement')
+    else:
+        units = [time_step.attributes.get('unit_of_measurement') for time_step in state_changes]
+    values, unknown_units = normalise_states(
+        name,
+        [time_step.state for time_step in state_changes],
+        units,
+        conversions)
+    timestamps = np.fromiter(
+        (datetime_to_epoch_us(time_step.last_updated) for time_step in state_changes),
+        dtype=np.int64,
+        count=len(state_changes))
+    keep = ~np.isnan(values)
+    return HistoryFrame(timestamps[keep], values[keep]), unknown_units
+
+
+def external_temp_history(_hass, state_changes, window_attributes=None):
     """External temperature history.
 
     The sensor will be displayed in whatever unit the sensor is set to. This is odd.  It ignores the
     hh setting and is different to the climate_entity.  I imagine this could change in the future.
 
     The unit is stored with each time step log, so we are fully able convert the history to °C.
+
+    If the states were fetched without attributes, window_attributes holds the attributes shared
+    by every state and is used instead.
     """
-    history = {}
-    constant_attributes = {}  # Store attributes that would otherwise repeat in every time step
-    for time_step in state_changes:
-        if time_step.state == '':
-            LOGGER.warn(f'time_step ({time_step}) has no state value')
-            continue
-        if 'unit_of_measurement' not in time_step.attributes:
-            LOGGER.warn(f'unit_of_measurement missing from time_step ({time_step})')
-            continue
-        unit = time_step.attributes['unit_of_measurement']
-        state = time_step.state
-        if unit == '°F':
-            try:
-                state = to_celcius(float(time_step.state))
-            except Exception:
-                LOGGER.warn(f'Could not convert state ({time_step.state}) of type({type(time_step.state)}) to float')
-                continue
-        elif unit == '°C':
-            try:
-                state = float(time_step.state)
-            except Exception:
-                LOGGER.warn(f'Could not convert state ({time_step.state}) of type({type(time_step.state)}) to float')
-                continue
-        else:
-            LOGGER.error(f'External temperature sensor uses unkown units ({unit})')
-            raise ValueError(f'External temperature sensor uses unkown units ({unit})')
-        history[time_step.last_updated] = {
-            'state': state,
-            'attributes': {}}
+    history, unknown_units = sensor_history(
+        const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE,
+        state_changes,
+        window_attributes,
+        TEMPERATURE_UNIT_CONVERSIONS)
+    if unknown_units:
+        LOGGER.error(f'External temperature sensor uses unkown units ({unknown_units})')
+        raise ValueError(f'External temperature sensor uses unkown units ({unknown_units})')
 
     # Get attributes from most recent time_step
     constant_attributes = {
         'entity_id': state_changes[-1].entity_id,
-        'attributes': state_changes[-1].attributes}
+        'attributes': window_attributes if window_attributes is not None else state_changes[-1].attributes}
 
     return history, constant_attributes
 
 
-def power_history(_hass, state_changes):
+def power_history(_hass, state_changes, window_attributes=None):
     """Heat pump power use history.
 
     Home assistant includes units in each power usage log.  There are no issues converting
     each time step to kW.  The unit recorded is that used by the sensor.
+
+    If the states were fetched without attributes, window_attributes holds the attributes shared
+    by every state and is used instead.
     """
-    history = {}
-    constant_attributes = {}  # Store attributes that would otherwise repeat in every time step
-    for time_step in state_changes:
-        if time_step.state == '':
-            LOGGER.warn(f'time_step ({time_step}) has no state value')
-            continue
-        if 'unit_of_measurement' not in time_step.attributes:
-            LOGGER.warn(f'unit_of_measurement missing from time_step ({time_step})')
-            continue
-        unit = time_step.attributes['unit_of_measurement']
-        state = time_step.state
-        if unit == 'W':
-            try:
-                state = float(state) / 1000
-            except Exception:
-                LOGGER.warn(f'Could not convert state ({state}) of type({type(state)}) to float')
-                continue
-        elif unit == 'kW':
-            try:
-                state = float(state)
-            except Exception:
-                LOGGER.warn(f'Could not convert state ({state}) of type({type(state)}) to float')
-                continue
-        else:
-            LOGGER.warn(f'Heat pump uses unsupported units ({unit})')
-            continue
-        history[time_step.last_updated] = {
-            'state': state,
-            'attributes': {}}
+    history, _unknown_units = sensor_history(
+        const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER,
+        state_changes,
+        window_attributes,
+        POWER_UNIT_CONVERSIONS)
 
     # Get attributes from most recent time_step
     constant_attributes = {
         'entity_id': state_changes[-1].entity_id,
-        'attributes': state_changes[-1].attributes}
+        'attributes': window_attributes if window_attributes is not None else state_changes[-1].attributes}
 
     return history, constant_attributes
 
 
-async def get_state_changes(hass, entity_id, history_days):
-    """History of state changes for entity_id."""
-    start_time = datetime.now(tz=timezone.utc) - timedelta(days=history_days)
-    end_time = datetime.now(tz=timezone.utc)
+def get_window_attributes_with_session(hass, session, entity_id, start_time, end_time):
+    """Get the attributes of the most recent state of entity_id within the window.
+
+    The unit of every state in the window is resolved from the state_attributes table without
+    reading the states' attributes.  Returns None if the window doesn't have a single
+    unit_of_measurement (e.g. the user changed the unit) in which case the states must be fetched
+    with their attributes.
+    Must be run in the recorder executor.
+    """
+    metadata_id = get_instance(hass).states_meta_manager.get(entity_id, session, False)
+    if metadata_id is None:
+        return None
+    query = (
+        select(States.attributes_id)
+        .filter(States.metadata_id == metadata_id)
+        .filter(States.last_updated_ts > start_time.timestamp())
+        .filter(States.last_updated_ts < end_time.timestamp()))
+    attributes_ids = session.execute(query.distinct()).scalars().all()
+    if len(attributes_ids) == 0 or None in attributes_ids:
+        # Nothing recorded or legacy states that store their attributes inline
+        return None
+    shared_attrs = dict(session.execute(
+        select(StateAttributes.attributes_id, StateAttributes.shared_attrs)
+        .filter(StateAttributes.attributes_id.in_(attributes_ids))).tuples().all())
+    if len(shared_attrs) != len(attributes_ids):
+        return None
+    units = {
+        json_loads_object(shared_attrs[attributes_id] or '{}').get('unit_of_measurement')
+        for attributes_id in attributes_ids}
+    if len(units) != 1 or None in units:
+        return None
+    latest_attributes_id = session.execute(
+        query.order_by(States.last_updated_ts.desc()).limit(1)).scalar()
+    return json_loads_object(shared_attrs[latest_attributes_id] or '{}')
+
+
+def get_state_changes_batch_with_session(hass, session, windows, no_attributes_entity_ids=()):
+    """Fetch the state changes of several entities using a single recorder session.
+
+    windows maps each entity_id to its (start_time, end_time) window.  Entities that share a window
+    are fetched with a single query, the results are then split per entity.
+    Entities in no_attributes_entity_ids are fetched without joining and decoding the attributes of
+    every state if their whole window shares one unit_of_measurement (see
+    get_window_attributes_with_session).
+    Must be run in the recorder executor.
+
+    Returns ({entity_id: states}, {entity_id: window_attributes}), window_attributes is None for
+    entities whose states were fetched with their attributes.
+    """
+    window_attributes = {}
+    entity_ids_by_query = {}
+    for entity_id, (start_time, end_time) in windows.items():
+        window_attributes[entity_id] = None
+        if entity_id in no_attributes_entity_ids:
+            window_attributes[entity_id] = get_window_attributes_with_session(
+                hass,
+                session,
+                entity_id,
+                start_time,
+                end_time)
+        no_attributes = window_attributes[entity_id] is not None
+        entity_ids_by_query.setdefault((start_time, end_time, no_attributes), []).append(entity_id)
+
     filters = None
     include_start_time_state = False
     significant_changes_only = False
     minimal_response = False
-    no_attributes = False
     compressed_state_format = False
-    args = [
+    state_changes = {}
+    for (start_time, end_time, no_attributes), entity_ids in entity_ids_by_query.items():
+        args = [
+            hass,
+            session,
+            start_time,
+            end_time,
+            entity_ids,
+            filters,
+            include_start_time_state,
+            significant_changes_only,
+            minimal_response,
+            no_attributes,
+            compressed_state_format]
+        query_state_changes = get_significant_states_with_session(*args)
+        for entity_id in entity_ids:
+            state_changes[entity_id] = query_state_changes.get(entity_id, [])
+    return state_changes, window_attributes
+
+
+def get_state_changes_batch_sync(hass, windows, no_attributes_entity_ids=()):
+    """Open a recorder session and fetch the state changes of several entities."""
+    with session_scope(hass=hass, read_only=True) as session:
+        return get_state_changes_batch_with_session(hass, session, windows, no_attributes_entity_ids)
+
+
+async def get_state_changes_batch(hass, windows, no_attributes_entity_ids=()):
+    """State changes of several entities, each within its own (start_time, end_time) window.
+
+    All entities are fetched with one trip to the recorder executor.
+    Returns ({entity_id: states}, {entity_id: window_attributes}).
+    """
+    return await get_instance(hass).async_add_executor_job(
+        get_state_changes_batch_sync,
         hass,
-        start_time,
-        end_time,
-        [entity_id],
-        filters,
-        include_start_time_state,
-        significant_changes_only,
-        minimal_response,
-        no_attributes,
-        compressed_state_format]
-    state_changes = await get_instance(hass).async_add_executor_job(
-        get_significant_states,
-        *args)
-
-    return state_changes[entity_id]
-
-
-async def get_state_changes_period(hass, entity_id, history_days):
-    """Trying out a different history function."""
-    start_time = datetime.now(tz=timezone.utc) - timedelta(days=history_days)
-    end_time = datetime.now(tz=timezone.utc)
-    no_attributes = False
-    descending = False
-    limit = 99999
-    include_start_time_state = False
+        windows,
+        no_attributes_entity_ids)
+
+
+class HistoryPage:
+    """One page of recorder states of a single entity.
+
+    start_time and end_time are the (exclusive) bounds of the page.  exhausted is True if the page
+    reached the end of the window it was taken from.
+    frame and constant_attributes hold the normalised states, they are set once the states have
+    been normalised (or straight away if the page was read from the history cache).
+    """
 
-    args = [
+    def __init__(self, entity_id, start_time, end_time, exhausted, states, window_attributes,
+                 frame=None, constant_attributes=None):
+        """Init."""
+        self.entity_id = entity_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.exhausted = exhausted
+        self.states = states
+        self.window_attributes = window_attributes
+        self.frame = frame
+        self.constant_attributes = constant_attributes
+
+
+def get_page_boundary_with_session(hass, session, entity_id, start_time, end_time, descending,
+                                   page_size):
+    """Date of the page_size-th state of entity_id in the window, None if there are fewer states.
+
+    Only reads the metadata_id/last_updated_ts index, the states themselves aren't loaded.
+    Must be run in the recorder executor.
+    """
+    metadata_id = get_instance(hass).states_meta_manager.get(entity_id, session, False)
+    if metadata_id is None:
+        return None
+    order = States.last_updated_ts.desc() if descending else States.last_updated_ts.asc()
+    boundary_ts = session.execute(
+        select(States.last_updated_ts)
+        .filter(States.metadata_id == metadata_id)
+        .filter(States.last_updated_ts > start_time.timestamp())
+        .filter(States.last_updated_ts < end_time.timestamp())
+        .order_by(order)
+        .offset(page_size - 1)
+        .limit(1)).scalar()
+    if boundary_ts is None:
+        return None
+    return datetime.fromtimestamp(boundary_ts, tz=timezone.utc)
+
+
+def get_history_pages_sync(hass, windows, descending, page_size, no_attributes_entity_ids=()):
+    """Fetch the next page of each entity's window using a single recorder session.
+
+    windows maps each entity_id to its (start_time, end_time) window.  Pages are taken from the
+    start of the window, or from the end if descending.  Each page holds at most page_size states
+    (plus any states that share the last timestamp) so memory is bounded no matter how densely the
+    entity is recorded.
+    Must be run in the recorder executor.
+    """
+    with session_scope(hass=hass, read_only=True) as session:
+        page_windows = {}
+        exhausted = {}
+        for entity_id, (start_time, end_time) in windows.items():
+            boundary = get_page_boundary_with_session(
+                hass,
+                session,
+                entity_id,
+                start_time,
+                end_time,
+                descending,
+                page_size)
+            exhausted[entity_id] = boundary is None
+            if boundary is None:
+                page_windows[entity_id] = (start_time, end_time)
+            elif descending:
+                page_windows[entity_id] = (boundary - timedelta(microseconds=1), end_time)
+            else:
+                page_windows[entity_id] = (start_time, boundary + timedelta(microseconds=1))
+        state_changes, window_attributes = get_state_changes_batch_with_session(
+            hass,
+            session,
+            page_windows,
+            no_attributes_entity_ids)
+    return {
+        entity_id: HistoryPage(
+            entity_id,
+            *page_windows[entity_id],
+            exhausted[entity_id],
+            state_changes[entity_id],
+            window_attributes[entity_id])
+        for entity_id in windows}
+
+
+async def get_history_pages(hass, windows, descending, page_size, no_attributes_entity_ids=()):
+    """Next HistoryPage of each entity's (start_time, end_time) window.
+
+    All entities are fetched with one trip to the recorder executor.  Returns {entity_id: page}.
+    """
+    return await get_instance(hass).async_add_executor_job(
+        get_history_pages_sync,
         hass,
-        start_time,
-        end_time,
-        entity_id,
-        no_attributes,
+        windows,
         descending,
-        limit,
-        include_start_time_state]
-    state_changes = await get_instance(hass).async_add_executor_job(
-        state_changes_during_period,
-        *args)
+        page_size,
+        no_attributes_entity_ids)
 
-    return state_changes[entity_id]
 
-
-def states_to_histories(hass, column_name, state_changes):
+def states_to_histories(hass, column_name, state_changes, window_attributes=None):
     """Clean up history states.
 
     Extracts relevent information from the states and ensures that everything is in the right data
-    type.
+    type.  Returns a HistoryFrame and the constant attributes.
+    window_attributes must be given if the states were fetched without attributes.
     """
     function_lookup = {
         const.DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY: climate_history,
@@ -268,13 +644,18 @@ def states_to_histories(hass, column_name, state_changes):
         const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE: external_temp_history}
     histories, constant_attributes = function_lookup[column_name](
         hass,
-        state_changes)
+        state_changes,
+        window_attributes)
     return histories, constant_attributes
 
 
 def histories_to_dynamo_data(hass, histories, constant_attributes, user_hash, heat_pump_entity_id,
                              postcode, tariff):
-    """Package the history data so that it's ready for upload to lambda."""
+    """Package the history data so that it's ready for upload to lambda.
+
+    histories are HistoryFrames, they are encoded to the format expected by dynamo by the api client
+    (see api.encode_history).
+    """
     user_info = get_user_info(hass, heat_pump_entity_id, postcode, tariff)
     dynamo_data = {
         'histories': histories,
@@ -304,41 +685,100 @@ async def get_history(hass, history_days: int, climate_entity_id, heat_pump_powe
         external_temp_entity_id: external_temp_history,
         heat_pump_power_entity_id: power_history}
 
+    start_time = datetime.now(tz=timezone.utc) - timedelta(days=history_days)
+    end_time = datetime.now(tz=timezone.utc)
+    windows = {}
     for entity_id in function_lookup:
         if entity_id is None:
             LOGGER.debug(f'({column_name_lookup[entity_id]}) entity missing, skipping...')
             continue
+        windows[entity_id] = (start_time, end_time)
+    state_changes, window_attributes = await get_state_changes_batch(
+        hass,
+        windows,
+        [heat_pump_power_entity_id, external_temp_entity_id])
+
+    for entity_id in windows:
         column_name = column_name_lookup[entity_id]
-        state_changes = await get_state_changes(hass, entity_id, history_days)
+        if len(state_changes[entity_id]) == 0:
+            LOGGER.debug(f'({column_name}) no history recorded, skipping...')
+            continue
         histories[column_name], constant_attributes[column_name] = states_to_histories(
             hass,
             column_name,
-            state_changes)
-
+            state_changes[entity_id],
+            window_attributes[entity_id])
 
     dynamo_data = histories_to_dynamo_data(hass, histories, constant_attributes, user_hash,
                                            heat_pump_power_entity_id, postcode, tariff)
     return dynamo_data
 
 
+def get_data_bounds(hass, entity_ids, start_time):
+    """Get the last_updated date of the first and last state of each entity_id after start_time.
+
+    Only the first and last row of each entity is read from the recorder (limited ascending and
+    descending queries on the metadata_id/last_updated_ts index) rather than every state.  Must be
+    run in the recorder executor.
+    Entities without any recorded states are left out of the returned dict.
+    """
+    start_time_ts = start_time.timestamp()
+    bounds = {}
+    with session_scope(hass=hass, read_only=True) as session:
+        entity_id_to_metadata_id = get_instance(hass).states_meta_manager.get_many(
+            entity_ids,
+            session,
+            False)
+        for entity_id, metadata_id in entity_id_to_metadata_id.items():
+            if metadata_id is None:
+                continue
+            query = (
+                select(States.last_updated_ts)
+                .filter(States.metadata_id == metadata_id)
+                .filter(States.last_updated_ts > start_time_ts))
+            earliest_ts = session.execute(
+                query.order_by(States.last_updated_ts.asc()).limit(1)).scalar()
+            latest_ts = session.execute(
+                query.order_by(States.last_updated_ts.desc()).limit(1)).scalar()
+            if earliest_ts is None or latest_ts is None:
+                continue
+            bounds[entity_id] = (
+                datetime.fromtimestamp(earliest_ts, tz=timezone.utc),
+                datetime.fromtimestamp(latest_ts, tz=timezone.utc))
+    return bounds
+
+
 async def get_earliest_and_latest_data_dates(hass, climate_entity_id, heat_pump_power_entity_id,
                                              external_temp_entity_id):
     """For each entity id find the earliest date that data has been recorded and the latest date.
 
-    Does not check further back than const.DYNAMO_HISTORY_DAYS (5 years).
+    Does not check further back than const.DYNAMO_HISTORY_DAYS (2 years).
+    Columns without any recorded data are left out.
     """
     entity_id_to_column_name = {
         climate_entity_id: const.DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY,
         heat_pump_power_entity_id: const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER,
         external_temp_entity_id: const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE}
 
-    earliest_dates = {}
-    latest_dates = {}
+    active_entity_ids = []
     for entity_id in entity_id_to_column_name:
         if entity_id is None:
             LOGGER.debug(f'({entity_id_to_column_name[entity_id]}) entity missing, skipping...')
             continue
-        state_changes = await get_state_changes(hass, entity_id, const.DYNAMO_HISTORY_DAYS)
-        earliest_dates[entity_id_to_column_name[entity_id]] = state_changes[0].last_updated
-        latest_dates[entity_id_to_column_name[entity_id]] = state_changes[-1].last_updated
+        active_entity_ids.append(entity_id)
+    start_time = datetime.now(tz=timezone.utc) - timedelta(days=const.DYNAMO_HISTORY_DAYS)
+    bounds = await get_instance(hass).async_add_executor_job(
+        get_data_bounds,
+        hass,
+        active_entity_ids,
+        start_time)
+
+    earliest_dates = {}
+    latest_dates = {}
+    for entity_id in active_entity_ids:
+        if entity_id not in bounds:
+            LOGGER.debug(f'({entity_id_to_column_name[entity_id]}) no history recorded, skipping...')
+            continue
+        column = entity_id_to_column_name[entity_id]
+        earliest_dates[column], latest_dates[column] = bounds[entity_id]
     return earliest_dates, latest_dates
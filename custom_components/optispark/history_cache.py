@@ -0,0 +1,498 @@
+"""On disk cache of the normalised history.
+
+Every page of history read from the recorder is normalised into a HistoryFrame and appended to the
+cache as a segment, so it never has to be read from the recorder again (not even after a restart).
+
+Layout, one directory per config entry:
+    .storage/optispark/<entry_id>/index.json: the segments of each column
+    .storage/optispark/<entry_id>/<segment>.npy: timestamp/value/label_id/attribute_id records
+    .storage/optispark/<entry_id>/<segment>.json: labels and attributes side tables
+Segments are written once.  At the end of each upload round runs of contiguous segments are merged
+(up to const.HISTORY_CACHE_SEGMENT_READINGS readings) and index.json is written, so a page doesn't
+cost a rewrite of the index.  Only history that still has to be uploaded is worth keeping:
+segments are removed once dynamo holds all their readings (they are skipped by the upload journal
+from then on), when they fall out of const.DYNAMO_HISTORY_DAYS, and, oldest first, when a column
+holds more than const.HISTORY_CACHE_MAX_READINGS readings.
+They are memory mapped when read so only the requested readings are loaded.
+"""
+
+import asyncio
+import bisect
+import json
+import os
+import shutil
+from operator import attrgetter
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from homeassistant.helpers.json import save_json
+
+from .const import LOGGER
+from . import const
+from .history import HistoryFrame, HistoryPage, datetime_to_epoch_us, epoch_us_to_datetime
+
+INDEX_VERSION = 1
+SEGMENT_DTYPE = np.dtype([
+    ('timestamp', np.int64),
+    ('value', np.float64),
+    ('label_id', np.int32),
+    ('attribute_id', np.int32)])
+_start_us = attrgetter('start_us')
+_end_us = attrgetter('end_us')
+
+
+def history_cache_path(hass, entry_id):
+    """Directory of the history cache of a config entry."""
+    return hass.config.path('.storage', const.DOMAIN, entry_id)
+
+
+async def async_remove_history_cache(hass, entry_id):
+    """Delete the history cache of a config entry."""
+    await hass.async_add_executor_job(shutil.rmtree, history_cache_path(hass, entry_id), True)
+
+
+def insert_segment(segments, segment):
+    """Insert segment in the sorted segments, unless it overlaps one of them."""
+    index = bisect.bisect_right(segments, segment.start_us, key=_start_us)
+    if index > 0 and segment.start_us < segments[index - 1].end_us - 1:
+        return False
+    if index < len(segments) and segments[index].start_us < segment.end_us - 1:
+        return False
+    segments.insert(index, segment)
+    return True
+
+
+class HistorySegment:
+    """Normalised readings of one column read from a single recorder window.
+
+    start_us and end_us are the exclusive bounds of the window in microseconds since the epoch.
+    Every reading the recorder had inside the window is in the segment, so the segment can stand in
+    for the recorder anywhere inside it.  Consecutive pages give contiguous segments: the next one
+    starts 1 µs before the end of the previous one.
+    """
+
+    def __init__(self, name, start_us, end_us, count):
+        """Init."""
+        self.name = name
+        self.start_us = start_us
+        self.end_us = end_us
+        self.count = count
+
+    def to_json(self):
+        """Entry in index.json."""
+        return {'name': self.name, 'start_us': self.start_us, 'end_us': self.end_us, 'count': self.count}
+
+    @classmethod
+    def from_json(cls, data):
+        """Segment from its entry in index.json."""
+        return cls(data['name'], data['start_us'], data['end_us'], data['count'])
+
+
+class HistoryCache:
+    """Persistent, per config entry, cache of the normalised history of each column.
+
+    columns maps each column to the entity_id it is read from.  Columns whose entity has changed
+    since the cache was written are dropped.
+    The segments of each column are sorted and don't overlap, so they are looked up with a binary
+    search on start_us (or end_us, which is sorted too).
+    The index is only modified on the event loop, all file access happens in the executor.
+    """
+
+    def __init__(self, hass, entry_id, columns):
+        """Init."""
+        self.hass = hass
+        self.path = history_cache_path(hass, entry_id)
+        self.columns = columns
+        self.loaded = False
+        self.segments = {column: [] for column in columns}
+        self.next_segment = 0
+        self.index_dirty = False  # The segments have changed since index.json was written
+        self.flush_lock = asyncio.Lock()
+
+    def segment_path(self, name, suffix):
+        """Path of a segment file."""
+        return os.path.join(self.path, name + suffix)
+
+    def index_json(self):
+        """Snapshot of the index to be written to index.json."""
+        return {
+            'version': INDEX_VERSION,
+            'next_segment': self.next_segment,
+            'columns': {
+                column: {
+                    'entity_id': self.columns[column],
+                    'segments': [segment.to_json() for segment in self.segments[column]]}
+                for column in self.columns}}
+
+    def _read_index(self, index_path):
+        """Content of index.json, None if there is no usable index.
+
+        Must be run in the executor.
+        """
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, encoding='utf-8') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            LOGGER.warn(f'History cache index ({index_path}) is unreadable, starting again')
+            return None
+        if index.get('version') != INDEX_VERSION:
+            return None
+        return index
+
+    def _load(self):
+        """Read index.json, dropping stale columns, expired or overlapping segments.
+
+        Segment files that aren't in the index (e.g. written just before a crash) are removed.
+        Returns the next segment number and the segments of each column, for async_load to
+        install on the event loop.
+        Must be run in the executor.
+        """
+        next_segment = 0
+        segments_by_column = {column: [] for column in self.columns}
+        if not os.path.isdir(self.path):
+            return next_segment, segments_by_column
+        index = self._read_index(os.path.join(self.path, 'index.json'))
+        if index is not None:
+            next_segment = index['next_segment']
+            expiry_us = datetime_to_epoch_us(
+                datetime.now(tz=timezone.utc) - timedelta(days=const.DYNAMO_HISTORY_DAYS))
+            for column, cached in index['columns'].items():
+                if cached['entity_id'] != self.columns.get(column):
+                    LOGGER.debug(f'({column}) entity changed, dropping cached history')
+                    continue
+                segments = sorted(
+                    (HistorySegment.from_json(segment) for segment in cached['segments']),
+                    key=_start_us)
+                for segment in segments:
+                    if segment.end_us > expiry_us:
+                        # Overlapping segments (from before they were rejected) are dropped
+                        insert_segment(segments_by_column[column], segment)
+        kept = {segment.name for segments in segments_by_column.values() for segment in segments}
+        for file_name in os.listdir(self.path):
+            if file_name != 'index.json' and file_name.partition('.')[0] not in kept:
+                os.remove(os.path.join(self.path, file_name))
+        LOGGER.debug(f'History cache loaded: { {column: len(segments) for column, segments in segments_by_column.items()} } segments')
+        return next_segment, segments_by_column
+
+    async def async_load(self):
+        """Load the index from disk."""
+        self.next_segment, self.segments = await self.hass.async_add_executor_job(self._load)
+        self.loaded = True
+
+    def find_segment(self, column, start_time, end_time, descending):
+        """Cached segment that continues the (start_time, end_time) window, None if there is none.
+
+        The segment must hold the start of the window (the end if descending) and reach further
+        into it than that, otherwise the window can't be advanced with it.
+        """
+        segments = self.segments[column]
+        if descending:
+            end_us = datetime_to_epoch_us(end_time)
+            # First segment that reaches the end of the window
+            index = bisect.bisect_left(segments, end_us, key=_end_us)
+            if index < len(segments) and segments[index].start_us + 1 < end_us:
+                return segments[index]
+        else:
+            start_us = datetime_to_epoch_us(start_time)
+            # Last segment that starts at or before the start of the window
+            index = bisect.bisect_right(segments, start_us, key=_start_us) - 1
+            if index >= 0 and start_us < segments[index].end_us - 1:
+                return segments[index]
+        return None
+
+    def clip_window(self, column, start_time, end_time, descending):
+        """Shrink the window so that it stops at the nearest cached segment.
+
+        Only the part of the window that isn't cached then needs reading from the recorder.
+        Returns (start_time, end_time, clipped).
+        """
+        segments = self.segments[column]
+        start_us = datetime_to_epoch_us(start_time)
+        end_us = datetime_to_epoch_us(end_time)
+        if descending:
+            # Last segment that ends inside the window.  Readings at segment.end_us aren't in the
+            # segment, keep them in the window
+            index = bisect.bisect_left(segments, end_us, key=_end_us) - 1
+            if index >= 0 and start_us < segments[index].end_us - 1:
+                return epoch_us_to_datetime(segments[index].end_us - 1), end_time, True
+        else:
+            # First segment that starts inside the window
+            index = bisect.bisect_right(segments, start_us, key=_start_us)
+            if index < len(segments) and segments[index].start_us + 1 < end_us:
+                return start_time, epoch_us_to_datetime(segments[index].start_us + 1), True
+        return start_time, end_time, False
+
+    def _read_frame(self, name, start_us, end_us, descending, page_size):
+        """HistoryFrame of at most page_size readings of a segment within (start_us, end_us).
+
+        The readings are taken from the start of the window (the end if descending).  Returns
+        (frame, constant_attributes, start_us, end_us) with the bounds shrunk to the readings taken,
+        like a recorder page.  Only the requested readings are read from the memory mapped file.
+        Must be run in the executor.
+        """
+        with open(self.segment_path(name, '.json'), encoding='utf-8') as file:
+            side_tables = json.load(file)
+        records = np.load(self.segment_path(name, '.npy'), mmap_mode='r')
+        timestamps = records['timestamp']
+        start = int(np.searchsorted(timestamps, start_us, side='right'))
+        stop = int(np.searchsorted(timestamps, end_us, side='left'))
+        if stop - start > page_size:
+            # The page ends at the first reading it doesn't hold, readings sharing its timestamp are
+            # left for the next page
+            if descending:
+                boundary = int(np.searchsorted(timestamps, timestamps[stop - page_size - 1], side='right'))
+                if boundary < stop:
+                    start, start_us = boundary, int(timestamps[stop - page_size - 1])
+            else:
+                boundary = int(np.searchsorted(timestamps, timestamps[start + page_size], side='left'))
+                if boundary > start:
+                    stop, end_us = boundary, int(timestamps[start + page_size])
+        records = np.array(records[start:stop])
+        labels = side_tables['labels']
+        frame = HistoryFrame(
+            timestamps=records['timestamp'],
+            values=records['value'],
+            labels=labels,
+            label_ids=None if labels is None else records['label_id'],
+            attributes=side_tables['attributes'],
+            attribute_ids=records['attribute_id'])
+        return frame, side_tables['constant_attributes'], start_us, end_us
+
+    async def async_read_page(self, entity_id, column, start_time, end_time, descending, page_size):
+        """Next HistoryPage of the window read from the cache, None if it isn't cached.
+
+        The page holds at most page_size readings and ends no later than the segment does, as if it
+        had been read from the recorder.
+        """
+        segment = self.find_segment(column, start_time, end_time, descending)
+        if segment is None:
+            return None
+        frame, constant_attributes, page_start, page_end = await self.hass.async_add_executor_job(
+            self._read_frame,
+            segment.name,
+            max(segment.start_us, datetime_to_epoch_us(start_time)),
+            min(segment.end_us, datetime_to_epoch_us(end_time)),
+            descending,
+            page_size)
+        if descending:
+            exhausted = page_start == datetime_to_epoch_us(start_time)
+        else:
+            exhausted = page_end == datetime_to_epoch_us(end_time)
+        return HistoryPage(
+            entity_id,
+            epoch_us_to_datetime(page_start),
+            epoch_us_to_datetime(page_end),
+            exhausted,
+            states=None,
+            window_attributes=None,
+            frame=frame,
+            constant_attributes=constant_attributes)
+
+    def _write_records(self, name, records, side_tables):
+        """Write the files of a segment.
+
+        Must be run in the executor.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.segment_path(name, '.npy.tmp'), 'wb') as file:
+            np.save(file, records)
+        os.replace(self.segment_path(name, '.npy.tmp'), self.segment_path(name, '.npy'))
+        save_json(self.segment_path(name, '.json'), side_tables, atomic_writes=True)
+
+    def _write_segment(self, name, frame, constant_attributes):
+        """Must be run in the executor."""
+        records = np.empty(len(frame), dtype=SEGMENT_DTYPE)
+        records['timestamp'] = frame.timestamps
+        records['value'] = frame.values
+        records['label_id'] = -1 if frame.label_ids is None else frame.label_ids
+        records['attribute_id'] = frame.attribute_ids
+        side_tables = {
+            'labels': frame.labels,
+            'attributes': [dict(attributes) for attributes in frame.attributes],
+            'constant_attributes': constant_attributes}
+        self._write_records(name, records, side_tables)
+
+    def new_segment_name(self, column):
+        """Unique name for a segment of column."""
+        name = f'{column}-{self.next_segment:06d}'
+        self.next_segment += 1
+        return name
+
+    def insert_segment(self, column, segment):
+        """Insert segment in the sorted segments of column, unless it overlaps one of them."""
+        return insert_segment(self.segments[column], segment)
+
+    async def async_append(self, column, page):
+        """Append a normalised page (page.frame must be set) to the cache of column.
+
+        Only the segment is written, index.json is written by async_flush at the end of the upload
+        round.  A page that overlaps the cache (read from the recorder while it was being cached)
+        isn't cached again.
+        """
+        segment = HistorySegment(
+            self.new_segment_name(column),
+            datetime_to_epoch_us(page.start_time),
+            datetime_to_epoch_us(page.end_time),
+            len(page.frame))
+        if not self.insert_segment(column, segment):
+            LOGGER.debug(f'({column}) page {page.start_time} - {page.end_time} is already cached')
+            return
+        try:
+            await self.hass.async_add_executor_job(
+                self._write_segment,
+                segment.name,
+                page.frame,
+                page.constant_attributes)
+        except (OSError, TypeError, ValueError) as err:
+            # The cache is only an optimisation, the page will be read from the recorder next time
+            LOGGER.warn(f'({column}) could not write history cache segment: {err}')
+            self.segments[column].remove(segment)
+            return
+        self.index_dirty = True
+
+    def contiguous_runs(self, column):
+        """Runs of contiguous segments of column that can be merged into one segment.
+
+        A run holds at most const.HISTORY_CACHE_SEGMENT_READINGS readings.
+        """
+        runs = []
+        run = []
+        for segment in self.segments[column]:
+            if (run and segment.start_us == run[-1].end_us - 1
+                    and sum(map(attrgetter('count'), run)) + segment.count <= const.HISTORY_CACHE_SEGMENT_READINGS):
+                run.append(segment)
+                continue
+            if len(run) > 1:
+                runs.append(run)
+            run = [segment]
+        if len(run) > 1:
+            runs.append(run)
+        return runs
+
+    def _merge_segments(self, name, names):
+        """Write the segments names as a single segment name, returns its number of readings.
+
+        The side tables are merged and the ids of the readings remapped.  Returns None if the
+        segments can't be merged (labelled and unlabelled readings).
+        Must be run in the executor.
+        """
+        parts = []
+        label_ids = {}
+        labelled = unlabelled = False
+        attributes = []
+        attribute_ids = {}
+        constant_attributes = None
+        for segment_name in names:
+            with open(self.segment_path(segment_name, '.json'), encoding='utf-8') as file:
+                side_tables = json.load(file)
+            records = np.load(self.segment_path(segment_name, '.npy'))
+            if side_tables['labels'] is not None:
+                labelled = True
+                # -1 (no label) indexes the -1 appended to the mapping
+                mapping = [label_ids.setdefault(label, len(label_ids)) for label in side_tables['labels']]
+                records['label_id'] = np.asarray(mapping + [-1], dtype=np.int32)[records['label_id']]
+            elif len(records):
+                unlabelled = True
+            mapping = []
+            for segment_attributes in side_tables['attributes']:
+                key = json.dumps(segment_attributes, sort_keys=True)
+                if key not in attribute_ids:
+                    attribute_ids[key] = len(attributes)
+                    attributes.append(segment_attributes)
+                mapping.append(attribute_ids[key])
+            records['attribute_id'] = np.asarray(mapping + [-1], dtype=np.int32)[records['attribute_id']]
+            if side_tables['constant_attributes'] is not None:
+                # The segments are in time order, the latest constant attributes win
+                constant_attributes = side_tables['constant_attributes']
+            parts.append(records)
+        if labelled and unlabelled:
+            return None
+        records = np.concatenate(parts) if parts else np.empty(0, dtype=SEGMENT_DTYPE)
+        self._write_records(name, records, {
+            'labels': list(label_ids) if labelled else None,
+            'attributes': attributes,
+            'constant_attributes': constant_attributes})
+        return len(records)
+
+    async def async_compact(self):
+        """Merge the runs of contiguous segments, returns the names of the replaced segments."""
+        replaced = []
+        for column, segments in self.segments.items():
+            for run in self.contiguous_runs(column):
+                name = self.new_segment_name(column)
+                try:
+                    count = await self.hass.async_add_executor_job(
+                        self._merge_segments,
+                        name,
+                        [segment.name for segment in run])
+                except (OSError, TypeError, ValueError) as err:
+                    LOGGER.warn(f'({column}) could not merge history cache segments: {err}')
+                    continue
+                index = segments.index(run[0]) if run[0] in segments else -1
+                if count is None or segments[index:index + len(run)] != run:
+                    # The merged files are removed as orphans the next time the cache is loaded
+                    continue
+                segments[index:index + len(run)] = [
+                    HistorySegment(name, run[0].start_us, run[-1].end_us, count)]
+                replaced += [segment.name for segment in run]
+                self.index_dirty = True
+        return replaced
+
+    def evict(self, uploaded=None):
+        """Drop the segments that won't be read again, returns their names.
+
+        uploaded(column, start_us, end_us) tells if dynamo holds every reading of a window, those
+        segments are dropped.  Then the oldest segments of each column are dropped until it holds at
+        most const.HISTORY_CACHE_MAX_READINGS readings.
+        """
+        evicted = []
+        for column, segments in self.segments.items():
+            kept = [
+                segment for segment in segments
+                if uploaded is None or not uploaded(column, segment.start_us, segment.end_us)]
+            readings = sum(segment.count for segment in kept)
+            while readings > const.HISTORY_CACHE_MAX_READINGS:
+                readings -= kept.pop(0).count
+            if len(kept) < len(segments):
+                evicted += [segment.name for segment in segments if segment not in kept]
+                segments[:] = kept
+                self.index_dirty = True
+        if evicted:
+            LOGGER.debug(f'({len(evicted)}) history cache segments evicted')
+        return evicted
+
+    def _write_index(self, index):
+        """Must be run in the executor."""
+        os.makedirs(self.path, exist_ok=True)
+        save_json(os.path.join(self.path, 'index.json'), index, atomic_writes=True)
+
+    def _remove_segments(self, names):
+        """Must be run in the executor."""
+        for name in names:
+            for suffix in ('.npy', '.json'):
+                if os.path.exists(path := self.segment_path(name, suffix)):
+                    os.remove(path)
+
+    async def async_flush(self, uploaded=None):
+        """End of an upload round: merge the contiguous segments, evict and write index.json.
+
+        See evict for uploaded.  Flushes are serialised so the index is written in the order its
+        snapshots are taken.  The segments that were merged or evicted are only removed once the
+        index no longer refers to them.
+        """
+        async with self.flush_lock:
+            replaced = await self.async_compact()
+            replaced += self.evict(uploaded)
+            if self.index_dirty is False:
+                return
+            self.index_dirty = False
+            try:
+                await self.hass.async_add_executor_job(self._write_index, self.index_json())
+            except (OSError, TypeError, ValueError) as err:
+                LOGGER.warn(f'Could not write history cache index: {err}')
+                self.index_dirty = True
+                return
+            if replaced:
+                await self.hass.async_add_executor_job(self._remove_segments, replaced)
@@ -127,7 +127,7 @@ class OptisparkNumber(OptisparkEntity, NumberEntity):
     async def async_set_native_value(self, value: float) -> None:
         """Update the current value."""
         self._native_value = value
-        lambda_args = self.coordinator.lambda_args
+        lambda_args = self.coordinator.requested_lambda_args
         lambda_args[self._lambda_parameter] = self._native_value
         await self.coordinator.async_set_lambda_args(lambda_args)
 
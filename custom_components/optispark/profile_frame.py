@@ -0,0 +1,114 @@
+"""Columnar heating profile with a cached lookup of the current slot."""
+from __future__ import annotations
+
+import math
+import numbers
+import time
+from datetime import datetime
+from decimal import Decimal
+from types import MappingProxyType
+
+import numpy as np
+
+from . import const
+from .history import datetime_to_epoch_us, epoch_us_to_datetime
+
+NO_SLOT_END = np.iinfo(np.int64).max
+
+
+def is_finite_number(value):
+    """Check if value is a finite int, float or Decimal (bools are rejected)."""
+    if isinstance(value, bool) or not isinstance(value, numbers.Real | Decimal):
+        return False
+    try:
+        return math.isfinite(value)
+    except ValueError:
+        # Signalling NaN Decimal
+        return False
+
+
+def validate(lambda_results):
+    """Check the lambda results before they are converted to a ProfileFrame.
+
+    Raises ValueError if a timestamp isn't a datetime, a value isn't a finite number or a column
+    doesn't have a value for each timestamp.  Nothing is coerced, a None would otherwise become a
+    NaN set point.
+    """
+    timestamps = lambda_results[const.LAMBDA_TIMESTAMP]
+    if not all(isinstance(date, datetime) for date in timestamps):
+        raise ValueError(f'Heating profile {const.LAMBDA_TIMESTAMP} has values that are not datetimes')
+    for key in const.LAMBDA_TIME_BASED_KEYS:
+        if len(lambda_results[key]) != len(timestamps):
+            raise ValueError(f'Heating profile {key} has {len(lambda_results[key])} values for '
+                             f'{len(timestamps)} timestamps')
+        if not all(is_finite_number(value) for value in lambda_results[key]):
+            raise ValueError(f'Heating profile {key} has values that are not finite numbers')
+    for key in const.LAMBDA_NON_TIME_BASED_KEYS:
+        if not is_finite_number(lambda_results[key]):
+            raise ValueError(f'Heating profile {key} ({lambda_results[key]!r}) is not a finite number')
+
+
+class ProfileFrame:
+    """Heating profile built once from the lambda results.
+
+    timestamps: sorted int64 microseconds since the epoch
+    columns: {key: float64 array} of the const.LAMBDA_TIME_BASED_KEYS, aligned with timestamps
+    constants: the const.LAMBDA_NON_TIME_BASED_KEYS
+    The slot in use is the latest timestamp strictly in the past.  It is found with a binary search
+    and cached until the next timestamp passes, so most lookups are a comparison of two ints.
+    Raises ValueError (see validate) if lambda_results isn't a usable heating profile.
+    """
+
+    def __init__(self, lambda_results):
+        """Init."""
+        validate(lambda_results)
+        timestamps = np.fromiter(
+            (datetime_to_epoch_us(date) for date in lambda_results[const.LAMBDA_TIMESTAMP]),
+            dtype=np.int64,
+            count=len(lambda_results[const.LAMBDA_TIMESTAMP]))
+        # Stable, so a repeated timestamp keeps its last value like the dict it replaces
+        order = np.argsort(timestamps, kind='stable')
+        self.timestamps = timestamps[order]
+        self.columns = {
+            key: np.asarray(lambda_results[key], dtype=np.float64)[order]
+            for key in const.LAMBDA_TIME_BASED_KEYS}
+        self.constants = {key: float(lambda_results[key]) for key in const.LAMBDA_NON_TIME_BASED_KEYS}
+        # The cached slot is valid while slot_start_us < now_us <= slot_end_us
+        self.slot_start_us = None
+        self.slot_end_us = None
+        self.slot_values = None
+        self.slot_searches = 0
+
+    def __len__(self):
+        """Number of slots."""
+        return len(self.timestamps)
+
+    def find_slot(self, now_us):
+        """Binary search for the slot of now_us and cache its values."""
+        index = int(np.searchsorted(self.timestamps, now_us, side='left')) - 1
+        if index < 0:
+            raise ValueError('None of the heating profile timestamps have been reached')
+        self.slot_searches += 1
+        self.slot_start_us = int(self.timestamps[index])
+        self.slot_end_us = int(self.timestamps[index + 1]) if index + 1 < len(self.timestamps) else NO_SLOT_END
+        values = {key: float(column[index]) for key, column in self.columns.items()}
+        values.update(self.constants)
+        self.slot_values = MappingProxyType(values)
+
+    def values_at(self, now_us=None) -> MappingProxyType:
+        """Values of the slot in use at now_us (default now).
+
+        The same read only view is returned for as long as the slot lasts.
+        """
+        if now_us is None:
+            now_us = time.time_ns() // 1000
+        if self.slot_values is None or not self.slot_start_us < now_us <= self.slot_end_us:
+            self.find_slot(now_us)
+        return self.slot_values
+
+    def next_timestamp(self, now):
+        """First timestamp after the datetime now, None if there is none."""
+        index = int(np.searchsorted(self.timestamps, datetime_to_epoch_us(now), side='right'))
+        if index == len(self.timestamps):
+            return None
+        return epoch_us_to_datetime(int(self.timestamps[index]))
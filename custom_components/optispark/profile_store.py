@@ -0,0 +1,76 @@
+"""Persisted copy of the last heating profile fetched from the lambda.
+
+Lets the handler serve the entities straight away after a restart, instead of waiting for the
+lambda before the first update.
+"""
+
+from datetime import datetime, timezone
+
+from homeassistant.helpers.storage import Store
+
+from .const import LOGGER
+from . import const
+from .history import datetime_to_epoch_us, epoch_us_to_datetime
+
+STORAGE_VERSION = 1
+
+
+def profile_store_key(entry_id):
+    """Store key of the heating profile of a config entry."""
+    return f'{const.DOMAIN}.{entry_id}.profile'
+
+
+class ProfileStore:
+    """Last heating profile and when it expires, stored with Home Assistant's Store helper.
+
+    Only the values that get_closest_time reads are stored.  Timestamps are stored as microseconds
+    since the epoch and values as floats (the lambda may return Decimals).
+    """
+
+    def __init__(self, hass, entry_id):
+        """Init."""
+        self.store = Store(hass, STORAGE_VERSION, profile_store_key(entry_id))
+        self.loaded = False
+
+    async def async_load(self):
+        """Load the heating profile.
+
+        Returns (lambda_results, expire_time), or None if there is no profile that can still be
+        served: it has expired, or none of its timestamps have been reached yet.
+        """
+        data = await self.store.async_load()
+        self.loaded = True
+        if data is None:
+            return None
+        try:
+            expire_time = epoch_us_to_datetime(data['expire_time'])
+            lambda_results = {
+                const.LAMBDA_TIMESTAMP: [
+                    epoch_us_to_datetime(epoch_us) for epoch_us in data[const.LAMBDA_TIMESTAMP]]}
+            for key in const.LAMBDA_TIME_BASED_KEYS + const.LAMBDA_NON_TIME_BASED_KEYS:
+                lambda_results[key] = data[key]
+        except (KeyError, TypeError, ValueError) as err:
+            LOGGER.warn(f'Persisted heating profile is unreadable, ignoring it: {err!r}')
+            return None
+        now = datetime.now(tz=timezone.utc)
+        if expire_time <= now or not any(date < now for date in lambda_results[const.LAMBDA_TIMESTAMP]):
+            LOGGER.debug(f'Persisted heating profile is out of date (expired {expire_time})')
+            return None
+        LOGGER.debug(f'Persisted heating profile restored, expires {expire_time}')
+        return lambda_results, expire_time
+
+    async def async_save(self, lambda_results, expire_time):
+        """Write the heating profile."""
+        data = {
+            'expire_time': datetime_to_epoch_us(expire_time),
+            const.LAMBDA_TIMESTAMP: [
+                datetime_to_epoch_us(date) for date in lambda_results[const.LAMBDA_TIMESTAMP]]}
+        for key in const.LAMBDA_TIME_BASED_KEYS:
+            data[key] = [float(value) for value in lambda_results[key]]
+        for key in const.LAMBDA_NON_TIME_BASED_KEYS:
+            data[key] = float(lambda_results[key])
+        await self.store.async_save(data)
+
+    async def async_remove(self):
+        """Delete the heating profile."""
+        await self.store.async_remove()
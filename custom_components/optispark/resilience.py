@@ -0,0 +1,110 @@
+"""Retry policies and circuit breaker for the calls to the lambda.
+
+Failures that may be temporary (timeouts, connection errors, throttling and server errors) are
+retried with exponential backoff and full jitter, so a fleet of clients that failed together
+doesn't retry together.  The circuit breaker stops calls altogether while the backend keeps
+failing, and lets a single probe through once it has had time to recover.
+"""
+
+import random
+import time
+
+from .const import LOGGER
+
+
+class RetryPolicy:
+    """How often, and how far apart, the calls of one operation type are attempted."""
+
+    def __init__(self, attempts, base_delay, max_delay, max_total):
+        """Init.
+
+        attempts: total number of attempts, including the first
+        base_delay: seconds, the backoff before the first retry is at most this long
+        max_delay: seconds, the backoff is capped at this
+        max_total: seconds, the attempts and backoffs of one call take at most this long
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total = max_total
+
+    def delay(self, retry, rng=random):
+        """Seconds to wait before retry number retry (1 for the first retry), with full jitter."""
+        return rng.uniform(0, min(self.max_delay, self.base_delay * 2**(retry - 1)))
+
+
+class CircuitBreaker:
+    """Fail calls fast while the backend is failing.
+
+    closed: calls go through.  failure_threshold consecutive failures open the breaker.
+    open: calls are refused until reset_timeout (jittered up to 50% longer) has passed.
+    half open: a single probe call goes through, its success closes the breaker and its failure
+        opens it again.  Other calls are refused while the probe is in flight.
+    Concurrent calls that fail together are one failure: a failure only counts if nothing has been
+    recorded since its call was let through (see generation).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half open'
+
+    def __init__(self, failure_threshold, reset_timeout, rng=random):
+        """Init."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.rng = rng
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.calls_refused = 0
+        self.generation = 0  # Moves on whenever a success or a failure is recorded
+
+    def allow_request(self):
+        """Check if a call may go ahead, moving an open breaker to half open when it is time."""
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            LOGGER.debug('Circuit breaker half open, probing the backend')
+            self.state = self.HALF_OPEN
+            return True
+        if self.state == self.CLOSED:
+            return True
+        self.calls_refused += 1
+        return False
+
+    def retry_after(self):
+        """Seconds until the breaker lets a probe through."""
+        return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        """The backend answered."""
+        if self.state != self.CLOSED:
+            LOGGER.info('Backend recovered, circuit breaker closed')
+        self.state = self.CLOSED
+        self.failures = 0
+        self.generation += 1
+
+    def record_failure(self, generation=None):
+        """The backend failed, or didn't answer.
+
+        generation is the breaker's generation when the call was let through.  The failure is
+        ignored if another outcome has been recorded since, i.e. the call ran concurrently with one
+        that has already been counted.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self.generation += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                LOGGER.warning(f'Backend failing ({self.failures}) times in a row, circuit breaker '
+                               f'open for {self.reset_timeout} s')
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + self.reset_timeout * self.rng.uniform(1, 1.5)
+
+    def release(self):
+        """The call ended without telling us anything about the backend (e.g. it was cancelled).
+
+        A probe in flight is given up, the next call becomes the probe.
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.open_until = time.monotonic()
@@ -0,0 +1,108 @@
+"""Snapshot of the heat pump's inputs, read from the state machine once per coordinator tick."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+from homeassistant.components.climate import ClimateEntityFeature
+from homeassistant.const import ATTR_SUPPORTED_FEATURES, ATTR_UNIT_OF_MEASUREMENT
+
+from .const import LOGGER
+from .history import POWER_UNIT_CONVERSIONS, TEMPERATURE_UNIT_CONVERSIONS
+
+# (entity_id, unit) pairs already reported, snapshots are taken every tick so each is logged once
+_reported_units: set[tuple[str, str | None]] = set()
+
+
+class InputSnapshot(NamedTuple):
+    """Inputs of a coordinator tick.
+
+    Temperatures are in °C and power in kW.  A value is None if its entity has no usable state.
+    target_temp is target_temp_low if the heat pump works with a temperature range.
+    """
+
+    taken: datetime
+    internal_temp: float | None
+    target_temp: float | None
+    supported_features: int
+    heat_pump_power_usage: float | None
+    external_temp: float | None
+
+    def update_inputs(self):
+        """The inputs read by an update (lambda_args and the heat pump's target temperature).
+
+        The power and external temperature are only shown by the sensors.
+        """
+        return self.internal_temp, self.target_temp, self.supported_features
+
+
+def _parse_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def convert(value, unit, conversions, name, entity_id) -> float | None:
+    """Convert value from unit with conversions (keyed by unit), None if it isn't a number.
+
+    An unsupported unit is logged the first time it is seen for entity_id.
+    """
+    if (value := _parse_float(value)) is None:
+        return None
+    if unit not in conversions:
+        if (entity_id, unit) not in _reported_units:
+            _reported_units.add((entity_id, unit))
+            LOGGER.error(f'{name} ({entity_id}) does not use supported unit({unit})')
+        return None
+    return conversions[unit](value)
+
+
+def sensor_value(state, conversions, name) -> float | None:
+    """Value of a sensor state converted from its unit of measurement."""
+    if state is None:
+        return None
+    return convert(
+        state.state, state.attributes.get(ATTR_UNIT_OF_MEASUREMENT), conversions, name, state.entity_id)
+
+
+def take_snapshot(hass, climate_entity_id, heat_pump_power_entity_id,
+                  external_temp_entity_id) -> InputSnapshot:
+    """Read the inputs from hass.states.
+
+    Climate attributes are recorded in the unit set by the user (see history.climate_history),
+    sensors in their own unit of measurement.
+    """
+    climate_state = hass.states.get(climate_entity_id)
+    if climate_state is not None:
+        attributes = climate_state.attributes
+        unit = hass.config.units.temperature_unit
+        supported_features = attributes.get(ATTR_SUPPORTED_FEATURES, 0)
+        if supported_features & ClimateEntityFeature.TARGET_TEMPERATURE_RANGE:
+            target_temp = attributes.get('target_temp_low')
+        else:
+            target_temp = attributes.get('temperature')
+        internal_temp = convert(
+            attributes.get('current_temperature'), unit, TEMPERATURE_UNIT_CONVERSIONS, 'Heat pump',
+            climate_entity_id)
+        target_temp = convert(
+            target_temp, unit, TEMPERATURE_UNIT_CONVERSIONS, 'Heat pump', climate_entity_id)
+    else:
+        supported_features = 0
+        internal_temp = target_temp = None
+    external_temp = None
+    if external_temp_entity_id is not None:
+        external_temp = sensor_value(
+            hass.states.get(external_temp_entity_id),
+            TEMPERATURE_UNIT_CONVERSIONS,
+            'External temperature sensor')
+    return InputSnapshot(
+        taken=datetime.now(tz=timezone.utc),
+        internal_temp=internal_temp,
+        target_temp=target_temp,
+        supported_features=supported_features,
+        heat_pump_power_usage=sensor_value(
+            hass.states.get(heat_pump_power_entity_id),
+            POWER_UNIT_CONVERSIONS,
+            'Heat pump'),
+        external_temp=external_temp)
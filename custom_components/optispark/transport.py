@@ -0,0 +1,44 @@
+"""Transports that carry the API client's requests to the lambda.
+
+A transport only has to implement request(), so the client can be pointed at something other than
+the real lambda over Home Assistant's aiohttp session, e.g. the in-process stand-in in
+script/lambda_standin.py for offline benchmarks.
+"""
+from __future__ import annotations
+
+import aiohttp
+
+
+class TransportResponse:
+    """Status, content type and body of a response.
+
+    The Content-Encoding of the body has already been undone.
+    """
+
+    def __init__(self, status: int, content_type: str, body: bytes):
+        """Init."""
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+
+class AiohttpTransport:
+    """Send requests with an aiohttp session, normally Home Assistant's shared session."""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        """Init."""
+        self.session = session
+
+    async def request(self, method, url, data=None, json=None, headers=None) -> TransportResponse:
+        """Send a request and read the whole response.
+
+        data is sent as the raw body, json (if data is None) is serialised to a json body.
+        """
+        async with self.session.request(
+            method=method,
+            url=url,
+            data=data,
+            json=json,
+            headers=headers,
+        ) as response:
+            return TransportResponse(response.status, response.content_type, await response.read())
@@ -0,0 +1,158 @@
+"""Durable journal of the history uploads that dynamo has acknowledged.
+
+Lets the handler resume an interrupted upload after a restart without asking dynamo where it got
+to, and without re-sending the batches that had already been acknowledged.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from homeassistant.helpers.storage import Store
+
+from .const import LOGGER
+from . import const
+from .history import datetime_to_epoch_us, epoch_us_to_datetime
+
+STORAGE_VERSION = 1
+
+
+def upload_journal_key(entry_id):
+    """Store key of the upload journal of a config entry."""
+    return f'{const.DOMAIN}.{entry_id}.upload_journal'
+
+
+class UploadJournal:
+    """Upload progress of each column, stored with Home Assistant's Store helper.
+
+    newest_watermarks/oldest_watermarks: the committed watermarks (see LambdaUpdateHandler)
+    acknowledged: {column: [[start_us, end_us], ...]} the (exclusive) windows of batches that
+        dynamo has acknowledged but that aren't behind the watermarks yet, e.g. batches that
+        finished ahead of an earlier batch that failed.  Overlapping windows are merged.
+    reconciled: when the watermarks were last reset from the dates in dynamo
+    Writes are delayed by const.UPLOAD_JOURNAL_SAVE_DELAY seconds so that a burst of batches is
+    saved once.  Pending writes are flushed when Home Assistant stops.
+    """
+
+    def __init__(self, hass, entry_id):
+        """Init."""
+        self.store = Store(hass, STORAGE_VERSION, upload_journal_key(entry_id))
+        self.loaded = False
+        self.newest_watermarks = {}
+        self.oldest_watermarks = {}
+        self.acknowledged = {}
+        self.reconciled = None
+
+    async def async_load(self):
+        """Load the journal."""
+        data = await self.store.async_load() or {}
+        self.newest_watermarks = {
+            column: epoch_us_to_datetime(epoch_us)
+            for column, epoch_us in data.get('newest_watermarks', {}).items()}
+        self.oldest_watermarks = {
+            column: None if epoch_us is None else epoch_us_to_datetime(epoch_us)
+            for column, epoch_us in data.get('oldest_watermarks', {}).items()}
+        self.acknowledged = {
+            column: [tuple(window) for window in windows]
+            for column, windows in data.get('acknowledged', {}).items()}
+        if data.get('reconciled') is not None:
+            self.reconciled = epoch_us_to_datetime(data['reconciled'])
+        self.loaded = True
+        LOGGER.debug(f'Upload journal loaded: { {column: len(windows) for column, windows in self.acknowledged.items()} } acknowledged batches ahead of the watermarks')
+
+    def data_to_save(self):
+        """Contents of the store."""
+        return {
+            'newest_watermarks': {
+                column: datetime_to_epoch_us(date) for column, date in self.newest_watermarks.items()},
+            'oldest_watermarks': {
+                column: None if date is None else datetime_to_epoch_us(date)
+                for column, date in self.oldest_watermarks.items()},
+            'acknowledged': {
+                column: [list(window) for window in windows]
+                for column, windows in self.acknowledged.items()},
+            'reconciled': None if self.reconciled is None else datetime_to_epoch_us(self.reconciled)}
+
+    def save(self):
+        """Schedule a write of the journal."""
+        self.store.async_delay_save(self.data_to_save, const.UPLOAD_JOURNAL_SAVE_DELAY)
+
+    def has_watermarks(self, columns):
+        """Check if the journal holds the watermarks of every column."""
+        return all(column in self.newest_watermarks for column in columns)
+
+    def needs_reconcile(self, columns):
+        """Check if the watermarks should be reset from the dates in dynamo.
+
+        Only needed if the journal doesn't know every column, or once every
+        const.UPLOAD_JOURNAL_RECONCILE_HOURS in case dynamo has changed behind our back.
+        """
+        if not self.has_watermarks(columns) or self.reconciled is None:
+            return True
+        return datetime.now(tz=timezone.utc) - self.reconciled > timedelta(
+            hours=const.UPLOAD_JOURNAL_RECONCILE_HOURS)
+
+    def acknowledge(self, column, start_time, end_time):
+        """Record that every reading of column within the (exclusive) window is in dynamo."""
+        windows = self.acknowledged.setdefault(column, [])
+        windows.append((datetime_to_epoch_us(start_time), datetime_to_epoch_us(end_time)))
+        windows.sort()
+        merged = [windows[0]]
+        for start_us, end_us in windows[1:]:
+            # Windows are exclusive, they are contiguous if this one starts before the last one ends
+            if start_us < merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_us))
+            else:
+                merged.append((start_us, end_us))
+        self.acknowledged[column] = merged
+        self.save()
+
+    def commit(self, newest_watermarks, oldest_watermarks, reconciled=False):
+        """Record the watermarks, dropping the acknowledged windows that are now behind them."""
+        self.newest_watermarks = dict(newest_watermarks)
+        self.oldest_watermarks = dict(oldest_watermarks)
+        if reconciled:
+            self.reconciled = datetime.now(tz=timezone.utc)
+        for column, windows in self.acknowledged.items():
+            if column not in self.newest_watermarks or self.oldest_watermarks.get(column) is None:
+                continue
+            oldest_us = datetime_to_epoch_us(self.oldest_watermarks[column])
+            newest_us = datetime_to_epoch_us(self.newest_watermarks[column])
+            self.acknowledged[column] = [
+                (start_us, end_us) for start_us, end_us in windows
+                if not (start_us + 1 >= oldest_us and end_us - 1 <= newest_us)]
+        self.save()
+
+    def find_acknowledged(self, column, start_time, end_time, descending):
+        """Acknowledged part at the start (end if descending) of the window, None if there is none.
+
+        Returns the (exclusive) bounds of a page that can be skipped and whether it exhausts the
+        window, with the same conventions as a page read from the recorder.
+        """
+        start_us = datetime_to_epoch_us(start_time)
+        end_us = datetime_to_epoch_us(end_time)
+        for window_start_us, window_end_us in self.acknowledged.get(column, []):
+            if descending and window_start_us + 1 < end_us <= window_end_us:
+                page_start_us = max(window_start_us, start_us)
+                return epoch_us_to_datetime(page_start_us), end_time, page_start_us == start_us
+            if not descending and window_start_us <= start_us < window_end_us - 1:
+                page_end_us = min(window_end_us, end_us)
+                return start_time, epoch_us_to_datetime(page_end_us), page_end_us == end_us
+        return None
+
+    def is_uploaded(self, column, start_us, end_us):
+        """Check if dynamo holds every reading of the (exclusive) window, from the journal alone.
+
+        The window is uploaded if it is behind the committed watermarks or inside an acknowledged
+        window.
+        """
+        if column in self.newest_watermarks and self.oldest_watermarks.get(column) is not None:
+            oldest_us = datetime_to_epoch_us(self.oldest_watermarks[column])
+            newest_us = datetime_to_epoch_us(self.newest_watermarks[column])
+            if start_us + 1 >= oldest_us and end_us - 1 <= newest_us:
+                return True
+        return any(
+            window_start_us <= start_us and end_us <= window_end_us
+            for window_start_us, window_end_us in self.acknowledged.get(column, []))
+
+    async def async_remove(self):
+        """Delete the journal."""
+        await self.store.async_remove()
@@ -0,0 +1,60 @@
+"""Pipelined upload of history payloads with bounded concurrency."""
+
+import asyncio
+from collections import deque
+
+from .const import LOGGER
+
+
+class UploadScheduler:
+    """Upload payloads concurrently while the next ones are being prepared.
+
+    Up to max_in_flight uploads run at once.  The payloads async iterator (reading the recorder,
+    normalising) is advanced while the uploads are in flight, and isn't advanced any further while
+    max_in_flight uploads are pending (backpressure).
+    Uploads may finish in any order but commit(payload, result) is called in the order the payloads
+    were produced, and only once every earlier payload has been committed.  If an upload fails
+    nothing after it is committed, so watermarks never skip over a failed upload.
+    """
+
+    def __init__(self, upload, commit, max_in_flight):
+        """Init.
+
+        upload: async function(payload) -> result
+        commit: async function(payload, result), called in order
+        """
+        self.upload = upload
+        self.commit = commit
+        self.max_in_flight = max_in_flight
+
+    async def commit_oldest(self, pending):
+        """Wait for the oldest pending upload and commit it."""
+        payload, task = pending.popleft()
+        await self.commit(payload, await task)
+
+    async def run(self, payloads, limit=None):
+        """Upload and commit every payload (at most limit payloads).  Returns the number committed.
+
+        The first failed upload is raised after the uploads still in flight have been cancelled.
+        """
+        pending = deque()
+        count = 0
+        try:
+            async for payload in payloads:
+                pending.append((payload, asyncio.create_task(self.upload(payload))))
+                count += 1
+                while pending and (len(pending) >= self.max_in_flight or pending[0][1].done()):
+                    await self.commit_oldest(pending)
+                if limit is not None and count >= limit:
+                    break
+            while pending:
+                await self.commit_oldest(pending)
+        finally:
+            if pending:
+                LOGGER.debug(f'Cancelling ({len(pending)}) uploads that will not be committed')
+            for _payload, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _payload, task in pending), return_exceptions=True)
+            if hasattr(payloads, 'aclose'):
+                await payloads.aclose()
+        return count
@@ -0,0 +1,276 @@
+"""Local stand-in for the Optispark lambda.
+
+Implements the three operations the API client uses (upload_only,
+get_newest_oldest_data_date_only and get_profile_only) with both the json and the binary
+transport, so the upload and profile paths can be benchmarked and load tested without network
+access.  Latency, lambda cold starts and errors can be injected.
+
+It can be served over HTTP, from the root of the repository:
+    python -m script.lambda_standin --port 8080 --latency 0.05
+and the client pointed at it with OptisparkApiClient(session, lambda_url='http://127.0.0.1:8080/'),
+or it can be used in-process, without sockets, with
+OptisparkApiClient(transport=StandInTransport(LambdaStandIn())).
+
+The stand-in unpickles the request bodies, so anyone who can reach it can run code on the machine.
+It is a development tool, not part of the integration, and only listens on loopback addresses.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import gzip
+import ipaddress
+import json
+import lzma
+import pickle
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+from custom_components.optispark import const
+from custom_components.optispark.api import BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE
+from custom_components.optispark.transport import TransportResponse
+
+COLUMNS = [
+    const.DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY,
+    const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER,
+    const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE]
+DECOMPRESS = {
+    None: lambda body: body,
+    'identity': lambda body: body,
+    'gzip': gzip.decompress,
+    'xz': lzma.decompress}
+
+
+def json_body(obj) -> bytes:
+    """Body of a json request."""
+    return json.dumps(obj).encode('utf-8')
+
+
+class LambdaStandIn:
+    """In memory imitation of the lambda and the dates of the histories it has stored.
+
+    latency: seconds added to every request
+    cold_start: seconds added when no warm instance is free, like a lambda starting a new
+        instance.  Instances go cold after idle_timeout seconds without a request.
+    error_rate: probability of answering with error_status instead of handling the request
+    binary: accept binary requests and answer with a binary body when the request accepts one,
+        otherwise binary requests are rejected with a 415 (like an older backend)
+    encodings: Content-Encodings accepted in binary requests (None for uncompressed), others
+        are rejected with a 415
+    """
+
+    def __init__(self, latency=0.0, cold_start=0.0, idle_timeout=300.0, error_rate=0.0,
+                 error_status=500, binary=True, encodings=(None, 'gzip', 'xz'), seed=None):
+        """Init."""
+        self.latency = latency
+        self.cold_start = cold_start
+        self.idle_timeout = idle_timeout
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.binary = binary
+        self.encodings = set(encodings)
+        self.random = random.Random(seed)
+        self.idle_instances = []  # When each idle instance last finished a request
+        self.dates = {}  # user_hash -> {column: [oldest epoch seconds, newest epoch seconds]}
+        self.requests = Counter()  # operation -> count
+        self.cold_starts = 0
+        self.errors_injected = 0
+        self.bytes_received = 0
+
+    def decode_request(self, headers, body: bytes, decoded=False):
+        """Payload of a request of either transport.
+
+        decoded: the Content-Encoding of the body has already been undone (by the HTTP server)
+        """
+        if headers.get('Content-Type') == BINARY_CONTENT_TYPE:
+            if decoded:
+                return pickle.loads(body)
+            return pickle.loads(DECOMPRESS[headers.get('Content-Encoding')](body))
+        return pickle.loads(gzip.decompress(base64.b64decode(json.loads(body))))
+
+    def encode_response(self, headers, payload) -> TransportResponse:
+        """Binary response if the request accepts one (and binary is enabled), json otherwise."""
+        if self.binary and BINARY_CONTENT_TYPE in headers.get('Accept', ''):
+            return TransportResponse(200, BINARY_CONTENT_TYPE, pickle.dumps(payload))
+        serialised = base64.b64encode(gzip.compress(pickle.dumps(payload))).decode('utf-8')
+        return TransportResponse(
+            200,
+            JSON_CONTENT_TYPE,
+            json.dumps({'serialised_payload': serialised}).encode('utf-8'))
+
+    async def wait_for_instance(self):
+        """Sleep for the latency, and the cold start if no instance is warm."""
+        now = time.monotonic()
+        self.idle_instances = [
+            last_used for last_used in self.idle_instances if now - last_used < self.idle_timeout]
+        if self.idle_instances:
+            self.idle_instances.pop()
+            delay = self.latency
+        else:
+            self.cold_starts += 1
+            delay = self.latency + self.cold_start
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def data_dates(self, user_hash):
+        """Oldest and newest dates stored for each column, as naive UTC datetimes like dynamo."""
+        stored = self.dates.get(user_hash, {})
+        oldest_dates, newest_dates = {}, {}
+        for column in COLUMNS:
+            if column in stored:
+                oldest_dates[column], newest_dates[column] = (
+                    datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+                    for epoch in stored[column])
+            else:
+                oldest_dates[column] = newest_dates[column] = None
+        return {'oldest_dates': oldest_dates, 'newest_dates': newest_dates}
+
+    def upload(self, dynamo_data):
+        """Record the dates of the uploaded histories."""
+        stored = self.dates.setdefault(dynamo_data['user_hash'], {})
+        for column, history in dynamo_data['histories'].items():
+            if not history:
+                continue
+            oldest, newest = float(min(history)), float(max(history))
+            if column in stored:
+                oldest, newest = min(oldest, stored[column][0]), max(newest, stored[column][1])
+            stored[column] = [oldest, newest]
+        return self.data_dates(dynamo_data['user_hash'])
+
+    def profile(self, lambda_args):
+        """A heating profile for today in half hour steps, holding the set point."""
+        start = datetime.now(tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        timestamps = [start + timedelta(minutes=30*step) for step in range(48)]
+        price = [0.15 + 0.15*(16 <= date.hour < 19) for date in timestamps]
+        base_demand = [1.0 + 0.5*(date.hour < 7) for date in timestamps]
+        optimised_demand = [demand*(0.4 if cost > 0.15 else 1.05) for demand, cost in zip(base_demand, price)]
+        results = {
+            const.LAMBDA_TIMESTAMP: timestamps,
+            const.LAMBDA_PRICE: price,
+            const.LAMBDA_BASE_DEMAND: base_demand,
+            const.LAMBDA_OPTIMISED_DEMAND: optimised_demand,
+            const.LAMBDA_TEMP_CONTROLS: [lambda_args[const.LAMBDA_SET_POINT]]*len(timestamps),
+            const.LAMBDA_BASE_COST: sum(d*p for d, p in zip(base_demand, price))/2,
+            const.LAMBDA_OPTIMISED_COST: sum(d*p for d, p in zip(optimised_demand, price))/2}
+        return results, {'success': True, 'error_message': None}
+
+    def handle_payload(self, payload):
+        """Result of the operation requested by payload."""
+        if payload.get('upload_only'):
+            self.requests['upload_only'] += 1
+            return self.upload(payload['dynamo_data'])
+        if payload.get('get_newest_oldest_data_date_only'):
+            self.requests['get_newest_oldest_data_date_only'] += 1
+            return self.data_dates(payload['dynamo_data']['user_hash'])
+        if payload.get('get_profile_only'):
+            self.requests['get_profile_only'] += 1
+            return self.profile(payload)
+        raise ValueError(f'No supported operation in payload keys {sorted(payload)}')
+
+    async def handle(self, headers, body: bytes, decoded=False) -> TransportResponse:
+        """Answer a request, see decode_request for decoded."""
+        self.bytes_received += len(body)
+        await self.wait_for_instance()
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                return TransportResponse(self.error_status, 'text/plain', b'Injected error')
+            if headers.get('Content-Type') == BINARY_CONTENT_TYPE and (
+                    not self.binary or headers.get('Content-Encoding') not in self.encodings):
+                return TransportResponse(415, 'text/plain', b'Unsupported Media Type')
+            try:
+                payload = self.decode_request(headers, body, decoded)
+                result = self.handle_payload(payload)
+            except (KeyError, TypeError, ValueError, pickle.UnpicklingError, OSError, lzma.LZMAError) as err:
+                return TransportResponse(502, 'text/plain', repr(err).encode('utf-8'))
+            return self.encode_response(headers, result)
+        finally:
+            self.idle_instances.append(time.monotonic())
+
+    def stats(self):
+        """Counters of what the stand-in has done."""
+        return {
+            'requests': dict(self.requests),
+            'cold_starts': self.cold_starts,
+            'errors_injected': self.errors_injected,
+            'bytes_received': self.bytes_received}
+
+    async def handle_http(self, request: web.Request) -> web.Response:
+        """Answer a request served over HTTP."""
+        headers = dict(request.headers)
+        # aiohttp has already decompressed gzip, deflate and br bodies
+        decoded = headers.get('Content-Encoding') in ('gzip', 'deflate', 'br')
+        response = await self.handle(headers, await request.read(), decoded)
+        return web.Response(status=response.status, body=response.body, content_type=response.content_type)
+
+    def make_app(self) -> web.Application:
+        """Application that serves the stand-in over HTTP."""
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post('/', self.handle_http)
+        return app
+
+
+class StandInTransport:
+    """Transport that hands requests straight to a LambdaStandIn, without any sockets."""
+
+    def __init__(self, standin: LambdaStandIn):
+        """Init."""
+        self.standin = standin
+
+    async def request(self, method, url, data=None, json=None, headers=None) -> TransportResponse:
+        """Send a request (see transport.AiohttpTransport)."""
+        headers = dict(headers or {})
+        if data is None:
+            data = json_body(json)
+            headers.setdefault('Content-Type', JSON_CONTENT_TYPE)
+        return await self.standin.handle(headers, data)
+
+
+def is_loopback(host):
+    """Check if host only accepts connections from this machine."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    """Serve the stand-in over HTTP, on a loopback address only."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='loopback address to listen on')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--cold-start', type=float, default=0.0, help='seconds added to cold starts')
+    parser.add_argument('--idle-timeout', type=float, default=300.0,
+                        help='seconds before an idle instance goes cold')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of an error response')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--json-only', action='store_true', help='reject binary requests with a 415')
+    parser.add_argument('--gzip-only', action='store_true',
+                        help='reject binary requests that are uncompressed or use xz with a 415')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if not is_loopback(args.host):
+        parser.error(f'refusing to listen on {args.host}, request bodies are unpickled so the '
+                     f'stand-in must only be reachable from this machine')
+    standin = LambdaStandIn(
+        latency=args.latency,
+        cold_start=args.cold_start,
+        idle_timeout=args.idle_timeout,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        binary=not args.json_only,
+        encodings=('gzip',) if args.gzip_only else (None, 'gzip', 'xz'),
+        seed=args.seed)
+    web.run_app(standin.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
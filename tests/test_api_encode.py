@@ -0,0 +1,55 @@
+"""Tests for encoding history frames for DynamoDB."""
+from decimal import Decimal
+
+import numpy as np
+
+from custom_components.optispark.api import (
+    decimal_column,
+    encode_dynamo_data,
+    encode_history,
+    floats_to_decimal,
+)
+from custom_components.optispark.history import HistoryFrame
+
+AWKWARD_FLOATS = [0.1, 0.2 + 0.1, 1 / 3, 1e-7, 123456789.123456789, -0.0, 5e-324, 1.7976931348623157e308, 1e16, 1e22, 20.0]
+
+
+def test_decimal_column_matches_decimal_of_str():
+    """Each element is converted exactly like Decimal(str(x)), including awkward floats."""
+    rng = np.random.default_rng(0)
+    values = AWKWARD_FLOATS + (rng.standard_normal(1000) * 10.0 ** rng.integers(-10, 10, 1000)).tolist()
+    assert decimal_column(values) == [Decimal(str(value)) for value in values]
+    # The same exponent and digits, not only equal values
+    assert [value.as_tuple() for value in decimal_column(values)] == [Decimal(str(value)).as_tuple() for value in values]
+
+
+def test_encode_history_matches_floats_to_decimal():
+    """Numeric frames encode exactly like floats_to_decimal(frame.to_dict())."""
+    timestamps = np.array([1_698_796_800_000_000, 1_698_796_800_123_456, 1_698_796_860_000_001])
+    frame = HistoryFrame(timestamps, AWKWARD_FLOATS[:3])
+    assert encode_history(frame) == floats_to_decimal(frame.to_dict())
+
+
+def test_encode_history_with_labels_and_attributes():
+    """Labelled frames give each reading its own copy of the converted attributes."""
+    frame = HistoryFrame(
+        timestamps=[1_000_000, 2_000_000, 3_000_000],
+        values=[np.nan, np.nan, np.nan],
+        labels=['heat', 'off'],
+        label_ids=[0, 1, 0],
+        attributes=[{'temperature': 20.5, 'hvac_modes': ['heat', 'off']}],
+        attribute_ids=[0, -1, 0])
+    encoded = encode_history(frame)
+    assert encoded == floats_to_decimal(frame.to_dict())
+    first, _second, third = encoded.values()
+    assert first['attributes'] is not third['attributes']
+    assert first['attributes']['temperature'] == Decimal('20.5')
+
+
+def test_encode_dynamo_data_only_encodes_histories_as_frames():
+    """Everything outside histories goes through floats_to_decimal."""
+    frame = HistoryFrame([1_000_000], [1.5])
+    encoded = encode_dynamo_data({'histories': {'power': frame}, 'constant_attributes': {'power': {'x': 0.5}}})
+    assert encoded == {
+        'histories': {'power': {Decimal('1.0'): {'state': Decimal('1.5'), 'attributes': {}}}},
+        'constant_attributes': {'power': {'x': Decimal('0.5')}}}
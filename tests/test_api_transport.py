@@ -0,0 +1,191 @@
+"""Tests for the negotiation between the json wrapped and the binary transports."""
+import asyncio
+import base64
+import gzip
+import json
+import lzma
+import pickle
+from datetime import datetime
+
+import numpy as np
+
+from custom_components.optispark import const
+from custom_components.optispark.api import BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, OptisparkApiClient
+from custom_components.optispark.history import HistoryFrame
+
+DATES = {'oldest_dates': {'climate_entity': datetime(2023, 1, 1)}, 'newest_dates': {'climate_entity': None}}
+
+
+def decompress(body: bytes) -> bytes:
+    """Undo whichever compression the client chose for a request body."""
+    if body.startswith(b'\x1f\x8b'):
+        return gzip.decompress(body)
+    if body.startswith(b'\xfd7zXZ\x00'):
+        return lzma.decompress(body)
+    return body
+
+
+class FakeResponse:
+    """The parts of an aiohttp response used by the client."""
+
+    def __init__(self, status, content_type, body):
+        """Init."""
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+    async def read(self):
+        """Body with the Content-Encoding undone."""
+        return self.body
+
+    async def json(self):
+        """Body parsed as json."""
+        return json.loads(self.body)
+
+    def release(self):
+        """Nothing to release."""
+
+    def raise_for_status(self):
+        """Raise for error statuses."""
+        if self.status >= 400:
+            raise RuntimeError(self.status)
+
+
+class FakeRequest:
+    """Result of session.request(), can be awaited or used as an async context manager."""
+
+    def __init__(self, response):
+        """Init."""
+        self.response = response
+
+    def __await__(self):
+        """Await the response."""
+        async def response():
+            return self.response
+        return response().__await__()
+
+    async def __aenter__(self):
+        """Enter with the response."""
+        return self.response
+
+    async def __aexit__(self, *exc_info):
+        """Nothing to clean up."""
+
+
+class FakeBackend:
+    """aiohttp session standing in for the lambda.
+
+    binary_requests: whether requests with the binary content type are accepted
+    binary_responses: whether a binary response is sent to clients that accept one
+    encodings: Content-Encodings accepted in binary requests (None for uncompressed)
+    """
+
+    def __init__(self, binary_requests=True, binary_responses=True, encodings=(None, 'gzip', 'xz')):
+        """Init."""
+        self.binary_requests = binary_requests
+        self.binary_responses = binary_responses
+        self.encodings = encodings
+        self.requests = []
+        self.payloads = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        """Decode the request and answer it, json bodies are passed as the json keyword."""
+        headers = headers or {}
+        binary = headers.get('Content-Type') == BINARY_CONTENT_TYPE
+        self.requests.append(f'binary {headers.get("Content-Encoding", "identity")}' if binary else 'json')
+        if binary and (not self.binary_requests or headers.get('Content-Encoding') not in self.encodings):
+            return FakeRequest(FakeResponse(415, 'text/plain', b''))
+        if binary:
+            payload = pickle.loads(decompress(data))
+        else:
+            payload = pickle.loads(decompress(base64.b64decode(kwargs['json'])))
+        self.payloads.append(payload)
+        if self.binary_responses and BINARY_CONTENT_TYPE in headers.get('Accept', ''):
+            return FakeRequest(FakeResponse(200, BINARY_CONTENT_TYPE, pickle.dumps(DATES)))
+        body = json.dumps(
+            {'serialised_payload': base64.b64encode(gzip.compress(pickle.dumps(DATES))).decode('utf-8')})
+        return FakeRequest(FakeResponse(200, JSON_CONTENT_TYPE, body.encode()))
+
+
+def get_data_dates(client, times):
+    """Call get_data_dates times, returns the last result."""
+    async def test():
+        for _ in range(times):
+            result = await client.get_data_dates({'user_hash': 'user'})
+        return result
+
+    return asyncio.run(test())
+
+
+def test_switches_to_binary_after_a_binary_response():
+    """The first request is json, the backend's binary answer switches the client to binary."""
+    backend = FakeBackend()
+    client = OptisparkApiClient(backend)
+    oldest_dates, newest_dates = get_data_dates(client, 3)
+    # The date probes are small enough to be sent uncompressed
+    assert backend.requests == ['json', 'binary identity', 'binary identity']
+    assert oldest_dates['climate_entity'].tzinfo is not None
+    assert newest_dates['climate_entity'] is None
+
+
+def test_stays_on_json_with_a_json_backend():
+    """A backend that only answers json keeps the client on json."""
+    backend = FakeBackend(binary_requests=False, binary_responses=False)
+    client = OptisparkApiClient(backend)
+    get_data_dates(client, 2)
+    assert backend.requests == ['json', 'json']
+
+
+def test_falls_back_to_json_on_415():
+    """Binary requests rejected with 415 fall back to gzip then json, and json is used from then on."""
+    backend = FakeBackend()
+    client = OptisparkApiClient(backend)
+    get_data_dates(client, 1)
+    backend.binary_requests = False
+    backend.binary_responses = False
+    oldest_dates, _newest_dates = get_data_dates(client, 2)
+    assert backend.requests == ['json', 'binary identity', 'binary gzip', 'json', 'json']
+    assert oldest_dates['climate_entity'].year == 2023
+
+
+def test_large_uploads_are_encoded_in_the_executor():
+    """Uploads above the threshold are encoded off the event loop, dynamo_data is left as it was."""
+    backend = FakeBackend()
+    client = OptisparkApiClient(backend)
+    count = const.EXECUTOR_ENCODE_MIN_READINGS
+    frame = HistoryFrame(np.arange(count) * 1_000_000, np.arange(count) / 4)
+    dynamo_data = {'user_hash': 'user', 'histories': {'power': frame}}
+
+    async def test():
+        await client.get_data_dates({'user_hash': 'user'})
+        backend.binary_requests = False
+        return await client.upload_history(dynamo_data)
+
+    oldest_dates, _newest_dates = asyncio.run(test())
+    assert oldest_dates['climate_entity'].year == 2023
+    # The 415 fallback encoded the payload again rather than reusing the binary body
+    assert backend.requests[0] == backend.requests[-1] == 'json'
+    assert all(request.startswith('binary') for request in backend.requests[1:-1])
+    assert client.codec_seconds['executor'] > 0
+    assert dynamo_data['histories']['power'] is frame
+    histories = backend.payloads[-1]['dynamo_data']['histories']
+    assert len(histories['power']) == count
+
+
+def test_rejected_encodings_fall_back_to_gzip():
+    """A backend that only gunzips rejects the other encodings once each, gzip is used from then on."""
+    backend = FakeBackend(encodings=('gzip',))
+    client = OptisparkApiClient(backend)
+    get_data_dates(client, 3)
+    assert backend.requests == ['json', 'binary identity', 'binary gzip', 'binary gzip']
+
+
+def test_xz_is_only_measured_off_the_event_loop():
+    """Payloads encoded on the event loop never try xz, large ones encoded in the executor may."""
+    client = OptisparkApiClient(FakeBackend())
+    client.compression_policy.bytes_per_second = 1  # Sending dominates, the best ratio wins
+    data = {'dynamo_data': {'user_hash': 'user'}, 'padding': list(range(10_000))}
+    client.request_arguments(data, ['identity', 'gzip-1', 'gzip-6', 'gzip-9', 'xz'], 'probe', on_event_loop=True)
+    assert ('probe', 'xz') not in client.compression_policy.stats
+    client.request_arguments(data, ['identity', 'gzip-1', 'gzip-6', 'gzip-9', 'xz'], 'probe')
+    assert ('probe', 'xz') in client.compression_policy.stats
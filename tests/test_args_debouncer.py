@@ -0,0 +1,92 @@
+"""Tests for the merging of lambda_args changes by LambdaArgsDebouncer."""
+import asyncio
+from types import SimpleNamespace
+
+from homeassistant.core import HomeAssistant
+
+from custom_components.optispark.args_debouncer import LambdaArgsDebouncer
+from custom_components.optispark.coordinator import OptisparkDataUpdateCoordinator
+
+
+def run_with_hass(tmp_path, test):
+    """Run test(hass) in a Home Assistant instance."""
+    async def main():
+        hass = HomeAssistant(str(tmp_path))
+        try:
+            await test(hass)
+        finally:
+            await hass.async_stop(force=True)
+    asyncio.run(main())
+
+
+def test_burst_is_applied_once_after_the_quiet_period(tmp_path):
+    """A burst of changes is applied once, with the last lambda_args."""
+    async def test(hass):
+        applied = []
+        debouncer = LambdaArgsDebouncer(hass, applied.append, quiet_period=0.1, max_wait=5)
+        for set_point in range(5):
+            debouncer.update({'set_point': set_point})
+            await asyncio.sleep(0.02)
+        assert applied == []
+        await asyncio.sleep(0.2)
+        assert applied == [{'set_point': 4}]
+        assert debouncer.calls_saved == 4
+
+    run_with_hass(tmp_path, test)
+
+
+def test_max_wait_applies_during_continuous_changes(tmp_path):
+    """Changes that never go quiet are still applied max_wait after the first one."""
+    async def test(hass):
+        applied = []
+        debouncer = LambdaArgsDebouncer(hass, applied.append, quiet_period=0.1, max_wait=0.25)
+        for set_point in range(10):
+            debouncer.update({'set_point': set_point})
+            await asyncio.sleep(0.05)
+        assert 1 <= len(applied) <= 2
+        await asyncio.sleep(0.2)
+        assert applied[-1] == {'set_point': 9}
+
+    run_with_hass(tmp_path, test)
+
+
+def test_cancel_drops_pending_changes(tmp_path):
+    """Nothing is applied after async_cancel."""
+    async def test(hass):
+        applied = []
+        debouncer = LambdaArgsDebouncer(hass, applied.append, quiet_period=0.05, max_wait=1)
+        debouncer.update({'set_point': 1})
+        debouncer.async_cancel()
+        await asyncio.sleep(0.1)
+        assert applied == []
+
+    run_with_hass(tmp_path, test)
+
+
+def test_lambda_args_change_once_settled(tmp_path):
+    """Entities edit copies, the coordinator's lambda_args only change when the burst is applied."""
+    async def test(hass):
+        coordinator = OptisparkDataUpdateCoordinator.__new__(OptisparkDataUpdateCoordinator)
+        coordinator._lambda_args = {'set_point': 20.0, 'temp_range': 2.0}
+        coordinator._lambda_args_debouncer = LambdaArgsDebouncer(
+            hass, coordinator._apply_lambda_args, quiet_period=0.05, max_wait=5)
+        coordinator._lambda_update_handler = SimpleNamespace(manual_update=False)
+        coordinator.async_schedule_update = lambda: None
+        applied = coordinator._lambda_args
+
+        set_point = coordinator.requested_lambda_args
+        set_point['set_point'] = 22.0
+        await coordinator.async_set_lambda_args(set_point)
+        temp_range = coordinator.requested_lambda_args
+        temp_range['temp_range'] = 3.0
+        await coordinator.async_set_lambda_args(temp_range)
+        assert coordinator._lambda_args is applied
+        assert applied == {'set_point': 20.0, 'temp_range': 2.0}
+
+        await asyncio.sleep(0.1)
+        # Neither change was lost by the other
+        assert coordinator._lambda_args == {'set_point': 22.0, 'temp_range': 3.0}
+        assert coordinator._lambda_update_handler.manual_update is True
+        assert applied == {'set_point': 20.0, 'temp_range': 2.0}
+
+    run_with_hass(tmp_path, test)
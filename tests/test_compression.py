@@ -0,0 +1,59 @@
+"""Tests for the choice of payload compression."""
+import gzip
+import lzma
+import pickle
+
+import numpy as np
+
+from custom_components.optispark import const
+from custom_components.optispark.compression import BINARY_CODECS, CODECS, CompressionPolicy
+
+PAYLOAD = pickle.dumps({'power': np.round(np.sin(np.arange(20_000) / 50), 2).tolist()})
+
+
+def decompress(codec, data):
+    """Undo codec."""
+    if codec.content_encoding == 'gzip':
+        return gzip.decompress(data)
+    if codec.content_encoding == 'xz':
+        return lzma.decompress(data)
+    return data
+
+
+def test_small_payloads_use_the_first_candidate():
+    """Payloads below the minimum size aren't measured, the cheapest codec is used."""
+    policy = CompressionPolicy()
+    codec, compressed = policy.compress('probe', BINARY_CODECS, b'x' * (const.COMPRESSION_MIN_BYTES - 1))
+    assert codec.name == BINARY_CODECS[0]
+    assert compressed == b'x' * (const.COMPRESSION_MIN_BYTES - 1)
+    assert policy.decisions == {}
+
+
+def test_fast_uplink_skips_compression():
+    """When sending is free the codec that spends the least time compressing wins."""
+    policy = CompressionPolicy(bytes_per_second=1e18)
+    codec, compressed = policy.compress('upload', BINARY_CODECS, PAYLOAD)
+    assert codec.name == 'identity'
+    assert compressed == PAYLOAD
+
+
+def test_slow_uplink_picks_the_best_ratio():
+    """When sending dominates the codec with the best measured ratio wins, and the result decodes."""
+    policy = CompressionPolicy(bytes_per_second=1)
+    codec, compressed = policy.compress('upload', BINARY_CODECS, PAYLOAD)
+    ratios = {name: policy.stats[('upload', name)].ratio for name in BINARY_CODECS}
+    assert codec.name == min(ratios, key=ratios.get)
+    assert decompress(codec, compressed) == PAYLOAD
+
+
+def test_decision_is_cached_per_payload_type():
+    """The codec is only re-evaluated every const.COMPRESSION_REEVALUATE_EVERY payloads."""
+    policy = CompressionPolicy(bytes_per_second=1)
+    codec, _compressed = policy.compress('upload', BINARY_CODECS, PAYLOAD)
+    key = ('upload', tuple(BINARY_CODECS))
+    assert policy.decisions[key] == [codec.name, const.COMPRESSION_REEVALUATE_EVERY - 1]
+    policy.compress('upload', BINARY_CODECS, PAYLOAD)
+    assert policy.decisions[key][1] == const.COMPRESSION_REEVALUATE_EVERY - 2
+    policy.compress('profile', BINARY_CODECS, PAYLOAD)
+    assert ('profile', tuple(BINARY_CODECS)) in policy.decisions
+    assert set(CODECS) >= set(BINARY_CODECS)
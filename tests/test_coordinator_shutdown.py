@@ -0,0 +1,67 @@
+"""Tests for shutting the coordinator down."""
+import asyncio
+from types import SimpleNamespace
+
+from custom_components.optispark import coordinator as coordinator_module
+from custom_components.optispark.coordinator import OptisparkDataUpdateCoordinator
+
+
+class Counter:
+    """Callable counting its calls."""
+
+    def __init__(self):
+        """Init."""
+        self.calls = 0
+
+    def __call__(self, *_args):
+        """Count the call."""
+        self.calls += 1
+
+
+async def nothing():
+    """Awaitable doing nothing."""
+
+
+def stand_in_coordinator():
+    """Coordinator with only the parts used by async_shutdown and schedule_wakeup."""
+    coordinator = OptisparkDataUpdateCoordinator.__new__(OptisparkDataUpdateCoordinator)
+    coordinator.hass = None
+    coordinator._shutdown_requested = False
+    coordinator._unsub_refresh = None
+    coordinator._unsub_shutdown = None
+    coordinator._debounced_refresh = SimpleNamespace(async_shutdown=nothing)
+    coordinator._shutting_down = False
+    coordinator._switch_enabled = True
+    coordinator._unsub_state_changes = Counter()
+    coordinator._unsub_wakeup = Counter()
+    coordinator._lambda_args_debouncer = SimpleNamespace(async_cancel=Counter())
+    coordinator._lambda_update_handler = SimpleNamespace(async_cancel_backfill=nothing)
+    return coordinator
+
+
+def test_shutdown_is_idempotent():
+    """Listeners are removed once however often async_shutdown is called."""
+    coordinator = stand_in_coordinator()
+    unsub_state_changes = coordinator._unsub_state_changes
+    unsub_wakeup = coordinator._unsub_wakeup
+
+    async def test():
+        await coordinator.async_shutdown()
+        await coordinator.async_shutdown()
+
+    asyncio.run(test())
+    assert unsub_state_changes.calls == 1
+    assert unsub_wakeup.calls == 1
+    assert coordinator._unsub_state_changes is None
+    assert coordinator._unsub_wakeup is None
+
+
+def test_no_wakeup_is_scheduled_after_shutdown(monkeypatch):
+    """A late schedule_wakeup, e.g. from an update that was in flight, doesn't schedule anything."""
+    track = Counter()
+    monkeypatch.setattr(coordinator_module, 'async_track_point_in_utc_time', track)
+    coordinator = stand_in_coordinator()
+    asyncio.run(coordinator.async_shutdown())
+    coordinator.schedule_wakeup()
+    assert track.calls == 0
+    assert coordinator._unsub_wakeup is None
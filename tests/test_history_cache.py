@@ -0,0 +1,195 @@
+"""Tests for the segment lookups, compaction and eviction of HistoryCache."""
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from custom_components.optispark import const
+from custom_components.optispark.history import (
+    HistoryFrame,
+    HistoryPage,
+    datetime_to_epoch_us,
+    epoch_us_to_datetime as dt,
+)
+from custom_components.optispark.history_cache import HistoryCache
+
+COLUMN = 'climate_entity'
+ENTITY_ID = 'climate.heat_pump'
+# Recent enough not to have expired
+BASE_US = datetime_to_epoch_us(datetime.now(tz=timezone.utc) - timedelta(days=1))
+
+
+class Config:
+    """Config of a Home Assistant instance stored in a temporary directory."""
+
+    def __init__(self, config_dir):
+        """Init."""
+        self.config_dir = config_dir
+
+    def path(self, *parts):
+        """Path inside the config directory."""
+        return os.path.join(self.config_dir, *parts)
+
+
+class Hass:
+    """The parts of Home Assistant used by HistoryCache."""
+
+    def __init__(self, config_dir):
+        """Init."""
+        self.config = Config(config_dir)
+
+    async def async_add_executor_job(self, target, *args):
+        """Run target in the default executor."""
+        return await asyncio.get_running_loop().run_in_executor(None, target, *args)
+
+
+def page(start_us, count, label):
+    """Page of count readings, 1 µs apart, starting just after start_us."""
+    timestamps = np.arange(start_us + 1, start_us + 1 + count)
+    frame = HistoryFrame(
+        timestamps,
+        timestamps.astype(float),
+        labels=['heat', label],
+        label_ids=np.arange(count) % 2,
+        attributes=[{'label': label}],
+        attribute_ids=np.zeros(count))
+    return HistoryPage(
+        ENTITY_ID, dt(start_us), dt(start_us + count + 1), False, None, None, frame, {'label': label})
+
+
+async def contiguous_cache(tmp_path, pages=4, count=10):
+    """Cache holding contiguous pages, each one starting 1 µs before the previous one ends."""
+    cache = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+    await cache.async_load()
+    start_us = BASE_US
+    for i in range(pages):
+        await cache.async_append(COLUMN, page(start_us, count, f'mode{i}'))
+        start_us += count
+    return cache
+
+
+def test_lookups(tmp_path):
+    """find_segment and clip_window match the exclusive window conventions."""
+    async def test():
+        cache = await contiguous_cache(tmp_path)
+        segments = cache.segments[COLUMN]
+        assert len(segments) == 4
+        # Ascending: the segment holding the start of the window
+        assert cache.find_segment(COLUMN, dt(BASE_US + 15), dt(BASE_US + 100), False) is segments[1]
+        assert cache.find_segment(COLUMN, dt(BASE_US + 40), dt(BASE_US + 100), False) is None
+        # Descending: the segment reaching the end of the window
+        assert cache.find_segment(COLUMN, dt(BASE_US), dt(BASE_US + 11), True) is segments[0]
+        assert cache.find_segment(COLUMN, dt(BASE_US), dt(BASE_US + 12), True) is segments[1]
+        assert cache.find_segment(COLUMN, dt(BASE_US), dt(BASE_US + 100), True) is None
+        # The uncached part of a window stops at the nearest segment
+        assert cache.clip_window(COLUMN, dt(BASE_US - 50), dt(BASE_US + 100), False) == (
+            dt(BASE_US - 50), dt(BASE_US + 1), True)
+        assert cache.clip_window(COLUMN, dt(BASE_US - 50), dt(BASE_US + 100), True) == (
+            dt(BASE_US + 40), dt(BASE_US + 100), True)
+        assert cache.clip_window(COLUMN, dt(BASE_US + 50), dt(BASE_US + 100), False)[2] is False
+
+    asyncio.run(test())
+
+
+def test_overlapping_page_is_not_cached(tmp_path):
+    """A page overlapping a cached segment is left out of the cache."""
+    async def test():
+        cache = await contiguous_cache(tmp_path, pages=1)
+        await cache.async_append(COLUMN, page(BASE_US + 5, 10, 'overlap'))
+        assert len(cache.segments[COLUMN]) == 1
+
+    asyncio.run(test())
+
+
+def test_flush_merges_contiguous_segments(tmp_path):
+    """Contiguous segments are merged into one, with their side tables, and indexed."""
+    async def test():
+        cache = await contiguous_cache(tmp_path)
+        assert not os.path.exists(os.path.join(cache.path, 'index.json'))
+        await cache.async_flush()
+        assert [segment.count for segment in cache.segments[COLUMN]] == [40]
+        assert sorted(os.listdir(cache.path)) == sorted(
+            [cache.segments[COLUMN][0].name + '.npy', cache.segments[COLUMN][0].name + '.json', 'index.json'])
+
+        restored = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+        await restored.async_load()
+        assert [segment.name for segment in restored.segments[COLUMN]] == [
+            segment.name for segment in cache.segments[COLUMN]]
+        cached = await restored.async_read_page(
+            ENTITY_ID, COLUMN, dt(BASE_US), dt(BASE_US + 41), False, page_size=100)
+        assert cached.exhausted
+        assert cached.frame.timestamps.tolist() == list(range(BASE_US + 1, BASE_US + 41))
+        assert cached.frame.states()[9:12] == ['mode0', 'heat', 'mode1']
+        assert cached.frame.attributes[cached.frame.attribute_ids[35]] == {'label': 'mode3'}
+        assert cached.constant_attributes == {'label': 'mode3'}
+
+    asyncio.run(test())
+
+
+def test_read_page_is_capped_at_page_size(tmp_path):
+    """Pages read from a merged segment hold at most page_size readings."""
+    async def test():
+        cache = await contiguous_cache(tmp_path)
+        await cache.async_flush()
+        ascending = await cache.async_read_page(
+            ENTITY_ID, COLUMN, dt(BASE_US), dt(BASE_US + 41), False, page_size=15)
+        assert len(ascending.frame) == 15
+        assert not ascending.exhausted
+        # The next window starts 1 µs before the end of the page
+        assert ascending.end_time == dt(BASE_US + 16)
+        descending = await cache.async_read_page(
+            ENTITY_ID, COLUMN, dt(BASE_US), dt(BASE_US + 41), True, page_size=15)
+        assert descending.frame.timestamps.tolist() == list(range(BASE_US + 26, BASE_US + 41))
+        assert descending.start_time == dt(BASE_US + 25)
+
+    asyncio.run(test())
+
+
+def test_load_removes_unindexed_segments(tmp_path):
+    """Segment files written after the last index write are removed when the cache is loaded."""
+    async def test():
+        cache = await contiguous_cache(tmp_path, pages=1)
+        await cache.async_flush()
+        await cache.async_append(COLUMN, page(BASE_US + 100, 10, 'unindexed'))
+        restored = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+        await restored.async_load()
+        assert len(restored.segments[COLUMN]) == 1
+        assert len(os.listdir(cache.path)) == 3
+
+    asyncio.run(test())
+
+
+def test_flush_evicts_uploaded_segments(tmp_path):
+    """Segments dynamo already holds are dropped from the index and their files removed."""
+    async def test():
+        cache = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+        await cache.async_load()
+        # Gaps between the pages so they aren't merged
+        for i in range(3):
+            await cache.async_append(COLUMN, page(BASE_US + 100*i, 10, f'mode{i}'))
+        await cache.async_flush(lambda column, start_us, end_us: end_us <= BASE_US + 111)
+        assert [segment.start_us for segment in cache.segments[COLUMN]] == [BASE_US + 200]
+        assert len(os.listdir(cache.path)) == 3
+
+        restored = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+        await restored.async_load()
+        assert [segment.start_us for segment in restored.segments[COLUMN]] == [BASE_US + 200]
+
+    asyncio.run(test())
+
+
+def test_flush_caps_the_readings_of_a_column(tmp_path, monkeypatch):
+    """The oldest segments are dropped once a column holds too many readings."""
+    monkeypatch.setattr(const, 'HISTORY_CACHE_MAX_READINGS', 25)
+
+    async def test():
+        cache = HistoryCache(Hass(str(tmp_path)), 'entry', {COLUMN: ENTITY_ID})
+        await cache.async_load()
+        for i in range(3):
+            await cache.async_append(COLUMN, page(BASE_US + 100*i, 10, f'mode{i}'))
+        await cache.async_flush()
+        assert [segment.start_us for segment in cache.segments[COLUMN]] == [BASE_US + 100, BASE_US + 200]
+        assert len(os.listdir(cache.path)) == 5
+
+    asyncio.run(test())
@@ -0,0 +1,116 @@
+"""Tests for converting recorded sensor states to HistoryFrames."""
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+import pytest
+from homeassistant.const import UnitOfTemperature
+
+from custom_components.optispark import const
+from custom_components.optispark.history import (
+    POWER_UNIT_CONVERSIONS,
+    TEMPERATURE_UNIT_CONVERSIONS,
+    ClimateAttributesCache,
+    normalise_states,
+    parse_states,
+    states_to_histories,
+)
+
+START = datetime(2023, 11, 1, tzinfo=timezone.utc)
+
+
+def state(value, attributes=None, seconds=0, entity_id='sensor.power'):
+    """Stand-in for a recorded state, fetched without attributes unless they are given."""
+    return SimpleNamespace(
+        entity_id=entity_id,
+        state=value,
+        attributes={} if attributes is None else attributes,
+        last_updated=START + timedelta(seconds=seconds))
+
+
+def test_window_attributes_supply_the_unit():
+    """States fetched without attributes are converted with the unit shared by the window."""
+    states = [state('1500', seconds=0), state('500', seconds=60)]
+    frame, constant_attributes = states_to_histories(
+        None, const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER, states, {'unit_of_measurement': 'W'})
+    assert frame.values.tolist() == [1.5, 0.5]
+    assert constant_attributes == {'entity_id': 'sensor.power', 'attributes': {'unit_of_measurement': 'W'}}
+
+
+def test_per_state_attributes_are_used_without_window_attributes():
+    """Without window attributes each state's own unit is used."""
+    states = [
+        state('1500', {'unit_of_measurement': 'W'}, seconds=0),
+        state('1.5', {'unit_of_measurement': 'kW'}, seconds=60)]
+    frame, constant_attributes = states_to_histories(None, const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER, states)
+    assert frame.values.tolist() == [1.5, 1.5]
+    assert constant_attributes['attributes'] == {'unit_of_measurement': 'kW'}
+
+
+def test_external_temperature_with_window_attributes():
+    """The external temperature uses the window unit and rejects units it can't convert."""
+    states = [state('50', seconds=0, entity_id='sensor.outside'), state('', seconds=30, entity_id='sensor.outside')]
+    frame, _constant_attributes = states_to_histories(
+        None, const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE, states, {'unit_of_measurement': '°F'})
+    assert frame.values.tolist() == [10.0]
+    with pytest.raises(ValueError):
+        states_to_histories(
+            None, const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE, states, {'unit_of_measurement': 'K'})
+
+
+def test_climate_attributes_are_converted_once_per_payload():
+    """Repeated and equal payloads are converted once, and the recorder's dicts are left untouched."""
+    cache = ClimateAttributesCache(UnitOfTemperature.FAHRENHEIT)
+    shared = {'current_temperature': '68', 'temperature': 77, 'hvac_modes': ['heat', 'off']}
+    view = cache(shared)
+    assert view['current_temperature'] == 20.0
+    assert view['temperature'] == 25.0
+    assert shared['current_temperature'] == '68'
+    assert cache(shared) is view
+    assert cache(dict(shared)) is view
+    assert (cache.hits, cache.misses) == (2, 1)
+    with pytest.raises(TypeError):
+        view['temperature'] = 0
+
+
+def test_climate_attributes_cache_rejects_unknown_units():
+    """Only °C and °F are supported by the climate converter."""
+    with pytest.raises(ValueError):
+        ClimateAttributesCache('K')
+
+
+def test_parse_states_sets_non_numbers_to_nan():
+    """States that aren't finite numbers are NaN, the rest are parsed as floats."""
+    values = parse_states(['1.5', 'unavailable', '', 'inf', '-2', 'nan', 'unknown'])
+    assert values[0] == 1.5
+    assert values[4] == -2.0
+    assert np.isnan(values[[1, 2, 3, 5, 6]]).all()
+    assert parse_states(['1', '2']).tolist() == [1.0, 2.0]
+
+
+def test_normalise_states_converts_each_unit():
+    """Each state is converted with its own unit, missing and unknown units are rejected."""
+    values, unknown_units = normalise_states(
+        'power', ['1500', '2', '3', '4', 'unavailable'], ['W', 'kW', None, 'MW', 'kW'], POWER_UNIT_CONVERSIONS)
+    assert values[:2].tolist() == [1.5, 2.0]
+    assert np.isnan(values[2:]).all()
+    assert unknown_units == {'MW'}
+
+
+def test_normalise_states_with_a_shared_unit():
+    """A single unit is applied to every state."""
+    values, unknown_units = normalise_states(
+        'temperature', ['32', '212'], '°F', TEMPERATURE_UNIT_CONVERSIONS)
+    assert values.tolist() == [0.0, 100.0]
+    assert unknown_units == set()
+
+
+def test_power_history_drops_unknown_units():
+    """Power readings in unsupported units are dropped, not raised."""
+    states = [
+        state('1500', {'unit_of_measurement': 'W'}, seconds=0),
+        state('1', {'unit_of_measurement': 'MW'}, seconds=60)]
+    frame, _constant_attributes = states_to_histories(None, const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER, states)
+    assert frame.values.tolist() == [1.5]
+    assert len(frame) == 1
@@ -0,0 +1,128 @@
+"""Tests for the columnar HistoryFrame and the converters that build it."""
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from homeassistant.const import UnitOfTemperature
+
+from custom_components.optispark import const
+from custom_components.optispark.history import (
+    HistoryFrame,
+    datetime_to_epoch_us,
+    epoch_us_to_datetime,
+    states_to_histories,
+)
+
+START = datetime(2023, 11, 1, tzinfo=timezone.utc)
+
+
+def hass(temperature_unit=UnitOfTemperature.CELSIUS):
+    """Stand-in for the hass attributes the converters read."""
+    return SimpleNamespace(config=SimpleNamespace(units=SimpleNamespace(temperature_unit=temperature_unit)))
+
+
+def state(entity_id, value, attributes, seconds):
+    """Stand-in for a recorded state, seconds after START."""
+    return SimpleNamespace(
+        entity_id=entity_id,
+        state=value,
+        attributes=attributes,
+        last_updated=START + timedelta(seconds=seconds))
+
+
+def test_epoch_us_round_trip():
+    """Datetimes survive the conversion to microseconds, including the microseconds."""
+    date = datetime(2023, 11, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    assert epoch_us_to_datetime(datetime_to_epoch_us(date)) == date
+    assert datetime_to_epoch_us(datetime(1970, 1, 1, tzinfo=timezone.utc)) == 0
+
+
+def test_to_dict_matches_the_dynamo_format():
+    """to_dict gives the {datetime: {'state': ..., 'attributes': ...}} format, {} without attributes."""
+    frame = HistoryFrame(
+        timestamps=[1_000_000, 2_000_000],
+        values=[float('nan'), float('nan')],
+        labels=['heat', 'off'],
+        label_ids=[1, 0],
+        attributes=[{'temperature': 20.0}],
+        attribute_ids=[0, -1])
+    assert frame.to_dict() == {
+        epoch_us_to_datetime(1_000_000): {'state': 'off', 'attributes': {'temperature': 20.0}},
+        epoch_us_to_datetime(2_000_000): {'state': 'heat', 'attributes': {}}}
+
+
+def test_numeric_states_are_the_values():
+    """Entities without labels report their float values as states."""
+    frame = HistoryFrame([1, 2, 3], [0.5, 1.0, 1.5])
+    assert len(frame) == 3
+    assert frame.states() == [0.5, 1.0, 1.5]
+    assert frame.attribute_ids.tolist() == [-1, -1, -1]
+
+
+def test_climate_side_tables_hold_each_distinct_value_once():
+    """Repeated hvac modes and attribute payloads are stored once and indexed by every reading."""
+    attributes = {'current_temperature': '20.5', 'temperature': 21}
+    states = [
+        state('climate.heat_pump', 'heat', attributes, 0),
+        state('climate.heat_pump', 'heat', attributes, 60),
+        state('climate.heat_pump', 'off', attributes, 120)]
+    frame, constant_attributes = states_to_histories(hass(), const.DATABASE_COLUMN_SENSOR_CLIMATE_ENTITY, states)
+    assert frame.labels == ['heat', 'off']
+    assert frame.label_ids.tolist() == [0, 0, 1]
+    assert frame.attribute_ids.tolist() == [0, 0, 0]
+    assert frame.attributes[0]['current_temperature'] == 20.5
+    assert frame.datetimes() == [START, START + timedelta(seconds=60), START + timedelta(seconds=120)]
+    assert constant_attributes['entity_id'] == 'climate.heat_pump'
+
+
+def test_sensor_values_are_converted_to_dynamo_units():
+    """Power is converted to kW and the external temperature to °C."""
+    power = [
+        state('sensor.power', '1500', {'unit_of_measurement': 'W'}, 0),
+        state('sensor.power', '2', {'unit_of_measurement': 'kW'}, 60)]
+    frame, _constant_attributes = states_to_histories(hass(), const.DATABASE_COLUMN_SENSOR_HEAT_PUMP_POWER, power)
+    assert frame.values.tolist() == [1.5, 2.0]
+    temperature = [state('sensor.outside', '50', {'unit_of_measurement': '°F'}, 0)]
+    frame, _constant_attributes = states_to_histories(
+        hass(), const.DATABASE_COLUMN_SENSOR_EXTERNAL_TEMPERATURE, temperature)
+    assert frame.values.tolist() == [10.0]
+
+
+def sliceable_frame():
+    """HistoryFrame of readings at 10, 20, 20 and 30 µs with labels and attributes."""
+    return HistoryFrame(
+        timestamps=[10, 20, 20, 30],
+        values=[1.0, 2.0, 2.5, 3.0],
+        labels=['heat', 'off'],
+        label_ids=[0, 1, 0, 1],
+        attributes=[{'temperature': 20.0}],
+        attribute_ids=[0, -1, 0, -1])
+
+
+def test_after_excludes_the_date():
+    """Readings at the date are left out by after."""
+    after = sliceable_frame().after(epoch_us_to_datetime(20))
+    assert after.timestamps.tolist() == [30]
+    assert after.states() == ['off']
+
+
+def test_before_excludes_the_date():
+    """Readings at the date are left out by before."""
+    before = sliceable_frame().before(epoch_us_to_datetime(20))
+    assert before.timestamps.tolist() == [10]
+    assert before.values.tolist() == [1.0]
+
+
+def test_window_keeps_side_tables():
+    """Slices share the side tables, the ids still index into them."""
+    window = sliceable_frame().after(epoch_us_to_datetime(10)).before(epoch_us_to_datetime(30))
+    assert window.timestamps.tolist() == [20, 20]
+    assert window.states() == ['off', 'heat']
+    assert window.attribute_ids.tolist() == [-1, 0]
+    assert window.attributes == [{'temperature': 20.0}]
+
+
+def test_empty_slices():
+    """Windows without readings give empty frames."""
+    assert len(sliceable_frame().after(datetime(2100, 1, 1, tzinfo=timezone.utc))) == 0
+    assert len(sliceable_frame().before(epoch_us_to_datetime(10))) == 0
+    assert sliceable_frame().before(epoch_us_to_datetime(10)).first_datetime() is None
@@ -0,0 +1,81 @@
+"""Tests for the updates caused by the heat pump's inputs changing."""
+from types import SimpleNamespace
+
+from homeassistant.const import UnitOfTemperature
+
+from custom_components.optispark.coordinator import OptisparkDataUpdateCoordinator
+
+
+class StateMachine:
+    """Stand-in for hass.states that the tests can change."""
+
+    def __init__(self):
+        """Init."""
+        self.states = {}
+
+    def get(self, entity_id):
+        """State of entity_id."""
+        return self.states.get(entity_id)
+
+    def set(self, entity_id, state, attributes):
+        """Change the state of entity_id, returns the state_changed event data."""
+        self.states[entity_id] = SimpleNamespace(entity_id=entity_id, state=state, attributes=attributes)
+        return SimpleNamespace(data={'entity_id': entity_id, 'new_state': self.states[entity_id]})
+
+
+def stand_in_coordinator():
+    """Coordinator with only the parts used by _async_input_changed, recording what it does."""
+    states = StateMachine()
+    coordinator = OptisparkDataUpdateCoordinator.__new__(OptisparkDataUpdateCoordinator)
+    coordinator.hass = SimpleNamespace(
+        states=states,
+        config=SimpleNamespace(units=SimpleNamespace(temperature_unit=UnitOfTemperature.CELSIUS)))
+    coordinator._climate_entity_id = 'climate.heat_pump'
+    coordinator._heat_pump_power_entity_id = 'sensor.power'
+    coordinator._external_temp_entity_id = 'sensor.outside'
+    coordinator._switch_enabled = True
+    coordinator._snapshot = None
+    coordinator.calls = []
+    coordinator.async_update_listeners = lambda: coordinator.calls.append('listeners')
+    coordinator.async_schedule_update = lambda: coordinator.calls.append('update')
+    states.set('climate.heat_pump', 'heat', {'current_temperature': 20, 'temperature': 21})
+    states.set('sensor.power', '1000', {'unit_of_measurement': 'W'})
+    return coordinator, states
+
+
+def test_changes_to_the_update_inputs_schedule_an_update():
+    """A new internal or target temperature refreshes the entities and schedules an update."""
+    coordinator, states = stand_in_coordinator()
+    coordinator.refresh_snapshot()
+    coordinator._async_input_changed(
+        states.set('climate.heat_pump', 'heat', {'current_temperature': 19.5, 'temperature': 21}))
+    assert coordinator.calls == ['listeners', 'update']
+    assert coordinator.snapshot.internal_temp == 19.5
+
+
+def test_other_changes_only_refresh_the_entities():
+    """Sensors and unrelated climate attributes are shown straight away without an update."""
+    coordinator, states = stand_in_coordinator()
+    coordinator.refresh_snapshot()
+    coordinator._async_input_changed(states.set('sensor.power', '2000', {'unit_of_measurement': 'W'}))
+    coordinator._async_input_changed(states.set(
+        'climate.heat_pump', 'heat', {'current_temperature': 20, 'temperature': 21, 'fan_mode': 'low'}))
+    assert coordinator.calls == ['listeners', 'listeners']
+    assert coordinator.snapshot.heat_pump_power_usage == 2.0
+
+
+def test_nothing_happens_while_disabled_or_on_removal():
+    """Changes are ignored while the integration is disabled, and when an entity is removed."""
+    coordinator, states = stand_in_coordinator()
+    coordinator.refresh_snapshot()
+    coordinator._async_input_changed(SimpleNamespace(data={'entity_id': 'climate.heat_pump', 'new_state': None}))
+    coordinator._switch_enabled = False
+    coordinator._async_input_changed(
+        states.set('climate.heat_pump', 'heat', {'current_temperature': 18, 'temperature': 21}))
+    assert coordinator.calls == []
+
+
+def test_update_inputs():
+    """Only the temperatures and features read by an update are compared."""
+    coordinator, _states = stand_in_coordinator()
+    assert coordinator.snapshot.update_inputs() == (20.0, 21.0, 0)
@@ -0,0 +1,134 @@
+"""Tests for the single flight of profile requests."""
+import asyncio
+
+from custom_components.optispark import const
+from custom_components.optispark.api import OptisparkApiClient, profile_request_key
+
+SET_POINT = const.LAMBDA_SET_POINT
+
+
+class FakeLambda:
+    """Stand-in for _async_get_profile, each request waits until it is released."""
+
+    def __init__(self):
+        """Init."""
+        self.requests = []
+        self.cancelled = []
+        self.release = None
+
+    async def __call__(self, lambda_args):
+        """Answer with the set point that was asked for."""
+        self.requests.append(lambda_args)
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(lambda_args)
+            raise
+        return {SET_POINT: lambda_args[SET_POINT]}
+
+
+def client_and_lambda():
+    """Client whose profile requests are answered by a FakeLambda."""
+    client = OptisparkApiClient(None)
+    fake_lambda = FakeLambda()
+    client._async_get_profile = fake_lambda
+    return client, fake_lambda
+
+
+def test_equivalent_requests_are_coalesced():
+    """Concurrent callers with equal lambda_args share one request."""
+    async def test():
+        client, fake_lambda = client_and_lambda()
+        fake_lambda.release = asyncio.Event()
+        callers = [asyncio.create_task(client.async_get_profile({SET_POINT: 20})) for _ in range(3)]
+        await asyncio.sleep(0)
+        fake_lambda.release.set()
+        results = await asyncio.gather(*callers)
+        assert results == [{SET_POINT: 20}] * 3
+        assert len(fake_lambda.requests) == 1
+        assert client.profile_requests_coalesced == 2
+
+    asyncio.run(test())
+
+
+def test_new_lambda_args_supersede_the_request_in_flight():
+    """The stale request is cancelled and its callers get the new request's result."""
+    async def test():
+        client, fake_lambda = client_and_lambda()
+        fake_lambda.release = asyncio.Event()
+        stale = asyncio.create_task(client.async_get_profile({SET_POINT: 20}))
+        await asyncio.sleep(0)
+        fresh = asyncio.create_task(client.async_get_profile({SET_POINT: 22}))
+        await asyncio.sleep(0)
+        fake_lambda.release.set()
+        assert await stale == {SET_POINT: 22}
+        assert await fresh == {SET_POINT: 22}
+        assert fake_lambda.cancelled == [{SET_POINT: 20}]
+
+    asyncio.run(test())
+
+
+def test_cancelled_caller_leaves_the_request_running():
+    """Cancelling one caller doesn't cancel the request the other callers are waiting for."""
+    async def test():
+        client, fake_lambda = client_and_lambda()
+        fake_lambda.release = asyncio.Event()
+        first = asyncio.create_task(client.async_get_profile({SET_POINT: 20}))
+        second = asyncio.create_task(client.async_get_profile({SET_POINT: 20}))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        fake_lambda.release.set()
+        assert await second == {SET_POINT: 20}
+        assert first.cancelled()
+        assert fake_lambda.cancelled == []
+
+    asyncio.run(test())
+
+
+def test_requests_after_completion_are_sent_again():
+    """Coalescing only applies while a request is in flight, results aren't cached."""
+    async def test():
+        client, fake_lambda = client_and_lambda()
+        fake_lambda.release = asyncio.Event()
+        fake_lambda.release.set()
+        await client.async_get_profile({SET_POINT: 20})
+        await client.async_get_profile({SET_POINT: 20})
+        assert len(fake_lambda.requests) == 2
+
+    asyncio.run(test())
+
+
+def test_request_key_only_compares_the_user_parameters():
+    """Requests that differ in the heat pump's current temperature are equivalent, not in a user parameter."""
+    lambda_args = {
+        const.LAMBDA_SET_POINT: 20.0,
+        const.LAMBDA_TEMP_RANGE: 2.0,
+        const.LAMBDA_POSTCODE: 'AB11 6LU',
+        const.LAMBDA_USER_HASH: 'user',
+        const.LAMBDA_HEAT_PUMP_MODE_RAW: 'HEATING',
+        const.LAMBDA_INITIAL_INTERNAL_TEMP: 19.5,
+        const.LAMBDA_OUTSIDE_RANGE: False}
+    warmer = lambda_args | {const.LAMBDA_INITIAL_INTERNAL_TEMP: 23.0, const.LAMBDA_OUTSIDE_RANGE: True}
+    assert profile_request_key(warmer) == profile_request_key(lambda_args)
+    for key in const.LAMBDA_PROFILE_REQUEST_KEY_ARGS:
+        changed = lambda_args | {key: 'changed'}
+        assert profile_request_key(changed) != profile_request_key(lambda_args), key
+
+
+def test_requests_with_a_new_internal_temp_are_coalesced():
+    """A request made as the internal temperature changes shares the request in flight."""
+    async def test():
+        client, fake_lambda = client_and_lambda()
+        fake_lambda.release = asyncio.Event()
+        first = asyncio.create_task(client.async_get_profile(
+            {SET_POINT: 20, const.LAMBDA_INITIAL_INTERNAL_TEMP: 19.0}))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(client.async_get_profile(
+            {SET_POINT: 20, const.LAMBDA_INITIAL_INTERNAL_TEMP: 19.5}))
+        await asyncio.sleep(0)
+        fake_lambda.release.set()
+        assert await first == await second == {SET_POINT: 20}
+        assert len(fake_lambda.requests) == 1
+
+    asyncio.run(test())
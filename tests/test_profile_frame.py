@@ -0,0 +1,100 @@
+"""Tests for the slot lookup and validation of ProfileFrame."""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from custom_components.optispark import const
+from custom_components.optispark.history import datetime_to_epoch_us
+from custom_components.optispark.profile_frame import ProfileFrame
+
+START = datetime(2023, 11, 1, tzinfo=timezone.utc)
+
+
+def lambda_results(count=3, **overrides):
+    """Heating profile with count half hour slots, the temp_controls of slot i is 18 + i."""
+    results = {const.LAMBDA_TIMESTAMP: [START + timedelta(minutes=30*i) for i in range(count)]}
+    for key in const.LAMBDA_TIME_BASED_KEYS:
+        results[key] = [float(i) for i in range(count)]
+    results[const.LAMBDA_TEMP_CONTROLS] = [18.0 + i for i in range(count)]
+    for key in const.LAMBDA_NON_TIME_BASED_KEYS:
+        results[key] = Decimal('1.5')
+    results.update(overrides)
+    return results
+
+
+def us(date):
+    """Microseconds since the epoch."""
+    return datetime_to_epoch_us(date)
+
+
+def test_slot_is_latest_timestamp_strictly_in_the_past():
+    """A timestamp only becomes the current slot once it has passed."""
+    frame = ProfileFrame(lambda_results())
+    second = START + timedelta(minutes=30)
+    assert frame.values_at(us(second))[const.LAMBDA_TEMP_CONTROLS] == 18.0
+    assert frame.values_at(us(second) + 1)[const.LAMBDA_TEMP_CONTROLS] == 19.0
+    assert frame.values_at(us(START) + 1)[const.LAMBDA_TEMP_CONTROLS] == 18.0
+
+
+def test_last_slot_lasts_forever():
+    """The last slot is used for any time after its timestamp."""
+    frame = ProfileFrame(lambda_results())
+    assert frame.values_at(us(START + timedelta(days=1)))[const.LAMBDA_TEMP_CONTROLS] == 20.0
+    assert frame.next_timestamp(START + timedelta(days=1)) is None
+
+
+def test_no_slot_before_the_first_timestamp():
+    """Looking up a time at or before the first timestamp is an error."""
+    frame = ProfileFrame(lambda_results())
+    with pytest.raises(ValueError):
+        frame.values_at(us(START))
+
+
+def test_slot_is_cached_until_it_ends():
+    """The binary search only runs again once the current slot has ended."""
+    frame = ProfileFrame(lambda_results())
+    first = frame.values_at(us(START) + 1)
+    assert frame.values_at(us(START + timedelta(minutes=30))) is first
+    assert frame.slot_searches == 1
+    frame.values_at(us(START + timedelta(minutes=30)) + 1)
+    assert frame.slot_searches == 2
+
+
+def test_next_timestamp():
+    """next_timestamp is the first timestamp strictly after now."""
+    frame = ProfileFrame(lambda_results())
+    assert frame.next_timestamp(START) == START + timedelta(minutes=30)
+    assert frame.next_timestamp(START - timedelta(seconds=1)) == START
+
+
+def test_unsorted_and_repeated_timestamps():
+    """Timestamps are sorted and a repeated timestamp keeps its last value."""
+    results = lambda_results(count=3)
+    results[const.LAMBDA_TIMESTAMP] = [START + timedelta(hours=1), START, START]
+    results[const.LAMBDA_TEMP_CONTROLS] = [30.0, 10.0, 11.0]
+    frame = ProfileFrame(results)
+    assert frame.values_at(us(START) + 1)[const.LAMBDA_TEMP_CONTROLS] == 11.0
+    assert frame.values_at(us(START + timedelta(hours=1)) + 1)[const.LAMBDA_TEMP_CONTROLS] == 30.0
+
+
+def test_values_are_read_only():
+    """The values returned are shared between lookups so they can't be modified."""
+    values = ProfileFrame(lambda_results()).values_at(us(START) + 1)
+    assert values[const.LAMBDA_BASE_COST] == 1.5
+    with pytest.raises(TypeError):
+        values[const.LAMBDA_TEMP_CONTROLS] = 0.0
+
+
+@pytest.mark.parametrize('overrides', [
+    {const.LAMBDA_TEMP_CONTROLS: [18.0, None, 20.0]},
+    {const.LAMBDA_TEMP_CONTROLS: [18.0, float('nan'), 20.0]},
+    {const.LAMBDA_TEMP_CONTROLS: [18.0, '19', 20.0]},
+    {const.LAMBDA_TEMP_CONTROLS: [18.0, 19.0]},
+    {const.LAMBDA_BASE_COST: None},
+    {const.LAMBDA_TIMESTAMP: [START, None, START + timedelta(hours=1)]},
+])
+def test_invalid_profiles_are_rejected(overrides):
+    """Values that aren't finite numbers are rejected rather than coerced."""
+    with pytest.raises(ValueError):
+        ProfileFrame(lambda_results(**overrides))
@@ -0,0 +1,160 @@
+"""Tests for the retry policy and circuit breaker."""
+import asyncio
+import random
+
+import pytest
+
+from custom_components.optispark import api, resilience
+from custom_components.optispark.api import (
+    OptisparkApiClient,
+    OptisparkApiClientCommunicationError,
+    OptisparkApiClientRequestError,
+)
+from custom_components.optispark.resilience import CircuitBreaker, RetryPolicy
+from custom_components.optispark.transport import TransportResponse
+
+
+class Clock:
+    """Controllable replacement for time.monotonic."""
+
+    def __init__(self):
+        """Init."""
+        self.now = 1000.0
+
+    def __call__(self):
+        """Current time."""
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Clock used by the circuit breaker."""
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, 'monotonic', clock)
+    return clock
+
+
+class Lowest:
+    """Random number generator that always picks the lower bound."""
+
+    def uniform(self, low, high):
+        """Lower bound."""
+        return low
+
+
+def test_retry_delay_is_capped_exponential_backoff():
+    """The jittered delay never exceeds the capped exponential backoff."""
+    policy = RetryPolicy(attempts=5, base_delay=1, max_delay=5, max_total=60)
+    rng = random.Random(1)
+    for retry, cap in [(1, 1), (2, 2), (3, 4), (4, 5), (10, 5)]:
+        for _ in range(50):
+            assert 0 <= policy.delay(retry, rng) <= cap
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    """The threshold of consecutive failures opens the breaker, a success resets the count."""
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, rng=Lowest())
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.calls_refused == 1
+    assert breaker.retry_after() == 60
+
+
+def test_half_open_probe(clock):
+    """Once the reset timeout has passed a single probe goes through and decides the state."""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60, rng=Lowest())
+    breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_released_probe_lets_the_next_call_probe(clock):
+    """A cancelled probe doesn't leave the breaker half open."""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60, rng=Lowest())
+    breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.release()
+    assert breaker.allow_request()
+
+
+def test_concurrent_failures_count_once(clock):
+    """Calls let through together that fail together are a single failure."""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, rng=Lowest())
+    generations = []
+    for _ in range(4):
+        assert breaker.allow_request()
+        generations.append(breaker.generation)
+    for generation in generations:
+        breaker.record_failure(generation)
+    assert breaker.failures == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+    # A call let through after the failure was recorded counts again
+    breaker.record_failure(breaker.generation)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+class FailingTransport:
+    """Transport answering every request with status, taking seconds of the clock each time."""
+
+    def __init__(self, clock, status, seconds=0):
+        """Init."""
+        self.clock = clock
+        self.status = status
+        self.seconds = seconds
+        self.requests = 0
+
+    async def request(self, method, url, data=None, json=None, headers=None):
+        """Answer with status."""
+        self.requests += 1
+        self.clock.now += self.seconds
+        return TransportResponse(self.status, 'text/plain', b'')
+
+
+def client_with(transport, clock, monkeypatch):
+    """Client whose retry backoffs advance clock instead of sleeping."""
+    async def sleep(seconds):
+        clock.now += seconds
+
+    monkeypatch.setattr(api.asyncio, 'sleep', sleep)
+    client = OptisparkApiClient(transport=transport)
+    client.random = Lowest()
+    return client
+
+
+def test_502_is_not_retried(clock, monkeypatch):
+    """A 502 means the lambda failed on the payload, it is raised straight away."""
+    transport = FailingTransport(clock, 502)
+    client = client_with(transport, clock, monkeypatch)
+    with pytest.raises(OptisparkApiClientRequestError):
+        asyncio.run(client.get_data_dates({'user_hash': 'user'}))
+    assert transport.requests == 1
+    assert client.circuit_breaker.failures == 0
+
+
+def test_retries_stop_at_the_total_time_budget(clock, monkeypatch):
+    """Slow failures aren't retried once the policy's max_total would be exceeded."""
+    transport = FailingTransport(clock, 503, seconds=100)
+    client = client_with(transport, clock, monkeypatch)
+    policy = client.retry_policies['upload_history']
+    start = clock.now
+    with pytest.raises(OptisparkApiClientCommunicationError):
+        asyncio.run(client.upload_history({'user_hash': 'user'}))
+    assert transport.requests < policy.attempts
+    assert clock.now - start <= policy.max_total
@@ -0,0 +1,79 @@
+"""Tests for the snapshot of the heat pump's inputs."""
+from types import SimpleNamespace
+
+from homeassistant.components.climate import ClimateEntityFeature
+from homeassistant.const import UnitOfTemperature
+
+from custom_components.optispark import snapshot as snapshot_module
+from custom_components.optispark.snapshot import take_snapshot
+
+
+def hass(states, temperature_unit=UnitOfTemperature.CELSIUS):
+    """Stand-in for hass with a state machine holding states ({entity_id: (state, attributes)})."""
+    states = {
+        entity_id: SimpleNamespace(entity_id=entity_id, state=state, attributes=attributes)
+        for entity_id, (state, attributes) in states.items()}
+    return SimpleNamespace(
+        states=SimpleNamespace(get=states.get),
+        config=SimpleNamespace(units=SimpleNamespace(temperature_unit=temperature_unit)))
+
+
+def snapshot(states, temperature_unit=UnitOfTemperature.CELSIUS, external_temp_entity_id='sensor.outside'):
+    """Snapshot of the standard entities."""
+    return take_snapshot(
+        hass(states, temperature_unit), 'climate.heat_pump', 'sensor.power', external_temp_entity_id)
+
+
+def test_values_are_converted_to_celsius_and_kw():
+    """Climate temperatures use the user's unit, sensors their own unit of measurement."""
+    taken = snapshot({
+        'climate.heat_pump': ('heat', {'current_temperature': 68, 'temperature': '77', 'supported_features': 1}),
+        'sensor.power': ('1500', {'unit_of_measurement': 'W'}),
+        'sensor.outside': ('50', {'unit_of_measurement': '°F'})},
+        temperature_unit=UnitOfTemperature.FAHRENHEIT)
+    assert taken.internal_temp == 20.0
+    assert taken.target_temp == 25.0
+    assert taken.heat_pump_power_usage == 1.5
+    assert taken.external_temp == 10.0
+    assert taken.taken.tzinfo is not None
+
+
+def test_temperature_range_uses_target_temp_low():
+    """Heat pumps that work with a range report their lower bound as the target."""
+    taken = snapshot({
+        'climate.heat_pump': ('heat_cool', {
+            'current_temperature': 20,
+            'target_temp_low': 19,
+            'target_temp_high': 24,
+            'supported_features': ClimateEntityFeature.TARGET_TEMPERATURE_RANGE})})
+    assert taken.target_temp == 19.0
+    assert taken.supported_features == ClimateEntityFeature.TARGET_TEMPERATURE_RANGE
+
+
+def test_missing_and_unusable_states_are_none():
+    """Missing entities, non numeric states and unsupported units give None."""
+    taken = snapshot({
+        'sensor.power': ('unavailable', {'unit_of_measurement': 'W'}),
+        'sensor.outside': ('280', {'unit_of_measurement': 'K'})})
+    assert taken.internal_temp is None
+    assert taken.target_temp is None
+    assert taken.supported_features == 0
+    assert taken.heat_pump_power_usage is None
+    assert taken.external_temp is None
+    assert snapshot({}, external_temp_entity_id=None).external_temp is None
+
+
+def test_unsupported_unit_is_logged_once_per_entity(caplog, monkeypatch):
+    """Snapshots are taken every tick, an unsupported unit is only reported the first time."""
+    monkeypatch.setattr(snapshot_module, '_reported_units', set())
+    states = {
+        'sensor.power': ('3', {'unit_of_measurement': 'hp'}),
+        'sensor.outside': ('3', {'unit_of_measurement': 'hp'})}
+    for _ in range(3):
+        taken = snapshot(states)
+        assert taken.heat_pump_power_usage is None
+        assert taken.external_temp is None
+    errors = [record.getMessage() for record in caplog.records if record.levelname == 'ERROR']
+    assert len(errors) == 2
+    assert {'sensor.power', 'sensor.outside'} == {
+        entity_id for entity_id in ('sensor.power', 'sensor.outside') for error in errors if entity_id in error}
@@ -0,0 +1,84 @@
+"""Tests for the acknowledged windows of UploadJournal."""
+from unittest.mock import MagicMock
+
+import pytest
+
+from custom_components.optispark.history import epoch_us_to_datetime as dt
+from custom_components.optispark.upload_journal import UploadJournal
+
+COLUMN = 'heat_pump_power'
+
+
+class MemoryStore:
+    """Stand-in for the Store helper that keeps the last save in memory."""
+
+    def __init__(self):
+        """Init."""
+        self.data = None
+
+    def async_delay_save(self, data_func, delay):
+        """Save straight away."""
+        self.data = data_func()
+
+
+@pytest.fixture
+def journal():
+    """Journal of a config entry, saved in memory."""
+    journal = UploadJournal(MagicMock(), 'entry')
+    journal.store = MemoryStore()
+    return journal
+
+
+def test_overlapping_windows_are_merged(journal):
+    """Exclusive windows merge when one starts before the other ends."""
+    journal.acknowledge(COLUMN, dt(100), dt(200))
+    journal.acknowledge(COLUMN, dt(199), dt(300))
+    journal.acknowledge(COLUMN, dt(150), dt(160))
+    assert journal.acknowledged[COLUMN] == [(100, 300)]
+    assert journal.store.data['acknowledged'][COLUMN] == [[100, 300]]
+
+
+def test_windows_with_a_gap_are_kept_apart(journal):
+    """(100, 200) and (200, 300) don't hold a reading at 200, so they aren't merged."""
+    journal.acknowledge(COLUMN, dt(200), dt(300))
+    journal.acknowledge(COLUMN, dt(100), dt(200))
+    assert journal.acknowledged[COLUMN] == [(100, 200), (200, 300)]
+
+
+def test_find_acknowledged_ascending(journal):
+    """An ascending window can skip the acknowledged part at its start."""
+    journal.acknowledge(COLUMN, dt(100), dt(200))
+    assert journal.find_acknowledged(COLUMN, dt(150), dt(500), False) == (dt(150), dt(200), False)
+    assert journal.find_acknowledged(COLUMN, dt(150), dt(180), False) == (dt(150), dt(180), True)
+    # Nothing is acknowledged after 199 µs
+    assert journal.find_acknowledged(COLUMN, dt(199), dt(500), False) is None
+
+
+def test_find_acknowledged_descending(journal):
+    """A descending window can skip the acknowledged part at its end."""
+    journal.acknowledge(COLUMN, dt(100), dt(200))
+    assert journal.find_acknowledged(COLUMN, dt(0), dt(150), True) == (dt(100), dt(150), False)
+    assert journal.find_acknowledged(COLUMN, dt(120), dt(150), True) == (dt(120), dt(150), True)
+    assert journal.find_acknowledged(COLUMN, dt(0), dt(101), True) is None
+
+
+def test_commit_drops_windows_behind_the_watermarks(journal):
+    """Windows between the oldest and newest watermarks are forgotten once committed."""
+    journal.acknowledge(COLUMN, dt(100), dt(200))
+    journal.acknowledge(COLUMN, dt(500), dt(600))
+    journal.commit({COLUMN: dt(300)}, {COLUMN: dt(50)})
+    assert journal.acknowledged[COLUMN] == [(500, 600)]
+    assert journal.has_watermarks([COLUMN])
+    assert not journal.has_watermarks([COLUMN, 'climate_entity'])
+
+
+def test_is_uploaded(journal):
+    """Windows behind the watermarks or inside an acknowledged window are uploaded."""
+    journal.commit({COLUMN: dt(300)}, {COLUMN: dt(50)})
+    journal.acknowledge(COLUMN, dt(500), dt(600))
+    assert journal.is_uploaded(COLUMN, 49, 301)
+    assert not journal.is_uploaded(COLUMN, 48, 301)
+    assert not journal.is_uploaded(COLUMN, 250, 400)
+    assert journal.is_uploaded(COLUMN, 500, 600)
+    assert not journal.is_uploaded(COLUMN, 550, 650)
+    assert not journal.is_uploaded('climate_entity', 100, 200)
@@ -0,0 +1,88 @@
+"""Tests for the ordering and backpressure of UploadScheduler."""
+import asyncio
+
+import pytest
+
+from custom_components.optispark.upload_scheduler import UploadScheduler
+
+
+async def produce(payloads, produced=None):
+    """Async iterator over payloads, recording how far it has been advanced."""
+    for payload in payloads:
+        if produced is not None:
+            produced.append(payload)
+        yield payload
+
+
+def test_commits_in_production_order():
+    """Uploads that finish out of order are still committed in the order they were produced."""
+    committed = []
+
+    async def upload(payload):
+        # Later payloads finish first
+        await asyncio.sleep(0.01 * (5 - payload))
+        return payload * 10
+
+    async def commit(payload, result):
+        committed.append((payload, result))
+
+    scheduler = UploadScheduler(upload, commit, max_in_flight=5)
+    count = asyncio.run(scheduler.run(produce(range(5))))
+    assert count == 5
+    assert committed == [(0, 0), (1, 10), (2, 20), (3, 30), (4, 40)]
+
+
+def test_uploads_in_flight_are_bounded():
+    """No more than max_in_flight uploads run at once."""
+    in_flight = 0
+    peak = 0
+
+    async def upload(payload):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    async def commit(payload, result):
+        pass
+
+    scheduler = UploadScheduler(upload, commit, max_in_flight=2)
+    assert asyncio.run(scheduler.run(produce(range(6)))) == 6
+    assert peak == 2
+
+
+def test_failed_upload_stops_commits():
+    """Nothing after a failed upload is committed, even uploads that succeeded."""
+    committed = []
+
+    async def upload(payload):
+        if payload == 1:
+            await asyncio.sleep(0.02)
+            raise RuntimeError('upload failed')
+        return payload
+
+    async def commit(payload, result):
+        committed.append(payload)
+
+    scheduler = UploadScheduler(upload, commit, max_in_flight=3)
+    with pytest.raises(RuntimeError):
+        asyncio.run(scheduler.run(produce(range(3))))
+    assert committed == [0]
+
+
+def test_limit_stops_reading_payloads():
+    """The payloads stop being read once limit payloads have been produced."""
+    committed = []
+    produced = []
+
+    async def upload(payload):
+        return payload
+
+    async def commit(payload, result):
+        committed.append(payload)
+
+    scheduler = UploadScheduler(upload, commit, max_in_flight=2)
+    assert asyncio.run(scheduler.run(produce(range(10), produced), limit=3)) == 3
+    assert committed == [0, 1, 2]
+    assert produced == [0, 1, 2]